@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+ Copyright (C) 2010-2013, Ryan Fan <reg_info@126.com>
+
+ This program is free software; you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation; either version 2 of the License, or
+ (at your option) any later version.
+
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU Library General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with this program; if not, write to the Free Software
+ Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+"""
+import asyncio
+import json
+
+from yunresolver import YunResolver, ThrottlingError, MAX_PAGE_SIZE, DEFAULT_API_URL, \
+    THROTTLING_CODES
+from utils import DDNSUtils
+from metrics import API_REQUESTS, API_REQUEST_DURATION, API_RETRIES
+
+
+class AsyncYunResolver(YunResolver):
+    """
+    asyncio implementation of Aliyun Resolver API, it shares params building
+    and signing with YunResolver, only network I/O is done by aiohttp
+    """
+    def __init__(self, access_id, access_key, debug, pool_size=100,
+                 connect_timeout=5, read_timeout=10, max_retries=3, retry_backoff=0.5,
+                 url=DEFAULT_API_URL):
+        super(AsyncYunResolver, self).__init__(access_id, access_key, debug,
+                                               pool_size=pool_size,
+                                               connect_timeout=connect_timeout,
+                                               read_timeout=read_timeout,
+                                               max_retries=max_retries,
+                                               retry_backoff=retry_backoff,
+                                               url=url)
+
+    @property
+    def session(self):
+        """
+        aiohttp session, created on first use inside the running event loop
+        """
+        if self._session is None:
+            import aiohttp
+            connector = aiohttp.TCPConnector(limit=self.pool_size)
+            timeout = aiohttp.ClientTimeout(sock_connect=self.timeout[0],
+                                            sock_read=self.timeout[1])
+            self._session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        return self._session
+
+    def close(self):
+        """
+        Close pooled connections from synchronous code like YunResolver.close(),
+        transports are dropped at once. Coroutines should await aclose()
+        """
+        session, self._session = self._session, None
+        if session is not None and session.connector is not None:
+            session.connector.close()
+
+    async def aclose(self):
+        """
+        Close pooled connections gracefully on the running event loop
+        """
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    @staticmethod
+    def get_error_code(content):
+        """
+        Get Aliyun error code from failed response
+
+        :param content: response body
+        :return: error code or None
+        """
+        try:
+            return json.loads(content.decode("utf-8")).get('Code')
+        except (ValueError, AttributeError):
+            return None
+
+    async def request(self, params, raise_throttling=False):
+        """
+        Send signed request to Aliyun through the pooled session, retried the
+        same way as YunResolver.request()
+
+        :param params: signed request params
+        :param raise_throttling: raise ThrottlingError if Aliyun asks to slow down
+        :return: tuple of (http status, json result or None)
+        """
+        import aiohttp
+
+        action = params.get('Action', '')
+        attempt = 0
+        while True:
+            # aiohttp only accepts str or number query values
+            query = dict((k, str(v)) for k, v in params.items())
+            try:
+                with API_REQUEST_DURATION.time(action=action):
+                    async with self.session.get(self.url, params=query) as ret:
+                        status = ret.status
+                        content = await ret.read()
+            except aiohttp.ClientConnectorError:
+                # the request never reached Aliyun, it can be sent again as is
+                API_REQUESTS.inc(action=action, code="error")
+                if attempt >= self.max_retries:
+                    raise
+                API_RETRIES.inc(action=action)
+                await asyncio.sleep(self.retry_backoff * (2 ** attempt))
+                attempt += 1
+                continue
+
+            API_REQUESTS.inc(action=action, code=status)
+            if status == 200:
+                return status, json.loads(content.decode("utf-8"))
+
+            error_code = self.get_error_code(content)
+            if raise_throttling and error_code in THROTTLING_CODES:
+                raise ThrottlingError(error_code)
+            if attempt < self.max_retries and self.is_retryable(status, error_code):
+                API_RETRIES.inc(action=action)
+                await asyncio.sleep(self.retry_backoff * (2 ** attempt))
+                attempt += 1
+                self.resign(params)
+                continue
+
+            DDNSUtils.err("Server side problem: {0}".format(status),
+                          action=action, status=status)
+            if self.debug:
+                DDNSUtils.err("Error in {0}(), params: {1},\nhttp response: {2}"
+                              .format(action, query, content),
+                              action=action, params=query, response=content)
+            return status, None
+
+    async def describe_domain_records_page(self, domain_name, page_number=None, page_size=None,
+                                           rr_keyword="", type_keyword="", value_keyword=""):
+        """
+        query:  DomainName(*), PageNumber, PageSize, RRKeyWord, TypeKeyWord, ValueKeyWord
+        return: TotalCount, PageNumber, PageSize, DomainRecords
+        """
+        params = self.get_describe_domain_records_params(domain_name,
+                                                         page_number=page_number,
+                                                         page_size=page_size,
+                                                         rr_keyword=rr_keyword,
+                                                         type_keyword=type_keyword,
+                                                         value_keyword=value_keyword)
+        _, json_result = await self.request(params)
+        return json_result
+
+    async def iter_domain_records(self, domain_name, page_size=MAX_PAGE_SIZE,
+                                  rr_keyword="", type_keyword="", value_keyword=""):
+        """
+        Async generator walking through all pages of DescribeDomainRecords,
+        the next page is requested while the current one is consumed
+
+        :return: async generator of domain record dict
+        """
+        def fetch(page_number):
+            return asyncio.ensure_future(
+                self.describe_domain_records_page(domain_name,
+                                                  page_number=page_number,
+                                                  page_size=page_size,
+                                                  rr_keyword=rr_keyword,
+                                                  type_keyword=type_keyword,
+                                                  value_keyword=value_keyword))
+
+        page_number = 1
+        fetched_count = 0
+        json_result = await fetch(page_number)
+        while json_result:
+            total_count = json_result.get('TotalCount', 0)
+            records = json_result.get('DomainRecords', {}).get('Record', [])
+            fetched_count += len(records)
+
+            next_page = None
+            if records and fetched_count < total_count:
+                page_number += 1
+                next_page = fetch(page_number)
+
+            try:
+                for rec in records:
+                    yield rec
+            except GeneratorExit:
+                if next_page is not None:
+                    next_page.cancel()
+                raise
+
+            if next_page is None:
+                break
+
+            json_result = await next_page
+            if not json_result:
+                DDNSUtils.err("Failed fetching page {0} of DomainRecords for {1}, " \
+                              "got {2} of {3} records".format(page_number, domain_name,
+                                                               fetched_count, total_count),
+                              domain=domain_name, page=page_number, fetched=fetched_count,
+                              total=total_count)
+
+    async def describe_domain_records(self, domain_name, page_number=None, page_size=None,
+                                      rr_keyword="", type_keyword="", value_keyword=""):
+        """
+        Fetch domain records as list, all pages are fetched unless page_number is given
+
+        :return: list of domain record dict or None
+        """
+        if page_number:
+            json_result = await self.describe_domain_records_page(domain_name,
+                                                                  page_number=page_number,
+                                                                  page_size=page_size,
+                                                                  rr_keyword=rr_keyword,
+                                                                  type_keyword=type_keyword,
+                                                                  value_keyword=value_keyword)
+            if not json_result or json_result.get('TotalCount', 0) == 0:
+                return None
+            return list(json_result['DomainRecords']['Record'])
+
+        domain_record_list = []
+        async for rec in self.iter_domain_records(domain_name,
+                                                  page_size=page_size or MAX_PAGE_SIZE,
+                                                  rr_keyword=rr_keyword,
+                                                  type_keyword=type_keyword,
+                                                  value_keyword=value_keyword):
+            domain_record_list.append(rec)
+
+        if not domain_record_list:
+            return None
+
+        return domain_record_list
+
+    async def update_domain_record(self, record_id, rr="www", record_type="A",
+                                   record_value="192.168.0.1",
+                                   ttl=None, priority=None, line=None):
+        """
+        Update remote domain record on Aliyun server
+
+        :return: True if succeed, of False if failed
+        :raise ThrottlingError: if Aliyun asks to slow down
+        """
+        params = self.get_update_domain_record_params(record_id, rr=rr,
+                                                      record_type=record_type,
+                                                      record_value=record_value,
+                                                      ttl=ttl, priority=priority, line=line)
+        if params is None:
+            return False
+
+        status, _ = await self.request(params, raise_throttling=True)
+        return status == 200
+
+    async def describe_domain_record_info(self, record_id):
+        """
+        Fetch remote domain record info by record id
+
+        :param record_id:  domain record id
+        :return:  dict
+        """
+        params = self.get_describe_domain_record_info_params(record_id)
+        _, json_result = await self.request(params)
+        if json_result is None:
+            return False
+
+        return json_result
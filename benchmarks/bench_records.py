@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+Memory and time benchmark of record models and the indexes kept by
+DDNSDomainRecordManager, compared with the dict based records and linear
+matching used before. Run from the repository root:
+
+    python benchmarks/bench_records.py --sizes 10000,100000
+"""
+from __future__ import print_function
+import argparse
+import gc
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from config import DDNSConfig # pylint: disable=wrong-import-position
+from record import DDNSDomainRecordManager # pylint: disable=wrong-import-position
+from provider import AliyunProvider # pylint: disable=wrong-import-position
+
+
+class LegacyRemoteDomainRecord(object):
+    """
+    RemoteDomainRecord before __slots__: lowercased dict copy into __dict__
+    """
+    def __init__(self, domain_record_info):
+        self.domainname = None
+        self.recordid = None
+        self.rr = None
+        self.type = None
+        self.value = None
+        self.ttl = None
+        self.priority = None
+        self.line = None
+        self.status = None
+        self.locked = False
+
+        converted_domain_record_info = dict(zip(map(str.lower, domain_record_info.keys()),
+                                                domain_record_info.values()))
+        for k in converted_domain_record_info.keys():
+            self.__dict__[k] = converted_domain_record_info[k]
+
+
+class LegacyLocalDomainRecord(object): # pylint: disable=too-few-public-methods
+    """
+    LocalDomainRecord before __slots__, same fields in __dict__
+    """
+    def __init__(self, local_record):
+        for name in ('alias', 'domainname', 'rr', 'type', 'interface', 'recordid',
+                     'update_priority', 'ttl', 'line', 'priority'):
+            setattr(self, name, getattr(local_record, name))
+        self.subdomain = local_record.rr
+
+
+def legacy_find_local_record(local_record_list, remote_record):
+    """
+    DDNSDomainRecordManager.find_local_record() before the index
+    """
+    for local_record in local_record_list:
+        if all(getattr(local_record, attr) == getattr(remote_record, attr)
+               for attr in ('domainname', 'rr', 'type')):
+            return local_record
+    return None
+
+
+def write_config(path, size, zones):
+    lines = ["[DEFAULT]", "access_id=benchmark", "access_key=benchmark", "debug=false",
+             "interface=eth0", ""]
+    for i in range(size):
+        lines.extend(["[record{0}]".format(i),
+                      "domain=zone{0}.example".format(i % zones),
+                      "sub_domain=host{0}".format(i),
+                      ""])
+    with open(path, "w") as conf_file:
+        conf_file.write("\n".join(lines))
+
+
+def get_remote_infos(size, zones):
+    return [{"DomainName": "zone{0}.example".format(i % zones), "RecordId": str(1000000 + i),
+             "RR": "host{0}".format(i), "Type": "A", "Value": "192.0.2.1", "TTL": 600,
+             "Line": "default", "Status": "ENABLE", "Locked": False, "Weight": 1}
+            for i in range(size)]
+
+
+def timed(func):
+    """
+    Run func, return (result, seconds)
+    """
+    gc.collect()
+    start_time = time.time()
+    result = func()
+    return result, time.time() - start_time
+
+
+def traced(func):
+    """
+    Run func under tracemalloc, return bytes allocated and still alive
+    """
+    gc.collect()
+    tracemalloc.start()
+    result = func()
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return current
+
+
+def report(size, name, seconds=None, memory=None):
+    print("{0:>7} {1:<40} {2:>12} {3:>8}".format(
+        size, name,
+        "-" if seconds is None else "{0:.1f}".format(seconds * 1000),
+        "-" if memory is None else "{0:.1f}".format(memory / 1024.0 / 1024.0)))
+
+
+def bench_size(size, zones, sample, workdir):
+    conf_path = os.path.join(workdir, "ddns-{0}.conf".format(size))
+    write_config(conf_path, size, zones)
+    config, seconds = timed(lambda: DDNSConfig(conf_path))
+    report(size, "parse config", seconds)
+
+    manager, seconds = timed(lambda: DDNSDomainRecordManager(config))
+    report(size, "DDNSDomainRecordManager()", seconds)
+    local_records = manager.local_record_list
+
+    # memory of records alone, copied from already parsed values
+    memory = traced(lambda: [LegacyLocalDomainRecord(rec) for rec in local_records])
+    report(size, "local records, legacy", memory=memory)
+    memory = traced(lambda: [copy_slots(rec) for rec in local_records])
+    report(size, "local records, __slots__", memory=memory)
+
+    infos = get_remote_infos(size, zones)
+    _, seconds = timed(lambda: [LegacyRemoteDomainRecord(info) for info in infos])
+    memory = traced(lambda: [LegacyRemoteDomainRecord(info) for info in infos])
+    report(size, "remote records, legacy", seconds, memory)
+    to_remote_record = AliyunProvider.to_remote_record
+    remote_records, seconds = timed(lambda: [to_remote_record(info) for info in infos])
+    memory = traced(lambda: [to_remote_record(info) for info in infos])
+    report(size, "remote records, __slots__", seconds, memory)
+
+    zone_records = {}
+    for remote_record in remote_records:
+        zone_records.setdefault(remote_record.domainname, []).append(remote_record)
+
+    def index():
+        for domainname, records in zone_records.items():
+            manager.set_zone_records(domainname, records)
+    _, seconds = timed(index)
+    report(size, "index remote records", seconds)
+
+    def match():
+        for remote_record in remote_records:
+            manager.find_local_record(remote_record)
+        for local_record in local_records:
+            manager.find_remote_record(local_record)
+    _, seconds = timed(match)
+    report(size, "match all records, indexed", seconds)
+
+    # linear matching is O(N*M), time a sample of lookups and extrapolate
+    step = max(1, size // sample)
+    sampled = remote_records[::step]
+    _, seconds = timed(lambda: [legacy_find_local_record(local_records, rec)
+                                for rec in sampled])
+    report(size, "match all records, legacy (extrapolated)", seconds * size / len(sampled))
+
+
+def copy_slots(local_record):
+    """
+    Copy a slotted LocalDomainRecord without reading config again
+    """
+    record_type = type(local_record)
+    new_record = record_type.__new__(record_type)
+    for name in record_type.__slots__:
+        setattr(new_record, name, getattr(local_record, name))
+    return new_record
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark record models and indexes")
+    parser.add_argument("--sizes", default="10000,100000",
+                        help="comma separated numbers of DomainRecords")
+    parser.add_argument("--zones", type=int, default=100)
+    parser.add_argument("--sample", type=int, default=200,
+                        help="lookups timed for legacy linear matching")
+    args = parser.parse_args()
+
+    print("{0:>7} {1:<40} {2:>12} {3:>8}".format("records", "step", "ms", "MiB"))
+    workdir = tempfile.mkdtemp(prefix="ddns-bench-")
+    try:
+        for size in [int(s) for s in args.sizes.split(",") if s.strip()]:
+            bench_size(size, args.zones, args.sample, workdir)
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == "__main__":
+    main()
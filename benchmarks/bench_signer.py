@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+Micro-benchmark of AliyunSigner against the signing code YunResolver used
+before, run from the repository root:
+
+    python benchmarks/bench_signer.py [number]
+"""
+from __future__ import print_function
+import os
+import sys
+import timeit
+import hmac
+import hashlib
+import uuid
+from datetime import datetime
+if sys.version_info < (3,):
+    from urllib import urlencode, quote_plus
+else:
+    from urllib.parse import urlencode, quote_plus
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from signer import AliyunSigner # pylint: disable=wrong-import-position
+
+ACCESS_ID = "testid"
+ACCESS_KEY = "testsecret"
+
+
+def legacy_get_common_params(access_id):
+    """
+    YunResolver.get_common_params() before AliyunSigner
+    """
+    return {
+        'Format': 'json',
+        'Version': '2015-01-09',
+        'AccessKeyId': access_id,
+        'Timestamp': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'SignatureMethod': 'HMAC-SHA1',
+        'SignatureNonce': uuid.uuid4(),
+        'SignatureVersion': "1.0",
+    }
+
+
+def legacy_get_signature(hash_key, http_method, params, common_params):
+    """
+    YunResolver.get_signature() before AliyunSigner
+    """
+    def sha1_hmac(key, str_to_sign):
+        from base64 import b64encode
+        if sys.version_info < (3,):
+            return b64encode(hmac.new(key, str_to_sign, hashlib.sha1).digest())
+        key = bytes(key, 'utf-8')
+        str_to_sign = bytes(str_to_sign, 'utf-8')
+        byte_hash_value = hmac.new(key, str_to_sign, hashlib.sha1).digest()
+        return str(b64encode(byte_hash_value), 'utf8').strip('\n')
+
+    params.update(common_params)
+    sorted_params = sorted(params.items())
+    canon_str = urlencode(sorted_params)
+    sign_str = http_method + "&" + quote_plus("/") + "&" + quote_plus(canon_str)
+    return sha1_hmac(hash_key, sign_str)
+
+
+def get_request_params():
+    """
+    Params of a typical UpdateDomainRecord call
+    """
+    return {
+        'Action': 'UpdateDomainRecord',
+        'RecordId': '1234567890123456',
+        'RR': 'www',
+        'Type': 'A',
+        'Value': '203.0.113.7',
+        'TTL': 600,
+        'Line': 'default',
+    }
+
+
+def check_compatible():
+    """
+    Both implementations must produce the same signature for the same request
+    """
+    signer = AliyunSigner(ACCESS_ID, ACCESS_KEY)
+    unsafe_params = dict(get_request_params(), Type='AAAA', RR='*.home',
+                         Value='2001:db8::7', ValueKeyWord='a b&c=d/~')
+    for request_params in (get_request_params(), unsafe_params):
+        params = dict(request_params)
+        signature = signer.get_signature('GET', params)
+
+        common_params = dict((key, params[key]) for key in
+                             ('Format', 'Version', 'AccessKeyId', 'Timestamp',
+                              'SignatureMethod', 'SignatureNonce', 'SignatureVersion'))
+        expected = legacy_get_signature(ACCESS_KEY + '&', 'GET', dict(request_params),
+                                        common_params)
+        if signature != expected:
+            sys.exit("Signature mismatch: {0} != {1}".format(signature, expected))
+
+
+def main():
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    check_compatible()
+
+    signer = AliyunSigner(ACCESS_ID, ACCESS_KEY)
+    hash_key = ACCESS_KEY + '&'
+    legacy = timeit.timeit(
+        lambda: legacy_get_signature(hash_key, 'GET', get_request_params(),
+                                     legacy_get_common_params(ACCESS_ID)),
+        number=number)
+    current = timeit.timeit(lambda: signer.get_signature('GET', get_request_params()),
+                            number=number)
+    batch = [get_request_params() for _ in range(number)]
+    bulk = timeit.timeit(lambda: signer.sign_many('GET', batch), number=1)
+
+    print("{0:<12} {1:>10}".format("signer", "us/call"))
+    for name, seconds in (("legacy", legacy), ("AliyunSigner", current), ("sign_many", bulk)):
+        print("{0:<12} {1:>10.2f}".format(name, seconds * 1e6 / number))
+    print("speedup      {0:>9.2f}x".format(legacy / current))
+
+
+if __name__ == '__main__':
+    main()
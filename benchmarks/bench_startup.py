@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+Startup benchmark of the one-shot client. It reports "python -X importtime"
+measurements of importing ddns, then runs "ddns.py" as a fresh process
+against the local mock Aliyun API and DNS servers with all DomainRecords
+already up to date, which is what most timer triggered runs see. Run from
+the repository root:
+
+    python benchmarks/bench_startup.py --runs 20
+"""
+from __future__ import print_function
+import argparse
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.abspath(os.path.join(BENCH_DIR, os.pardir))
+sys.path.insert(0, BENCH_DIR)
+
+from mock_aliyun import ZoneStore, seed_zones, start_servers # pylint: disable=wrong-import-position
+
+PUBLIC_IP = "203.0.113.7"
+# modules a run finding nothing to change should never import
+HEAVY_MODULES = ("requests", "urllib3", "aiohttp", "http.server")
+
+
+def parse_importtime(stderr):
+    """
+    Parse "-X importtime" output
+
+    :return: list of (module, depth, self us, cumulative us) in output order,
+             where a module comes after all modules it imported
+    """
+    modules = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip())) // 2
+        modules.append((name.strip(), depth, int(self_us), int(cumulative_us)))
+    return modules
+
+
+def get_children(modules, parent):
+    """
+    Get modules imported directly by a top level module
+
+    :return: list of (module, cumulative us)
+    """
+    names = [module[0] for module in modules]
+    if parent not in names:
+        return []
+    end = names.index(parent)
+    start = end
+    while start > 0 and modules[start - 1][1] > 0:
+        start -= 1
+    return [(name, cumulative_us) for name, depth, _, cumulative_us in modules[start:end]
+            if depth == 1]
+
+
+def run_importtime(python, code, runs):
+    """
+    Import in fresh interpreters
+
+    :return: list of parse_importtime() results, one per run
+    """
+    results = []
+    for _ in range(runs):
+        proc = subprocess.Popen([python, "-X", "importtime", "-c", code], cwd=ROOT_DIR,
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                universal_newlines=True)
+        _, stderr = proc.communicate()
+        results.append(parse_importtime(stderr))
+    return results
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2] if values else 0
+
+
+def write_config(path, records, api_server, dns_server, state_file):
+    lines = [
+        "[DEFAULT]",
+        "access_id=benchmark",
+        "access_key=benchmark",
+        "debug=false",
+        "api_url={0}".format(api_server.url),
+        "nameservers=127.0.0.1",
+        "dns_port={0}".format(dns_server.port),
+        "",
+        "[feature_public_ip_providers]",
+        "providers={0}ip".format(api_server.url),
+        "",
+    ]
+    if state_file:
+        lines.insert(5, "state_file={0}".format(state_file))
+    for i, (domainname, rr) in enumerate(records):
+        lines.extend(["[record{0}]".format(i),
+                      "domain={0}".format(domainname),
+                      "sub_domain={0}".format(rr),
+                      ""])
+    with open(path, "w") as conf_file:
+        conf_file.write("\n".join(lines))
+
+
+def run_client(python, conf_path, runs):
+    """
+    Run ddns.py runs times
+
+    :return: tuple of (list of wall seconds, list of cpu seconds)
+    """
+    walls = []
+    cpus = []
+    with open(os.devnull, "w") as devnull:
+        for _ in range(runs):
+            usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+            start_time = time.time()
+            subprocess.check_call([python, "ddns.py", "-c", conf_path], cwd=ROOT_DIR,
+                                  stdout=devnull, stderr=devnull)
+            walls.append(time.time() - start_time)
+            new_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+            cpus.append(new_usage.ru_utime - usage.ru_utime + new_usage.ru_stime - usage.ru_stime)
+    return walls, cpus
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark startup of the one-shot client")
+    parser.add_argument("--python", default=sys.executable, help="interpreter to benchmark")
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--records", type=int, default=10)
+    parser.add_argument("--top", type=int, default=10, help="slowest modules to show")
+    args = parser.parse_args()
+
+    # import ddns
+    results = run_importtime(args.python, "import ddns", args.runs)
+    ddns_us = median([cumulative_us for result in results
+                      for name, depth, _, cumulative_us in result
+                      if name == "ddns" and depth == 0])
+    print("import ddns: {0:.1f} ms cumulative (median of {1})".format(ddns_us / 1000.0,
+                                                                    args.runs))
+    print("slowest modules imported by ddns:")
+    children = sorted(get_children(results[-1], "ddns"), key=lambda child: -child[1])
+    for name, cumulative_us in children[:args.top]:
+        print("  {0:<30} {1:>8.1f} ms".format(name, cumulative_us / 1000.0))
+
+    # one-shot runs finding nothing to change
+    store = ZoneStore()
+    records = seed_zones(store, args.records, value=PUBLIC_IP)
+    api_server, dns_server = start_servers(store, public_ip=PUBLIC_IP)
+    workdir = tempfile.mkdtemp(prefix="ddns-bench-")
+    try:
+        for label, state_file in (("dns check", None),
+                                  ("state cache", os.path.join(workdir, "ddns.state"))):
+            conf_path = os.path.join(workdir, "ddns.conf")
+            write_config(conf_path, records, api_server, dns_server, state_file)
+            # first run fills the state cache
+            run_client(args.python, conf_path, 1)
+            walls, cpus = run_client(args.python, conf_path, args.runs)
+            print("no-change run, {0:<12} wall {1:>7.1f} ms  cpu {2:>7.1f} ms".format(
+                label, median(walls) * 1000, median(cpus) * 1000))
+
+        # heavy modules imported by a no-change run
+        code = "import sys; sys.argv = ['ddns.py', '-c', {0!r}]; " \
+               "import runpy; runpy.run_path('ddns.py', run_name='__main__')".format(conf_path)
+        imported = set(module[0] for module in run_importtime(args.python, code, 1)[0])
+        heavy = [name for name in HEAVY_MODULES if name in imported]
+        print("heavy modules imported by no-change run: {0}".format(", ".join(heavy) or "none"))
+        print("API calls: {0}".format(api_server.get_stats()))
+    finally:
+        api_server.shutdown()
+        api_server.server_close()
+        shutil.rmtree(workdir)
+
+
+if __name__ == "__main__":
+    main()
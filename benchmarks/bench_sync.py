@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+End-to-end sync benchmark against the local mock Aliyun API and DNS servers.
+For every size a synthetic config is generated and ddns.main() is run in a
+fresh process for a few cycles: the first one updates all records, the
+following ones find nothing to change. Run from the repository root:
+
+    python benchmarks/bench_sync.py --sizes 10,100,1000,10000 --latency 0.01
+"""
+from __future__ import print_function
+import argparse
+import multiprocessing
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, os.pardir))
+sys.path.insert(0, BENCH_DIR)
+
+from mock_aliyun import ZoneStore, seed_zones, start_servers # pylint: disable=wrong-import-position
+
+STALE_IP = "192.0.2.1"
+PUBLIC_IP = "203.0.113.7"
+
+
+def write_config(path, records, api_server, dns_server, args):
+    """
+    Write synthetic ddns.conf pointing to the mock servers
+    """
+    lines = [
+        "[DEFAULT]",
+        "access_id=benchmark",
+        "access_key=benchmark",
+        "debug=false",
+        "api_url={0}".format(api_server.url),
+        "nameservers=127.0.0.1",
+        "dns_port={0}".format(dns_server.port),
+        "api_qps={0}".format(args.api_qps),
+        "max_workers={0}".format(args.max_workers),
+        "max_workers_per_zone={0}".format(args.max_workers_per_zone),
+        "",
+        "[feature_public_ip_providers]",
+        "providers={0}ip".format(api_server.url),
+        "",
+    ]
+    for i, (domainname, rr) in enumerate(records):
+        lines.extend(["[record{0}]".format(i),
+                      "domain={0}".format(domainname),
+                      "sub_domain={0}".format(rr),
+                      "type=A",
+                      ""])
+    with open(path, "w") as conf_file:
+        conf_file.write("\n".join(lines))
+
+
+def percentile(values, fraction):
+    """
+    Get percentile of values by nearest rank
+    """
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[int(round(fraction * (len(values) - 1)))]
+
+
+def run_client(conf_path, cycles, verbose, results):
+    """
+    Child process: run ddns.main() for cycles and put timings into results
+    """
+    if not verbose:
+        devnull = open(os.devnull, "w")
+        sys.stdout = sys.stderr = devnull
+
+    import ddns
+    from config import DDNSConfig
+    from reconciler import DDNSReconciler
+    from scheduler import UpdateScheduler
+
+    # seconds spent on each record, in reconciling and in updating
+    record_seconds = {}
+
+    def timed(func, get_record):
+        def wrapper(self, *args, **kwargs):
+            start_time = time.time()
+            try:
+                return func(self, *args, **kwargs)
+            finally:
+                key = get_record(*args).alias
+                record_seconds[key] = record_seconds.get(key, 0.0) + time.time() - start_time
+        return wrapper
+
+    DDNSReconciler.safe_reconcile_record = timed(DDNSReconciler.safe_reconcile_record,
+                                                 lambda local_record, *_: local_record)
+    UpdateScheduler.execute = timed(UpdateScheduler.execute, lambda job: job.local_record)
+
+    config = DDNSConfig(conf_path)
+    for _ in range(cycles):
+        record_seconds.clear()
+        start_time = time.time()
+        ddns.main(config)
+        wall_time = time.time() - start_time
+        latencies = list(record_seconds.values())
+        results.put({"wall": wall_time,
+                     "p50": percentile(latencies, 0.5),
+                     "p99": percentile(latencies, 0.99),
+                     # KiB on Linux
+                     "rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss})
+
+
+def bench_size(size, args, workdir):
+    """
+    Benchmark one config size
+
+    :return: list of result dicts, one per cycle
+    """
+    store = ZoneStore()
+    records = seed_zones(store, size, args.zones, value=STALE_IP)
+    api_server, dns_server = start_servers(store, public_ip=PUBLIC_IP,
+                                           latency=args.latency,
+                                           error_rate=args.error_rate,
+                                           throttle_rate=args.throttle_rate,
+                                           seed=size)
+    conf_path = os.path.join(workdir, "ddns-{0}.conf".format(size))
+    write_config(conf_path, records, api_server, dns_server, args)
+
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    client = context.Process(target=run_client,
+                             args=(conf_path, args.cycles, args.verbose, results))
+    client.start()
+
+    cycles = []
+    previous_calls = {}
+    for _ in range(args.cycles):
+        result = results.get()
+        calls = api_server.get_stats()
+        result["calls"] = dict((key, value - previous_calls.get(key, 0))
+                               for key, value in calls.items())
+        previous_calls = calls
+        cycles.append(result)
+    client.join()
+    api_server.shutdown()
+    api_server.server_close()
+    return cycles
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark syncing against mock Aliyun API")
+    parser.add_argument("--sizes", default="10,100,1000,10000",
+                        help="comma separated numbers of DomainRecords")
+    parser.add_argument("--zones", type=int, default=10)
+    parser.add_argument("--cycles", type=int, default=2)
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="seconds added to every API call")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--throttle-rate", type=float, default=0.0)
+    parser.add_argument("--api-qps", type=float, default=1000)
+    parser.add_argument("--max-workers", type=int, default=4)
+    parser.add_argument("--max-workers-per-zone", type=int, default=2)
+    parser.add_argument("--verbose", action="store_true", help="show client output")
+    args = parser.parse_args()
+
+    print("{0:>7} {1:>5} {2:>9} {3:>9} {4:>9} {5:>9}  {6}".format(
+        "records", "cycle", "wall(s)", "p50(ms)", "p99(ms)", "rss(MiB)", "API calls"))
+    workdir = tempfile.mkdtemp(prefix="ddns-bench-")
+    try:
+        for size in [int(s) for s in args.sizes.split(",") if s.strip()]:
+            for cycle, result in enumerate(bench_size(size, args, workdir), 1):
+                calls = ", ".join("{0}={1}".format(key, value)
+                                  for key, value in sorted(result["calls"].items()) if value)
+                print("{0:>7} {1:>5} {2:>9.3f} {3:>9.2f} {4:>9.2f} {5:>9.1f}  {6}".format(
+                    size, cycle, result["wall"], result["p50"] * 1000, result["p99"] * 1000,
+                    result["rss"] / 1024.0, calls or "-"))
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == "__main__":
+    main()
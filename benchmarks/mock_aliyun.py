@@ -0,0 +1,404 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+Local stand-in for the Aliyun DNS API, serving DescribeDomainRecords,
+DescribeDomainRecordInfo and UpdateDomainRecord from an in-memory zone store,
+plus "/ip" echoing the public IP and an authoritative UDP/TCP DNS server
+answering A/AAAA queries from the same store. Latency, error rate and
+throttling rate are configurable.
+
+Run standalone from the repository root:
+
+    python benchmarks/mock_aliyun.py --records 1000 --latency 0.02
+"""
+from __future__ import print_function
+import argparse
+import json
+import random
+import socket
+import struct
+import sys
+import threading
+import time
+if sys.version_info < (3,):
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+else:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+
+QTYPE_A = 1
+QTYPE_AAAA = 28
+MAX_PAGE_SIZE = 500
+
+
+class ZoneStore(object):
+    """
+    In-memory DomainRecords of all zones
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        # RecordId -> record dict as returned by Aliyun
+        self.records = {}
+        # domainname -> list of RecordId in creation order
+        self.zones = {}
+        # (hostname, type) -> RecordId, for DNS answers
+        self.names = {}
+        self.next_id = 1000000
+
+    def add(self, domainname, rr, record_type="A", value="192.0.2.1", ttl=600, line="default"):
+        """
+        Add one DomainRecord
+
+        :return: RecordId
+        """
+        with self.lock:
+            self.next_id += 1
+            recordid = str(self.next_id)
+            self.records[recordid] = {
+                "DomainName": domainname, "RecordId": recordid, "RR": rr,
+                "Type": record_type, "Value": value, "TTL": ttl, "Line": line,
+                "Status": "ENABLE", "Locked": False,
+            }
+            self.zones.setdefault(domainname, []).append(recordid)
+            self.names[(self.get_hostname(rr, domainname), record_type)] = recordid
+            return recordid
+
+    @staticmethod
+    def get_hostname(rr, domainname):
+        """
+        Get full hostname of a DomainRecord
+        """
+        if rr == "@":
+            return domainname
+        return "{0}.{1}".format(rr, domainname)
+
+    def search(self, domainname, rr_keyword="", type_keyword="", value_keyword=""):
+        """
+        Fuzzy search records of a zone like DescribeDomainRecords does
+
+        :return: list of record dicts
+        """
+        with self.lock:
+            return [dict(self.records[rid]) for rid in self.zones.get(domainname, [])
+                    if rr_keyword in self.records[rid]["RR"]
+                    and type_keyword in self.records[rid]["Type"]
+                    and value_keyword in self.records[rid]["Value"]]
+
+    def get(self, recordid):
+        """
+        Get record dict by RecordId or None
+        """
+        with self.lock:
+            record = self.records.get(recordid)
+            return dict(record) if record else None
+
+    def update(self, recordid, params):
+        """
+        Update record from UpdateDomainRecord params
+
+        :return: error code or None
+        """
+        with self.lock:
+            record = self.records.get(recordid)
+            if record is None:
+                return "DomainRecordNotBelongToUser"
+
+            changes = {"RR": params.get("RR", record["RR"]),
+                       "Type": params.get("Type", record["Type"]),
+                       "Value": params.get("Value", record["Value"]),
+                       # Aliyun resets TTL and line to defaults if not given
+                       "TTL": int(params.get("TTL", 600)),
+                       "Line": params.get("Line", "default")}
+            if all(record[key] == value for key, value in changes.items()):
+                return "DomainRecordDuplicate"
+
+            del self.names[(self.get_hostname(record["RR"], record["DomainName"]),
+                            record["Type"])]
+            record.update(changes)
+            self.names[(self.get_hostname(record["RR"], record["DomainName"]),
+                        record["Type"])] = recordid
+            return None
+
+    def resolve(self, hostname, record_type):
+        """
+        Get record value for DNS answers
+
+        :return: value or None
+        """
+        hostname = hostname.lower()
+        with self.lock:
+            recordid = self.names.get((hostname, record_type))
+            # names without own records are answered by the closest wildcard
+            labels = hostname.split(".")
+            for i in range(1, len(labels) - 1):
+                if recordid:
+                    break
+                recordid = self.names.get(("*." + ".".join(labels[i:]), record_type))
+            return self.records[recordid]["Value"] if recordid else None
+
+
+class MockAliyunServer(ThreadingMixIn, HTTPServer):
+    """
+    Threaded HTTP server speaking a subset of the Aliyun DNS API
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, store, address=("127.0.0.1", 0), public_ip="203.0.113.7",
+                 latency=0.0, error_rate=0.0, throttle_rate=0.0, seed=None):
+        """
+        :param store:         ZoneStore
+        :param public_ip:     IP returned by "/ip"
+        :param latency:       seconds added to every API call
+        :param error_rate:    fraction of API calls failing with InternalError
+        :param throttle_rate: fraction of API calls rejected with Throttling.User
+        """
+        HTTPServer.__init__(self, address, MockAliyunHandler)
+        self.store = store
+        self.public_ip = public_ip
+        self.latency = latency
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    @property
+    def url(self):
+        """
+        API url to put in config
+        """
+        return "http://{0}:{1}/".format(*self.server_address[:2])
+
+    def count(self, name):
+        """
+        Count one API call or error
+        """
+        with self.lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+
+    def get_stats(self):
+        """
+        Get a copy of call counters
+        """
+        with self.lock:
+            return dict(self.calls)
+
+    def roll(self, rate):
+        """
+        Whether a random event of the rate happens
+        """
+        with self.lock:
+            return rate > 0 and self.random.random() < rate
+
+
+class MockAliyunHandler(BaseHTTPRequestHandler):
+    """
+    Request handler of MockAliyunServer
+    """
+    protocol_version = "HTTP/1.1"
+    # headers and body are written separately, don't let Nagle delay the body
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args): # pylint: disable=redefined-builtin
+        pass
+
+    def do_GET(self): # pylint: disable=invalid-name
+        url = urlparse(self.path)
+        if url.path == "/ip":
+            return self.send_text(200, self.server.public_ip)
+        if url.path == "/stats":
+            return self.send_json(200, self.server.get_stats())
+
+        params = dict((key, values[0]) for key, values in parse_qs(url.query).items())
+        action = params.get("Action", "")
+        self.server.count(action)
+
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if self.server.roll(self.server.throttle_rate):
+            self.server.count("Throttling")
+            return self.send_error_code(400, "Throttling.User")
+        if self.server.roll(self.server.error_rate):
+            self.server.count("InternalError")
+            return self.send_error_code(500, "InternalError")
+
+        handler = getattr(self, "handle_" + action, None)
+        if handler is None:
+            return self.send_error_code(400, "InvalidAction.NotFound")
+        return handler(params)
+
+    def handle_DescribeDomainRecords(self, params): # pylint: disable=invalid-name
+        records = self.server.store.search(params.get("DomainName", ""),
+                                           params.get("RRKeyWord", ""),
+                                           params.get("TypeKeyWord", ""),
+                                           params.get("ValueKeyWord", ""))
+        page_number = int(params.get("PageNumber", 1))
+        page_size = min(int(params.get("PageSize", 20)), MAX_PAGE_SIZE)
+        start = (page_number - 1) * page_size
+        self.send_json(200, {
+            "RequestId": "mock",
+            "TotalCount": len(records),
+            "PageNumber": page_number,
+            "PageSize": page_size,
+            "DomainRecords": {"Record": records[start:start + page_size]},
+        })
+
+    def handle_DescribeDomainRecordInfo(self, params): # pylint: disable=invalid-name
+        record = self.server.store.get(params.get("RecordId"))
+        if record is None:
+            return self.send_error_code(400, "DomainRecordNotBelongToUser")
+        record["RequestId"] = "mock"
+        self.send_json(200, record)
+
+    def handle_UpdateDomainRecord(self, params): # pylint: disable=invalid-name
+        error = self.server.store.update(params.get("RecordId"), params)
+        if error:
+            return self.send_error_code(400, error)
+        self.send_json(200, {"RequestId": "mock", "RecordId": params.get("RecordId")})
+
+    def send_error_code(self, status, code):
+        self.send_json(status, {"RequestId": "mock", "Code": code, "Message": code})
+
+    def send_json(self, status, body):
+        self.send_text(status, json.dumps(body), "application/json")
+
+    def send_text(self, status, text, content_type="text/plain"):
+        data = text.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class MockDNSServer(object):
+    """
+    Authoritative DNS server answering A/AAAA queries from ZoneStore over
+    UDP and TCP on the same port
+    """
+    def __init__(self, store, host="127.0.0.1", port=0):
+        self.store = store
+        self.udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.udp.bind((host, port))
+        self.port = self.udp.getsockname()[1]
+        self.tcp = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.tcp.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.tcp.bind((host, self.port))
+        self.tcp.listen(16)
+
+    def start(self):
+        for target in (self.serve_udp, self.serve_tcp):
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+
+    def serve_udp(self):
+        while True:
+            data, address = self.udp.recvfrom(4096)
+            try:
+                self.udp.sendto(self.answer(data), address)
+            except (ValueError, struct.error):
+                pass
+
+    def serve_tcp(self):
+        while True:
+            conn, _ = self.tcp.accept()
+            try:
+                size = struct.unpack("!H", conn.recv(2))[0]
+                response = self.answer(conn.recv(size))
+                conn.sendall(struct.pack("!H", len(response)) + response)
+            except (ValueError, struct.error, socket.error):
+                pass
+            finally:
+                conn.close()
+
+    def answer(self, data):
+        """
+        Build response of one query
+        """
+        qid = struct.unpack_from("!H", data, 0)[0]
+        offset = 12
+        labels = []
+        while data[offset:offset + 1] != b"\x00":
+            length = ord(data[offset:offset + 1])
+            labels.append(data[offset + 1:offset + 1 + length].decode("ascii"))
+            offset += 1 + length
+        qtype = struct.unpack_from("!H", data, offset + 1)[0]
+        question = data[12:offset + 5]
+        hostname = ".".join(labels)
+
+        record_type = {QTYPE_A: "A", QTYPE_AAAA: "AAAA"}.get(qtype)
+        value = self.store.resolve(hostname, record_type) if record_type else None
+        answers = b""
+        if value:
+            family = socket.AF_INET if qtype == QTYPE_A else socket.AF_INET6
+            rdata = socket.inet_pton(family, value)
+            # name is a pointer to the question
+            answers = b"\xc0\x0c" + struct.pack("!HHIH", qtype, 1, 60, len(rdata)) + rdata
+        # QR, AA and NXDOMAIN if no answer
+        flags = 0x8400 | (0 if value else 3)
+        return struct.pack("!HHHHHH", qid, flags, 1, 1 if value else 0, 0, 0) + question + answers
+
+
+def seed_zones(store, records, zones=10, value="192.0.2.1"):
+    """
+    Create synthetic DomainRecords spread over zones
+
+    :return: list of (domainname, rr)
+    """
+    created = []
+    for i in range(records):
+        domainname = "zone{0}.example".format(i % zones)
+        rr = "host{0}".format(i)
+        store.add(domainname, rr, value=value)
+        created.append((domainname, rr))
+    return created
+
+
+def start_servers(store, **kwargs):
+    """
+    Start MockAliyunServer and MockDNSServer in background threads
+
+    :return: tuple of (MockAliyunServer, MockDNSServer)
+    """
+    api_server = MockAliyunServer(store, **kwargs)
+    thread = threading.Thread(target=api_server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    dns_server = MockDNSServer(store)
+    dns_server.start()
+    return api_server, dns_server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mock Aliyun DNS API server")
+    parser.add_argument("--port", type=int, default=8053)
+    parser.add_argument("--records", type=int, default=100)
+    parser.add_argument("--zones", type=int, default=10)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--throttle-rate", type=float, default=0.0)
+    args = parser.parse_args()
+
+    store = ZoneStore()
+    seed_zones(store, args.records, args.zones)
+    api_server, dns_server = start_servers(store, address=("127.0.0.1", args.port),
+                                           latency=args.latency,
+                                           error_rate=args.error_rate,
+                                           throttle_rate=args.throttle_rate)
+    print("API {0}, DNS 127.0.0.1:{1}, {2} records".format(api_server.url, dns_server.port,
+                                                           args.records))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
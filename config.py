@@ -17,40 +17,179 @@
  along with this program; if not, write to the Free Software
  Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
 """
-from __future__ import print_function
+import re
 import sys
 if sys.version_info < (3,):
     import ConfigParser
 else:
     import configparser as ConfigParser
 
-from utils import DDNSUtils
+from utils import DDNSUtils, LOG_FORMATS
+from yunresolver import DEFAULT_API_URL
 
 CONF_FILE = "ddns.conf"
 # Compaitible consideration for v0.1
 SYS_CONF_FILE = "/etc/ddns.conf"
+# account of DomainRecords not telling one, credentials are in DEFAULT section
+DEFAULT_ACCOUNT = "default"
+ACCOUNT_SECTION_PREFIX = "account_"
+# DNS provider of accounts not telling one
+ALIYUN_PROVIDER = "aliyun"
+# options making a section a record set expanded into many DomainRecords
+RECORD_SET_OPTIONS = ("domains", "sub_domains", "types")
+BRACE_PATTERN = re.compile(r"\{([^{}]*)\}")
+RANGE_PATTERN = re.compile(r"^\s*(\d+)\.\.(\d+)\s*$")
+
+
+def split_list(value):
+    """
+    Split comma or newline separated list, commas inside braces are kept
+
+    :return: list of stripped non-empty items
+    """
+    items = []
+    depth = 0
+    start = 0
+    for i, char in enumerate(value):
+        if char == "{":
+            depth += 1
+        elif char == "}":
+            depth -= 1
+        elif char in ",\n" and depth == 0:
+            items.append(value[start:i].strip())
+            start = i + 1
+    items.append(value[start:].strip())
+    return [item for item in items if item]
+
+
+def expand_template(template):
+    """
+    Expand braces in template like a shell does, "{www,api}" gives both words
+    and "node{01..20}" gives node01 to node20
+
+    :param template: domain or subdomain template
+    :return: generator of names
+    """
+    match = BRACE_PATTERN.search(template)
+    if match is None:
+        yield template
+        return
+
+    prefix, suffix = template[:match.start()], template[match.end():]
+    range_match = RANGE_PATTERN.match(match.group(1))
+    if range_match:
+        first, last = range_match.groups()
+        # keep zero padding of the first number
+        width = len(first) if first.startswith("0") else 0
+        step = 1 if int(last) >= int(first) else -1
+        choices = [str(i).zfill(width) for i in range(int(first), int(last) + step, step)]
+    else:
+        choices = [choice.strip() for choice in match.group(1).split(",")]
+
+    for choice in choices:
+        for rest in expand_template(suffix):
+            yield prefix + choice + rest
+
+
+def is_aliyun_provider(spec):
+    """
+    Whether DNS provider spec stands for Aliyun, which needs credentials
+
+    :param spec: provider spec or None
+    :return: True or False
+    """
+    return (spec or ALIYUN_PROVIDER).strip() == ALIYUN_PROVIDER
+
+
+class DDNSAccount(object):# pylint: disable=too-few-public-methods
+    """
+    Account owning some zones on a DNS provider, each has its own provider
+    and API rate limit
+    """
+    def __init__(self, name, access_id, access_key, api_url=DEFAULT_API_URL,
+                 api_qps=10, api_burst=None, provider=None):
+        self.name = name
+        self.access_id = access_id
+        self.access_key = access_key
+        self.api_url = api_url
+        self.api_qps = api_qps
+        self.api_burst = api_burst
+        # DNS provider spec, see provider.create_dns_provider()
+        self.provider = provider
+
+    def get_credentials(self):
+        """
+        Get what a DNSProvider of the account is created with
+
+        :return: tuple of (provider, access_id, access_key, api_url)
+        """
+        return self.provider, self.access_id, self.access_key, self.api_url
+
 
 class DDNSConfig(object):
     """
     Aliyun DDNS client config class to read/save config stuff
     """
-    def __init__(self):
+    def __init__(self, conf_file=None):
+        """
+        :param conf_file: config file path, default is "ddns.conf" in current
+                          directory, then "/etc/ddns.conf"
+        """
+        self.conf_file = conf_file
         # default options
         self.debug = False
+        self.log_format = "text"
         self.interval = 600
+        self.interval_jitter = 30
         self.access_id = None
         self.access_key = None
+        self.api_url = DEFAULT_API_URL
+        self.provider = None
+        # http connection pool and retry policy talking to Aliyun
+        self.pool_size = 10
+        self.connect_timeout = 5
+        self.read_timeout = 10
+        self.max_retries = 3
+        self.retry_backoff = 0.5
+        # authoritative nameservers, discovered per domain if not set
+        self.nameservers = None
+        self.dns_timeout = 2.0
+        self.dns_port = 53
+        # local state cache, disabled if state_file is not set
+        self.state_file = None
+        self.state_refresh_interval = 3600
+        # UpdateDomainRecord pacing and retries on throttling
+        self.api_qps = 10
+        self.api_burst = None
+        self.update_max_retries = 5
+        self.update_retry_backoff = 1.0
+        # seconds after which a plan is too old to apply, 0 means no limit
+        self.plan_max_age = 3600
+        # concurrent reconciliation
+        self.max_workers = 4
+        self.max_workers_per_zone = 2
 
         self.parser = ConfigParser.ConfigParser()
-        if not self.parser.read(CONF_FILE):
+        if conf_file:
+            if not self.parser.read(conf_file):
+                DDNSUtils.err_and_exit("Failed to read config file {0}.".format(conf_file))
+        elif not self.parser.read(CONF_FILE):
             # Compaitible consideration for v0.1
             if not self.parser.read(SYS_CONF_FILE):
                 DDNSUtils.err_and_exit("Failed to read config file.")
 
+        # credentials in DEFAULT section are optional if accounts are defined
+        account_sections = self.get_account_sections()
+        # other DNS providers don't need credentials either
+        if self.parser.has_option("DEFAULT", "provider"):
+            self.provider = self.parser.get("DEFAULT", "provider") or None
+        aliyun = is_aliyun_provider(self.provider)
         try:
             self.debug = self.parser.getboolean("DEFAULT", "debug")
-            self.access_id = self.parser.get("DEFAULT", "access_id")
-            self.access_key = self.parser.get("DEFAULT", "access_key")
+            if aliyun and (not account_sections or
+                           self.parser.has_option("DEFAULT", "access_id")):
+                self.access_id = self.parser.get("DEFAULT", "access_id")
+                self.access_key = self.parser.get("DEFAULT", "access_key")
         except ValueError as ex:
             DDNSUtils.err_and_exit("Invalid debug in config: {0}".format(ex))
         except ConfigParser.NoSectionError as ex:
@@ -58,13 +197,84 @@ class DDNSConfig(object):
         except ConfigParser.NoOptionError as ex:
             DDNSUtils.err_and_exit("Invalid config: {0}".format(ex))
 
-        if not self.access_id or not self.access_key:
-            DDNSUtils.err_and_exit("Invalid access_id or access_key in config file.")
+        if aliyun and (not account_sections or self.access_id or self.access_key):
+            if not self.access_id or not self.access_key:
+                DDNSUtils.err_and_exit("Invalid access_id or access_key in config file.")
+
+        if self.parser.has_option("DEFAULT", "log_format"):
+            self.log_format = self.parser.get("DEFAULT", "log_format").lower()
+            if self.log_format not in LOG_FORMATS:
+                DDNSUtils.err_and_exit("Invalid log_format in config: " \
+                                       "it should be one of {0}".format(", ".join(LOG_FORMATS)))
+        if self.parser.has_option("DEFAULT", "api_url"):
+            self.api_url = self.parser.get("DEFAULT", "api_url") or DEFAULT_API_URL
+        self.interval = self.get_number_option("DEFAULT", "interval", self.interval)
+        self.interval_jitter = self.get_number_option("DEFAULT", "interval_jitter",
+                                                      self.interval_jitter)
+        self.pool_size = self.get_number_option("DEFAULT", "pool_size", self.pool_size, int)
+        self.connect_timeout = self.get_number_option("DEFAULT", "connect_timeout",
+                                                      self.connect_timeout)
+        self.read_timeout = self.get_number_option("DEFAULT", "read_timeout", self.read_timeout)
+        self.max_retries = self.get_number_option("DEFAULT", "max_retries",
+                                                  self.max_retries, int)
+        self.retry_backoff = self.get_number_option("DEFAULT", "retry_backoff",
+                                                    self.retry_backoff)
+        if self.parser.has_option("DEFAULT", "nameservers"):
+            self.nameservers = [ns.strip() for ns in
+                                self.parser.get("DEFAULT", "nameservers").split(",")
+                                if ns.strip()] or None
+        self.dns_timeout = self.get_number_option("DEFAULT", "dns_timeout", self.dns_timeout)
+        self.dns_port = self.get_number_option("DEFAULT", "dns_port", self.dns_port, int)
+        if self.parser.has_option("DEFAULT", "state_file"):
+            self.state_file = self.parser.get("DEFAULT", "state_file") or None
+        self.state_refresh_interval = self.get_number_option("DEFAULT", "state_refresh_interval",
+                                                             self.state_refresh_interval)
+        self.api_qps = self.get_number_option("DEFAULT", "api_qps", self.api_qps)
+        if self.api_qps <= 0:
+            DDNSUtils.err_and_exit("Invalid api_qps in config: should be positive")
+        self.api_burst = self.get_number_option("DEFAULT", "api_burst", self.api_burst, int)
+        self.update_max_retries = self.get_number_option("DEFAULT", "update_max_retries",
+                                                         self.update_max_retries, int)
+        self.update_retry_backoff = self.get_number_option("DEFAULT", "update_retry_backoff",
+                                                           self.update_retry_backoff)
+        self.plan_max_age = self.get_number_option("DEFAULT", "plan_max_age", self.plan_max_age)
+        self.max_workers = self.get_number_option("DEFAULT", "max_workers",
+                                                  self.max_workers, int)
+        self.max_workers_per_zone = self.get_number_option("DEFAULT", "max_workers_per_zone",
+                                                           self.max_workers_per_zone, int)
+
+        # account name -> DDNSAccount
+        self.accounts = {}
+        if self.access_id or not aliyun:
+            self.accounts[DEFAULT_ACCOUNT] = DDNSAccount(DEFAULT_ACCOUNT, self.access_id,
+                                                         self.access_key, self.api_url,
+                                                         self.api_qps, self.api_burst,
+                                                         self.provider)
+        for section in account_sections:
+            self.get_account_options(section)
         
         if self.parser.has_section("feature_public_ip_from_nic"):
             self.get_feature_public_ip_from_nic_options()
         else:
             self.pifn_enable = False
+
+        self.netlink_enable = False
+        self.netlink_debounce = 2.0
+        if self.parser.has_section("feature_netlink_watch"):
+            self.get_feature_netlink_watch_options()
+
+        self.public_ip_providers = None
+        self.public_ip_quorum = 1
+        self.public_ip_parallel = 2
+        self.public_ip_timeout = 5
+        self.public_ip_cache_ttl = 60
+        if self.parser.has_section("feature_public_ip_providers"):
+            self.get_feature_public_ip_providers_options()
+
+        self.metrics_listen = None
+        self.metrics_textfile = None
+        if self.parser.has_section("feature_metrics"):
+            self.get_feature_metrics_options()
         
 
     def get_domain_record_sections(self):
@@ -73,26 +283,107 @@ class DDNSConfig(object):
 
         :return: section list
         """
-        # filter out feature_sections
+        # filter out feature_sections and account sections
         sections = self.parser.sections()
-        return [ s for s in sections if not s.lower().startswith("feature_") ]
+        return [ s for s in sections if not s.lower().startswith("feature_")
+                 and not s.lower().startswith(ACCOUNT_SECTION_PREFIX) ]
+
+    def get_account_sections(self):
+        """
+        Get sections defining Aliyun accounts, like [account_shop]
+
+        :return: section list
+        """
+        return [s for s in self.parser.sections()
+                if s.lower().startswith(ACCOUNT_SECTION_PREFIX)]
 
-    def get_option_value(self, section, option, default=None):
+    def iter_domain_records(self, errors):
         """
-        Get specific option value from section, default is None
+        Walk through DomainRecord definitions, options of a section are read
+        at once. A record set section listing "domains", "sub_domains" or
+        "types" is expanded lazily into one definition per combination:
+
+            [web]
+            domains=example.com,example.org
+            sub_domains=www,api,node{01..20}
+            types=A,AAAA
+
+        :param errors: list collecting errors of record set sections
+        :return: generator of (alias, options dict)
+        """
+        for section in self.get_domain_record_sections():
+            try:
+                options = self.get_section_options(section)
+            except (ConfigParser.Error, ValueError) as ex:
+                errors.append("Invalid DomainRecord section {0}: {1}".format(section, ex))
+                continue
+
+            if not any(options.get(option) for option in RECORD_SET_OPTIONS):
+                yield section, options
+                continue
+
+            if options.get("record_id"):
+                errors.append("Invalid record set {0}: record_id can't be shared " \
+                              "by many DomainRecords".format(section))
+                continue
+
+            domains = split_list(options.get("domains") or options.get("domain") or "")
+            templates = split_list(options.get("sub_domains") or options.get("sub_domain") or "")
+            types = split_list(options.get("types") or options.get("type") or "A")
+            if not domains or not templates:
+                errors.append("Invalid record set {0}: " \
+                              "no domains or sub_domains given".format(section))
+                continue
+
+            unbalanced = [t for t in domains + templates if t.count("{") != t.count("}")]
+            if unbalanced:
+                errors.append("Invalid record set {0}: unbalanced braces in {1}".format(
+                    section, ", ".join(unbalanced)))
+                continue
+
+            domains = [domain for template in domains for domain in expand_template(template)]
+            for template in templates:
+                for rr in expand_template(template):
+                    for domain in domains:
+                        for record_type in types:
+                            record_options = dict(options, domain=domain,
+                                                  sub_domain=rr, type=record_type)
+                            yield "{0}:{1}.{2}:{3}".format(section, rr, domain,
+                                                           record_type), record_options
+
+    def get_section_options(self, section):
+        """
+        Get all options of section including defaults, values are only
+        interpolated if some of them refer to others
+
+        :param section: ini file section
+        :return: dict of option and value
+        """
+        options = dict(self.parser.items(section, raw=True))
+        if any("%" in value for value in options.values() if value):
+            options = dict(self.parser.items(section))
+        return options
+
+    def get_number_option(self, section, option, default, convert=float):
+        """
+        Get optional numeric option value from section, exit if it is invalid
 
         :param section: ini file section
-        :param option:  init file option
-        :param default: default value for option
+        :param option:  ini file option
+        :param default: default value if option is not set
+        :param convert: int or float
         :return: option value
         """
-        value = default
+        if not self.parser.has_option(section, option):
+            return default
+
         try:
-            value = self.parser.get(section, option)
-        except ConfigParser.NoSectionError:
-            print("No section: {0}".format(section))
-        except ConfigParser.NoOptionError:
-            print("No option {0} in section: {1}".format(option, section))
+            value = convert(self.parser.get(section, option))
+        except ValueError as ex:
+            DDNSUtils.err_and_exit("Invalid {0} in config: {1}".format(option, ex))
+
+        if value < 0:
+            DDNSUtils.err_and_exit("Invalid {0} in config: should not be negative".format(option))
 
         return value
 
@@ -117,3 +408,93 @@ class DDNSConfig(object):
 
             if self.pifn_interface == "":
                 DDNSUtils.err_and_exit("Empty interface")
+
+    def get_feature_netlink_watch_options(self):
+        """
+        Get options about watching interface address changes via netlink.
+        """
+        section_name = "feature_netlink_watch"
+        try:
+            self.netlink_enable = self.parser.getboolean(section_name, "enable")
+        except ValueError as ex:
+            DDNSUtils.err_and_exit("Invalid 'enable' value in feature netlink_watch config: {0}".format(ex))
+        except ConfigParser.NoOptionError:
+            self.netlink_enable = False
+
+        self.netlink_debounce = self.get_number_option(section_name, "debounce",
+                                                       self.netlink_debounce)
+
+    def get_feature_public_ip_providers_options(self):
+        """
+        Get options about the public IP providers.
+        """
+        section_name = "feature_public_ip_providers"
+        if self.parser.has_option(section_name, "providers"):
+            providers = self.parser.get(section_name, "providers").replace("\n", ",")
+            self.public_ip_providers = [p.strip() for p in providers.split(",") if p.strip()]
+            if not self.public_ip_providers:
+                DDNSUtils.err_and_exit("Empty providers in feature public_ip_providers config")
+
+            # a bad spec is reported here, before anything was set up with it
+            from publicip import create_provider
+            for spec in self.public_ip_providers:
+                try:
+                    create_provider(spec)
+                except ValueError as ex:
+                    DDNSUtils.err_and_exit("Invalid providers in feature public_ip_providers "
+                                           "config: {0}".format(ex))
+
+        self.public_ip_quorum = self.get_number_option(section_name, "quorum",
+                                                       self.public_ip_quorum, int)
+        self.public_ip_parallel = self.get_number_option(section_name, "parallel",
+                                                         self.public_ip_parallel, int)
+        self.public_ip_timeout = self.get_number_option(section_name, "timeout",
+                                                        self.public_ip_timeout)
+        self.public_ip_cache_ttl = self.get_number_option(section_name, "cache_ttl",
+                                                          self.public_ip_cache_ttl)
+
+    def get_feature_metrics_options(self):
+        """
+        Get options about exposing metrics.
+        """
+        section_name = "feature_metrics"
+        if self.parser.has_option(section_name, "listen") and \
+           self.parser.get(section_name, "listen"):
+            host, _, port = self.parser.get(section_name, "listen").rpartition(":")
+            try:
+                self.metrics_listen = (host.strip("[]") or "127.0.0.1", int(port))
+            except ValueError:
+                DDNSUtils.err_and_exit("Invalid listen in feature metrics config: " \
+                                       "it should be [host]:port")
+
+        if self.parser.has_option(section_name, "textfile"):
+            self.metrics_textfile = self.parser.get(section_name, "textfile") or None
+
+    def get_account_options(self, section):
+        """
+        Get credentials and API rate limit of an account, options not given
+        are inherited from DEFAULT section
+        """
+        name = section[len(ACCOUNT_SECTION_PREFIX):]
+        if not name or name == DEFAULT_ACCOUNT:
+            DDNSUtils.err_and_exit("Invalid account section name: {0}".format(section))
+
+        provider = self.parser.get(section, "provider") or None \
+                   if self.parser.has_option(section, "provider") else self.provider
+        access_id = self.parser.get(section, "access_id") \
+                    if self.parser.has_option(section, "access_id") else None
+        access_key = self.parser.get(section, "access_key") \
+                     if self.parser.has_option(section, "access_key") else None
+        if is_aliyun_provider(provider) and (not access_id or not access_key):
+            DDNSUtils.err_and_exit("Invalid access_id or access_key in {0}".format(section))
+
+        api_url = self.api_url
+        if self.parser.has_option(section, "api_url"):
+            api_url = self.parser.get(section, "api_url") or DEFAULT_API_URL
+        api_qps = self.get_number_option(section, "api_qps", self.api_qps)
+        if api_qps <= 0:
+            DDNSUtils.err_and_exit("Invalid api_qps in {0}: should be positive".format(section))
+        api_burst = self.get_number_option(section, "api_burst", self.api_burst, int)
+
+        self.accounts[name] = DDNSAccount(name, access_id, access_key, api_url,
+                                          api_qps, api_burst, provider)
@@ -0,0 +1,283 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+ Copyright (C) 2010-2013, Ryan Fan
+
+ This program is free software; you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation; either version 2 of the License, or
+ (at your option) any later version.
+
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU Library General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with this program; if not, write to the Free Software
+ Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+"""
+import random
+import signal
+import threading
+import time
+
+from utils import DDNSUtils
+from config import DDNSConfig
+from record import DDNSDomainRecordManager
+from reconciler import DDNSReconciler
+from netlinkwatcher import NetlinkAddressWatcher
+from metricsserver import MetricsServer
+
+
+class DDNSDaemon(object):
+    """
+    Long-running DDNS client which reconciles DomainRecords every interval
+    seconds, keeping config, record manager and DNS provider sessions alive
+    between cycles
+
+    SIGHUP reloads config file, SIGTERM/SIGINT stops it after current cycle
+    """
+    def __init__(self, config=None):
+        self.config = config or DDNSConfig()
+        DDNSUtils.setup_logging(self.config.log_format, self.config.debug,
+                                records=len(self.config.get_domain_record_sections()))
+        self.record_manager = DDNSDomainRecordManager(self.config)
+        self.reconciler = DDNSReconciler(self.config, self.record_manager)
+
+        self.wakeup = threading.Event()
+        self.stopping = False
+        self.reload_requested = False
+
+        self.watcher = None
+        self.metrics_server = None
+        self.lock = threading.Lock()
+        # LocalDomainRecords affected by address changes, synced at next wakeup
+        self.triggered_records = []
+
+    def install_signal_handlers(self):
+        """
+        Install SIGHUP/SIGTERM/SIGINT handlers, must be called in main thread
+        """
+        signal.signal(signal.SIGHUP, self.handle_reload_signal)
+        signal.signal(signal.SIGTERM, self.handle_stop_signal)
+        signal.signal(signal.SIGINT, self.handle_stop_signal)
+
+    def handle_reload_signal(self, signum, frame): # pylint: disable=unused-argument
+        """
+        Reload config at next wakeup
+        """
+        self.reload_requested = True
+        self.wakeup.set()
+
+    def handle_stop_signal(self, signum, frame): # pylint: disable=unused-argument
+        """
+        Stop after current cycle
+        """
+        self.stop()
+
+    def stop(self):
+        """
+        Ask the daemon loop to exit
+        """
+        self.stopping = True
+        self.wakeup.set()
+
+    def start_watcher(self, source=None):
+        """
+        Start watching interface address changes if it is enabled in config
+
+        :param source: netlink message source, default is rtnetlink socket
+        """
+        if not self.config.netlink_enable:
+            return
+
+        try:
+            self.watcher = NetlinkAddressWatcher(self.handle_address_change,
+                                                 debounce=self.config.netlink_debounce,
+                                                 source=source)
+            self.watcher.start()
+        except (AttributeError, OSError) as ex:
+            self.watcher = None
+            DDNSUtils.err("Failed watching address changes, " \
+                          "fall back to interval syncing only: {0}".format(ex))
+
+    def start_metrics_server(self):
+        """
+        Start serving metrics on local HTTP endpoint if it is enabled in config,
+        the endpoint is kept as is on config reload
+        """
+        if not self.config.metrics_listen:
+            return
+
+        try:
+            self.metrics_server = MetricsServer(self.config.metrics_listen)
+            self.metrics_server.start()
+        except (OSError, IOError) as ex:
+            self.metrics_server = None
+            DDNSUtils.err("Failed serving metrics on {0[0]}:{0[1]}: {1}"
+                          .format(self.config.metrics_listen, ex))
+
+    def get_affected_records(self, ifnames):
+        """
+        Get LocalDomainRecords whose value comes from changed interfaces
+
+        :param ifnames: set of interface names, None if any interface may have changed
+        :return: list of LocalDomainRecord
+        """
+        def is_changed(ifname):
+            return ifnames is None or ifname in ifnames
+
+        affected_records = []
+        for local_record in self.record_manager.local_record_list:
+            if local_record.type == "AAAA":
+                if is_changed(local_record.interface):
+                    affected_records.append(local_record)
+            elif self.config.pifn_enable and is_changed(self.config.pifn_interface):
+                affected_records.append(local_record)
+
+        return affected_records
+
+    def handle_address_change(self, ifnames):
+        """
+        Queue affected LocalDomainRecords and wake up the daemon loop
+
+        :param ifnames: set of interface names, None if any interface may have changed
+        """
+        affected_records = self.get_affected_records(ifnames)
+        if not affected_records:
+            return
+
+        DDNSUtils.info("Address changed on {0}, syncing {1} DomainRecords"
+                       .format(", ".join(sorted(ifnames or ["any interface"])),
+                               len(affected_records)))
+        with self.lock:
+            for local_record in affected_records:
+                if local_record not in self.triggered_records:
+                    self.triggered_records.append(local_record)
+        self.wakeup.set()
+
+    def take_triggered_records(self):
+        """
+        Get and clear queued LocalDomainRecords
+
+        :return: list of LocalDomainRecord
+        """
+        with self.lock:
+            triggered_records = self.triggered_records
+            self.triggered_records = []
+        return triggered_records
+
+    def reload(self):
+        """
+        Re-read config file, keep current config if the new one is invalid.
+        DNS providers and their connection pools are kept for accounts whose
+        provider and credentials are unchanged.
+        """
+        self.reload_requested = False
+        try:
+            config = DDNSConfig(self.config.conf_file)
+        except SystemExit:
+            DDNSUtils.err("Failed reloading config, keep using the current one")
+            return
+
+        # account name -> DNSProvider to keep
+        providers = {}
+        for name, account in config.accounts.items():
+            current_account = self.config.accounts.get(name)
+            if current_account is not None and \
+               current_account.get_credentials() == account.get_credentials():
+                providers[name] = self.record_manager.providers[name]
+
+        # nothing of the running setup is touched until the new one is built
+        record_manager = None
+        try:
+            record_manager = DDNSDomainRecordManager(config, providers=providers)
+            reconciler = DDNSReconciler(config, record_manager)
+        except SystemExit:
+            if record_manager is not None:
+                for name, provider in record_manager.providers.items():
+                    if name not in providers:
+                        provider.close()
+            DDNSUtils.err("Failed reloading config, keep using the current one")
+            return
+
+        for name, provider in self.record_manager.providers.items():
+            if name not in providers:
+                provider.close()
+
+        record_ids = self.record_manager.record_ids
+        zone_accounts = self.record_manager.zone_accounts
+        for key, record_id in record_ids.items():
+            # same account, RecordIds learned so far are still valid
+            account = zone_accounts.get(key[0])
+            if account in providers and record_manager.zone_accounts.get(key[0]) == account:
+                record_manager.record_ids.setdefault(key, record_id)
+
+        self.config = config
+        self.record_manager = record_manager
+        self.reconciler = reconciler
+        DDNSUtils.setup_logging(self.config.log_format, self.config.debug,
+                                records=len(self.config.get_domain_record_sections()))
+        DDNSUtils.info("Config reloaded with {0} DomainRecords"
+                       .format(len(self.record_manager.local_record_list)))
+
+    def run_once(self, local_record_list=None):
+        """
+        Run one reconcile cycle, errors are reported instead of raised so the
+        daemon survives transient failures
+
+        :param local_record_list: list of LocalDomainRecord, default is all
+        """
+        try:
+            current_public_ip = self.reconciler.get_current_public_ip()
+            if not current_public_ip:
+                DDNSUtils.err("Failed to get current public IP")
+                return
+
+            self.reconciler.reconcile(current_public_ip, local_record_list)
+        except Exception as ex: # pylint: disable=broad-except
+            DDNSUtils.err("Failed reconciling DomainRecords: {0}".format(ex))
+        finally:
+            self.reconciler.write_metrics()
+
+    def get_sleep_seconds(self):
+        """
+        Get seconds to sleep before next cycle, a random jitter is added so
+        that many clients won't hit Aliyun at the same moment
+
+        :return: seconds
+        """
+        jitter = self.config.interval_jitter
+        return max(0, self.config.interval + random.uniform(-jitter, jitter))
+
+    def run(self):
+        """
+        Daemon loop
+        """
+        DDNSUtils.info("DDNS daemon started, interval: {0}s".format(self.config.interval))
+        next_cycle_time = 0
+        while not self.stopping:
+            self.wakeup.clear()
+            if self.reload_requested:
+                self.reload()
+                next_cycle_time = 0
+
+            if time.time() >= next_cycle_time:
+                # full cycle covers any records triggered meanwhile
+                self.take_triggered_records()
+                self.run_once()
+                next_cycle_time = time.time() + self.get_sleep_seconds()
+            else:
+                triggered_records = self.take_triggered_records()
+                if triggered_records:
+                    self.run_once(triggered_records)
+
+            self.wakeup.wait(max(0, next_cycle_time - time.time()))
+
+        if self.watcher is not None:
+            self.watcher.stop()
+        if self.metrics_server is not None:
+            self.metrics_server.stop()
+        self.record_manager.close()
+        DDNSUtils.info("DDNS daemon stopped")
@@ -17,63 +17,144 @@
  along with this program; if not, write to the Free Software
  Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
 """
+import argparse
+import json
+import sys
+
 from utils import DDNSUtils
 from config import DDNSConfig
 from record import DDNSDomainRecordManager
+from reconciler import DDNSReconciler
 
-def main():
+def main(config=None):
     """
     Main routine
+
+    :param config: DDNSConfig, default is loaded from config file
     """
-    config = DDNSConfig()
+    if config is None:
+        config = DDNSConfig()
+    DDNSUtils.setup_logging(config.log_format, config.debug,
+                            records=len(config.get_domain_record_sections()))
+
     record_manager = DDNSDomainRecordManager(config)
 
-    # get current public ip for this server
-    if config.pifn_enable:
-        current_public_ip = DDNSUtils.get_interface_address(config.pifn_interface)
-    else:
-        current_public_ip = DDNSUtils.get_current_public_ip()
+    reconciler = DDNSReconciler(config, record_manager)
+
+    current_public_ip = reconciler.get_current_public_ip()
     if not current_public_ip:
+        reconciler.write_metrics()
         DDNSUtils.err_and_exit("Failed to get current public IP")
 
-    for local_record in record_manager.local_record_list:
-        dns_resolved_ip = DDNSUtils.get_dns_resolved_ip(local_record.subdomain,
-                                                        local_record.domainname)
-        
-        if local_record.type=="AAAA":
-            current_ip = DDNSUtils.get_interface_ipv6_address(local_record.interface)
-        else:
-            current_ip = current_public_ip
-
-        if current_ip == dns_resolved_ip:
-            DDNSUtils.info("Skipped as no changes for DomainRecord" \
-                           "[{rec.subdomain}.{rec.domainname}]".format(rec=local_record))
-            continue
-
-        # If current public IP doesn't equal to current DNS resolved ip, only in three cases:
-        # 1. The new synced IP for remote record in Aliyun doesn't take effect yet
-        # 2. remote record's IP in Aliyun server has changed
-        # 3. current public IP is changed
-        remote_record = record_manager.fetch_remote_record(local_record)
-        if not remote_record:
-            DDNSUtils.err("Failed finding remote DomainRecord" \
-                          "[{rec.subdomain}.{rec.domainname}]".format(rec=local_record))
-            continue
-
-        if current_ip == remote_record.value:
-            DDNSUtils.info("Skipped as we already updated DomainRecord" \
-                           "[{rec.subdomain}.{rec.domainname}]".format(rec=local_record))
-            continue
-
-        # if we can fetch remote record and record's value doesn't equal to public IP
-        sync_result = record_manager.update(remote_record, current_ip,local_record.type)
-        
-        if not sync_result:
-            DDNSUtils.err("Failed updating DomainRecord" \
-                          "[{rec.subdomain}.{rec.domainname}]".format(rec=local_record))
+    reconciler.reconcile(current_public_ip)
+    reconciler.write_metrics()
+
+def plan(config=None, plan_file="-"):
+    """
+    Plan routine, works out changes of all DomainRecords without making any
+
+    :param config: DDNSConfig, default is loaded from config file
+    :param plan_file: file the JSON plan is written to, "-" for stdout
+    :return: plan dict
+    """
+    if config is None:
+        config = DDNSConfig()
+    DDNSUtils.setup_logging(config.log_format, config.debug,
+                            records=len(config.get_domain_record_sections()))
+
+    record_manager = DDNSDomainRecordManager(config)
+    reconciler = DDNSReconciler(config, record_manager)
+
+    current_public_ip = reconciler.get_current_public_ip()
+    if not current_public_ip:
+        DDNSUtils.err_and_exit("Failed to get current public IP")
+
+    change_plan = reconciler.plan(current_public_ip)
+    record_manager.close()
+
+    # log lines already queued must not end up in the middle of the plan
+    DDNSUtils.flush_logging()
+    text = json.dumps(change_plan, indent=2, sort_keys=True) + "\n"
+    if plan_file == "-":
+        sys.stdout.write(text)
+        sys.stdout.flush()
+    else:
+        try:
+            with open(plan_file, "w") as output:
+                output.write(text)
+        except (IOError, OSError) as ex:
+            DDNSUtils.err_and_exit("Failed writing plan {0}: {1}".format(plan_file, ex))
+    return change_plan
+
+def apply_plan(plan_file, config=None):
+    """
+    Apply routine, runs updates of a plan written by plan()
+
+    :param plan_file: file the JSON plan is read from, "-" for stdin
+    :param config: DDNSConfig, default is loaded from config file
+    """
+    if config is None:
+        config = DDNSConfig()
+    DDNSUtils.setup_logging(config.log_format, config.debug,
+                            records=len(config.get_domain_record_sections()))
+
+    try:
+        if plan_file == "-":
+            change_plan = json.load(sys.stdin)
         else:
-            DDNSUtils.info("Successfully updated DomainRecord" \
-                           "[{rec.subdomain}.{rec.domainname}]".format(rec=local_record))
+            with open(plan_file) as plan_input:
+                change_plan = json.load(plan_input)
+    except (IOError, OSError, ValueError) as ex:
+        DDNSUtils.err_and_exit("Failed reading plan {0}: {1}".format(plan_file, ex))
+
+    record_manager = DDNSDomainRecordManager(config)
+    reconciler = DDNSReconciler(config, record_manager)
+
+    # a plan made for another public IP would write the old one back
+    current_public_ip = reconciler.get_current_public_ip()
+    if not current_public_ip:
+        DDNSUtils.err_and_exit("Failed to get current public IP")
+
+    reconciler.apply(change_plan, current_public_ip)
+    reconciler.write_metrics()
+
+def run_daemon(config=None):
+    """
+    Daemon routine
+
+    :param config: DDNSConfig, default is loaded from config file
+    """
+    # daemon pulls in netlink watcher and metrics server, which one-shot runs don't need
+    from daemon import DDNSDaemon
+    daemon = DDNSDaemon(config)
+    daemon.install_signal_handlers()
+    daemon.start_metrics_server()
+    daemon.start_watcher()
+    daemon.run()
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Aliyun DDNS client")
+    parser.add_argument("-d", "--daemon", action="store_true",
+                        help="keep running and sync DomainRecords every interval seconds")
+    parser.add_argument("-c", "--config", metavar="FILE",
+                        help="config file, default is ddns.conf or /etc/ddns.conf")
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument("--plan", metavar="FILE", nargs="?", const="-",
+                       help="write changes as JSON plan to FILE or stdout without making them, "
+                       "exit status is 2 if any DomainRecord needs an update")
+    group.add_argument("--apply", metavar="FILE",
+                       help="run updates of a plan written by --plan, \"-\" reads stdin")
+    args = parser.parse_args()
+    if args.daemon and (args.plan or args.apply):
+        parser.error("--plan and --apply can't be used with --daemon")
+
+    ddns_config = DDNSConfig(args.config)
+    if args.daemon:
+        run_daemon(ddns_config)
+    elif args.plan:
+        if plan(ddns_config, args.plan)["summary"]["update"]:
+            sys.exit(2)
+    elif args.apply:
+        apply_plan(args.apply, ddns_config)
+    else:
+        main(ddns_config)
@@ -0,0 +1,332 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+ Copyright (C) 2010-2013, Ryan Fan
+
+ This program is free software; you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation; either version 2 of the License, or
+ (at your option) any later version.
+
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU Library General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with this program; if not, write to the Free Software
+ Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+"""
+import asyncio
+import random
+import time
+
+from utils import DDNSUtils
+from config import DDNSConfig
+from record import DDNSDomainRecordManager
+from provider import AliyunProvider
+from reconciler import DDNSReconciler
+from yunresolver import ThrottlingError
+from asyncresolver import AsyncYunResolver
+from metrics import RECORD_RECONCILE_DURATION, UPDATE_THROTTLED
+
+
+class AsyncDDNSReconciler(DDNSReconciler):
+    """
+    Reconcile LocalDomainRecords on one event loop, all records are in flight
+    at the same time, API calls against a zone are still limited
+    """
+    def __init__(self, config, record_manager):
+        super(AsyncDDNSReconciler, self).__init__(config, record_manager)
+        # domainname -> future of the zone fetching in current cycle
+        self.zone_futures = {}
+
+    def get_zone_semaphore(self, domainname):
+        """
+        Get the asyncio semaphore limiting concurrent API calls against a zone
+        """
+        if domainname not in self.zone_semaphores:
+            self.zone_semaphores[domainname] = asyncio.BoundedSemaphore(self.max_workers_per_zone)
+        return self.zone_semaphores[domainname]
+
+    async def fetch_zone(self, local_record):
+        """
+        Fetch all remote records of the LocalDomainRecord's zone once per cycle
+        """
+        domainname = local_record.domainname
+        if domainname not in self.zone_futures:
+            self.zone_futures[domainname] = asyncio.ensure_future(self._fetch_zone(domainname))
+        await self.zone_futures[domainname]
+
+    async def _fetch_zone(self, domainname):
+        resolver = self.record_manager.get_resolver(domainname)
+        remote_records = []
+        async with self.get_zone_semaphore(domainname):
+            async for rec in resolver.iter_domain_records(domainname):
+                remote_records.append(AliyunProvider.to_remote_record(rec))
+        self.record_manager.set_zone_records(domainname, remote_records)
+
+    async def find_remote_record(self, local_record):
+        """
+        Find RemoteDomainRecord of LocalDomainRecord, by known RecordId first
+        """
+        if local_record.domainname in self.zone_futures:
+            await self.zone_futures[local_record.domainname]
+            return self.record_manager.find_remote_record(local_record)
+
+        recordid = None
+        if local_record.domainname not in self.bulk_zones:
+            recordid = self.get_record_id(local_record)
+        if recordid:
+            async with self.get_zone_semaphore(local_record.domainname):
+                resolver = self.record_manager.get_resolver(local_record.domainname)
+                info = await resolver.describe_domain_record_info(recordid)
+            remote_record = self.record_manager.match_remote_record(
+                AliyunProvider.to_remote_record(info) if info else None, local_record)
+            if remote_record:
+                self.record_manager.remember_record_id(local_record, recordid)
+                return remote_record
+            self.forget_record_id(local_record)
+
+        await self.fetch_zone(local_record)
+        return self.record_manager.find_remote_record(local_record)
+
+    async def update_record(self, local_record, remote_record, value):
+        """
+        Update one RemoteDomainRecord paced by the account's token bucket and
+        retried when throttled, the same way UpdateScheduler does
+
+        :return: True or False
+        """
+        scheduler = self.scheduler
+        bucket = self.get_update_bucket(local_record.account)
+        resolver = self.record_manager.get_resolver(local_record.domainname)
+        settings = self.record_manager.get_update_settings(remote_record, local_record.ttl,
+                                                           local_record.line,
+                                                           local_record.priority)
+        for attempt in range(scheduler.max_retries + 1):
+            wait = bucket.try_acquire()
+            while wait:
+                await asyncio.sleep(wait)
+                wait = bucket.try_acquire()
+            try:
+                async with self.get_zone_semaphore(local_record.domainname):
+                    return await resolver.update_domain_record(remote_record.recordid,
+                                                               rr=remote_record.rr,
+                                                               record_value=value,
+                                                               record_type=local_record.type,
+                                                               **settings)
+            except ThrottlingError as ex:
+                UPDATE_THROTTLED.inc()
+                if attempt == scheduler.max_retries:
+                    DDNSUtils.err("Gave up updating DomainRecord" \
+                                  "[{rec.subdomain}.{rec.domainname}] after {0} retries: {1}"
+                                  .format(attempt, ex, rec=local_record))
+                    return False
+
+                await asyncio.sleep(scheduler.retry_backoff * (2 ** attempt) *
+                                    random.uniform(0.5, 1.5))
+
+        return False
+
+    async def reconcile_record(self, local_record, current_public_ip, dns_resolved_ips=None):
+        """
+        Run resolve/fetch pipeline for one LocalDomainRecord, decisions are
+        made by the same check_*() helpers as DDNSReconciler.reconcile_record()
+
+        :return: tuple of (status, list of (is_error, message[, fields]), pending
+                 update of (RemoteDomainRecord, value) or None)
+        """
+        loop = asyncio.get_running_loop()
+
+        # interface lookup is a blocking call
+        current_ip = await loop.run_in_executor(None, self.get_current_ip,
+                                                local_record, current_public_ip)
+        result = self.check_current_ip(local_record, current_ip)
+        if result is not None:
+            return result
+
+        if self.can_resolve(local_record):
+            key = local_record.key
+            if dns_resolved_ips is not None and key in dns_resolved_ips:
+                dns_resolved_ip = dns_resolved_ips[key]
+            else:
+                dns_resolved_ip = await loop.run_in_executor(None, DDNSUtils.get_dns_resolved_ip,
+                                                             local_record.subdomain,
+                                                             local_record.domainname,
+                                                             local_record.type,
+                                                             self.dns_client)
+            result = self.check_dns_answer(local_record, current_ip, dns_resolved_ip)
+            if result is not None:
+                return result
+
+        remote_record = await self.find_remote_record(local_record)
+        return self.check_remote_record(local_record, current_ip, remote_record)
+
+    async def safe_reconcile_record(self, local_record, current_public_ip, dns_resolved_ips=None):
+        """
+        Reconcile one LocalDomainRecord, turning unexpected errors into a failed result
+
+        :return: tuple of (result of reconcile_record(), seconds spent on it)
+        """
+        start_time = time.time()
+        try:
+            with RECORD_RECONCILE_DURATION.time():
+                result = await self.reconcile_record(local_record, current_public_ip,
+                                                     dns_resolved_ips)
+        except Exception as ex: # pylint: disable=broad-except
+            result = self.FAILED, [(True, "Failed reconciling DomainRecord" \
+                                    "[{rec.subdomain}.{rec.domainname}]: {ex}"
+                                    .format(rec=local_record, ex=ex),
+                                    {"reason": self.REASON_ERROR})], None
+        return result, time.time() - start_time
+
+    async def safe_update_record(self, job, semaphore):
+        """
+        Run one UpdateJob, turning unexpected errors into a failed update
+
+        :return: True or False
+        """
+        async with semaphore:
+            try:
+                return await self.update_record(job.local_record, job.remote_record, job.value)
+            except Exception as ex: # pylint: disable=broad-except
+                DDNSUtils.err("Failed updating DomainRecord" \
+                              "[{rec.subdomain}.{rec.domainname}]: {ex!r}"
+                              .format(rec=job.local_record, ex=ex))
+                return False
+
+    async def run_jobs(self, jobs):
+        """
+        Run jobs of one account, started in priority order with at most
+        max_workers of the update scheduler in flight
+
+        :param jobs: list of UpdateJob
+        :return: list of True or False
+        """
+        semaphore = asyncio.Semaphore(self.scheduler.max_workers)
+        return await asyncio.gather(*[self.safe_update_record(job, semaphore) for job in jobs])
+
+    async def run_updates(self, updates, results):
+        """
+        Run pending updates through the update scheduler's queue, so they are
+        coalesced and prioritized like DDNSReconciler.run_updates()
+
+        :param updates: list of (index in results, LocalDomainRecord, RemoteDomainRecord, value)
+        :param results: list of (status, messages, update), results of updates
+                        are merged into it
+        """
+        for _, local_record, remote_record, value in updates:
+            self.scheduler.submit(local_record, remote_record, value)
+
+        jobs_by_account = {}
+        for job in self.scheduler.take_jobs():
+            jobs_by_account.setdefault(job.local_record.account, []).append(job)
+        account_jobs = list(jobs_by_account.values())
+        account_results = await asyncio.gather(*[self.run_jobs(jobs) for jobs in account_jobs])
+
+        update_results = {}
+        for jobs, sync_results in zip(account_jobs, account_results):
+            for job, sync_result in zip(jobs, sync_results):
+                update_results[job.remote_record.recordid] = sync_result
+
+        for i, local_record, remote_record, value in updates:
+            sync_result = update_results.get(remote_record.recordid, False)
+            status, update_messages = self.finish_update(local_record, remote_record, value,
+                                                         sync_result)
+            results[i] = (status, results[i][1] + update_messages, None)
+
+    async def reconcile(self, current_public_ip, local_record_list=None):
+        """
+        Reconcile LocalDomainRecords, messages are output in the order of local records
+
+        :return: list of (LocalDomainRecord, status)
+        """
+        if local_record_list is None:
+            local_record_list = self.record_manager.local_record_list
+
+        start_time = time.time()
+        self.zone_futures = {}
+        self.interface_addresses.clear()
+        # all DNS queries are pipelined on one socket in a worker thread
+        loop = asyncio.get_running_loop()
+        dns_resolved_ips = await loop.run_in_executor(None, self.resolve_records,
+                                                      local_record_list, current_public_ip)
+        self.bulk_zones = await loop.run_in_executor(None, self.get_bulk_zones,
+                                                     local_record_list, current_public_ip,
+                                                     dns_resolved_ips)
+        detected = await asyncio.gather(*[self.safe_reconcile_record(rec, current_public_ip,
+                                                                     dns_resolved_ips)
+                                          for rec in local_record_list])
+        results = [result for result, _ in detected]
+        await self.run_updates([(i, local_record, update[0], update[1])
+                                for i, (local_record, (_, _, update)) in
+                                enumerate(zip(local_record_list, results)) if update is not None],
+                               results)
+
+        if self.state is not None:
+            self.state.save()
+        self.record_metrics([status for status, _, _ in results], start_time)
+
+        for local_record, (status, messages, _), (_, duration) in \
+                zip(local_record_list, results, detected):
+            self.log_messages(local_record, status, messages, duration)
+
+        return [(rec, status) for rec, (status, _, _) in zip(local_record_list, results)]
+
+
+async def close_record_manager(record_manager):
+    """
+    Close DNS providers of a DDNSDomainRecordManager, aiohttp sessions of
+    async resolvers are closed on the running event loop
+    """
+    resolvers = record_manager.resolvers
+    for name, provider in record_manager.providers.items():
+        if name not in resolvers:
+            provider.close()
+    await asyncio.gather(*[resolver.aclose() for resolver in resolvers.values()])
+
+
+async def async_main(config=None):
+    """
+    Main routine for asyncio applications, it can be awaited in an existing
+    event loop and never exits the process
+
+    :param config: DDNSConfig, default is loaded from config file
+    :return: list of (LocalDomainRecord, status), or None if failed
+    """
+    # invalid config is reported by err_and_exit, which must not end the
+    # application awaiting us
+    record_manager = None
+    try:
+        if config is None:
+            config = DDNSConfig()
+        DDNSUtils.setup_logging(config.log_format, config.debug,
+                                records=len(config.get_domain_record_sections()))
+
+        # one pooled aiohttp session per account
+        record_manager = DDNSDomainRecordManager(config, resolver_class=AsyncYunResolver)
+        if len(record_manager.resolvers) != len(record_manager.providers):
+            DDNSUtils.err("Only accounts on Aliyun can be synced by asyncio client")
+            await close_record_manager(record_manager)
+            return None
+        reconciler = AsyncDDNSReconciler(config, record_manager)
+    except SystemExit:
+        if record_manager is not None:
+            await close_record_manager(record_manager)
+        return None
+
+    try:
+        loop = asyncio.get_running_loop()
+        current_public_ip = await loop.run_in_executor(None, reconciler.get_current_public_ip)
+        if not current_public_ip:
+            DDNSUtils.err("Failed to get current public IP")
+            return None
+
+        return await reconciler.reconcile(current_public_ip)
+    finally:
+        reconciler.write_metrics()
+        await close_record_manager(record_manager)
+
+if __name__ == "__main__":
+    asyncio.run(async_main())
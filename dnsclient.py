@@ -0,0 +1,469 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+ Copyright (C) 2010-2013, Ryan Fan
+
+ This program is free software; you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation; either version 2 of the License, or
+ (at your option) any later version.
+
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU Library General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with this program; if not, write to the Free Software
+ Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+"""
+import random
+import select
+import socket
+import struct
+import threading
+import time
+
+# RFC 1035 resource record types and classes
+QTYPES = {'A': 1, 'NS': 2, 'CNAME': 5, 'AAAA': 28}
+QCLASS_IN = 1
+
+FLAG_RD = 0x0100
+FLAG_TC = 0x0200
+RCODE_MASK = 0x000f
+RCODES = {1: "FORMERR", 2: "SERVFAIL", 3: "NXDOMAIN", 4: "NOTIMP", 5: "REFUSED"}
+# errors of one nameserver rather than answers about the name, the next
+# nameserver is asked instead
+NAMESERVER_ERRORS = frozenset((RCODES[2], RCODES[4], RCODES[5]))
+
+DNS_HEADER = struct.Struct("!HHHHHH")
+RR_HEADER = struct.Struct("!HHIH")
+
+RESOLV_CONF = "/etc/resolv.conf"
+
+
+class DNSError(Exception):
+    """
+    Raised when a name can't be resolved
+    """
+    pass
+
+
+def build_query(qid, hostname, qtype, recursion=False):
+    """
+    Build DNS query packet
+
+    :param qid:       query id
+    :param hostname:  name to query
+    :param qtype:     record type name, e,g: 'A', 'AAAA'
+    :param recursion: set RD flag or not
+    :return: bytes
+    """
+    flags = FLAG_RD if recursion else 0
+    packet = DNS_HEADER.pack(qid, flags, 1, 0, 0, 0)
+    for label in hostname.rstrip(".").split("."):
+        label = label.encode("idna") if label != "*" else b"*"
+        packet += struct.pack("!B", len(label)) + label
+    packet += b"\0" + struct.pack("!HH", QTYPES[qtype], QCLASS_IN)
+    return packet
+
+
+def read_name(data, offset):
+    """
+    Read a possibly compressed domain name
+
+    :return: tuple of (name, offset after the name)
+    """
+    labels = []
+    end_offset = None
+    jumps = 0
+    while True:
+        if offset >= len(data):
+            raise DNSError("Truncated name in response")
+        length = data[offset] if not isinstance(data, str) else ord(data[offset])
+        if length & 0xc0 == 0xc0:
+            if end_offset is None:
+                end_offset = offset + 2
+            offset = struct.unpack_from("!H", data, offset)[0] & 0x3fff
+            jumps += 1
+            if jumps > 64:
+                raise DNSError("Compression loop in response")
+            continue
+
+        offset += 1
+        if length == 0:
+            break
+        labels.append(data[offset:offset + length].decode("ascii", "replace"))
+        offset += length
+
+    return ".".join(labels), end_offset if end_offset is not None else offset
+
+
+def parse_response(data):
+    """
+    Parse DNS response packet
+
+    :param data: bytes
+    :return: dict of id, rcode, truncated, question and answers list of (name, type, rdata)
+    """
+    if len(data) < DNS_HEADER.size:
+        raise DNSError("Truncated response")
+
+    qid, flags, qdcount, ancount, _, _ = DNS_HEADER.unpack_from(data, 0)
+    offset = DNS_HEADER.size
+    question = None
+    for _ in range(qdcount):
+        name, offset = read_name(data, offset)
+        qtype, _ = struct.unpack_from("!HH", data, offset)
+        offset += 4
+        question = (name.lower(), qtype)
+
+    answers = []
+    for _ in range(ancount):
+        name, offset = read_name(data, offset)
+        rtype, _, _, rdlength = RR_HEADER.unpack_from(data, offset)
+        offset += RR_HEADER.size
+        rdata_offset = offset
+        offset += rdlength
+        if rtype == QTYPES['A'] and rdlength == 4:
+            rdata = socket.inet_ntoa(data[rdata_offset:offset])
+        elif rtype == QTYPES['AAAA'] and rdlength == 16:
+            rdata = socket.inet_ntop(socket.AF_INET6, data[rdata_offset:offset])
+        elif rtype in (QTYPES['NS'], QTYPES['CNAME']):
+            rdata, _ = read_name(data, rdata_offset)
+        else:
+            continue
+        answers.append((name.lower(), rtype, rdata))
+
+    return {
+        'id': qid,
+        'rcode': flags & RCODE_MASK,
+        'truncated': bool(flags & FLAG_TC),
+        'question': question,
+        'answers': answers,
+    }
+
+
+def get_answer(response, qtype):
+    """
+    Get first answer of requested type from parsed response
+
+    :return: tuple of (rdata or None, error message or None)
+    """
+    if response['rcode']:
+        return None, RCODES.get(response['rcode'], "rcode {0}".format(response['rcode']))
+
+    for _, rtype, rdata in response['answers']:
+        if rtype == QTYPES[qtype]:
+            return rdata, None
+
+    return None, "no {0} record".format(qtype)
+
+
+def get_system_nameservers(path=RESOLV_CONF):
+    """
+    Get recursive nameservers of system resolver
+
+    :return: list of IP addresses
+    """
+    nameservers = []
+    try:
+        with open(path) as resolv_conf:
+            for line in resolv_conf:
+                fields = line.split()
+                if len(fields) >= 2 and fields[0] == "nameserver":
+                    nameservers.append(fields[1].split("%")[0])
+    except (IOError, OSError):
+        pass
+
+    return nameservers or ["127.0.0.1"]
+
+
+class DNSClient(object):
+    """
+    Lightweight stub DNS client querying authoritative nameservers directly,
+    so answers are neither cached nor stale. Many queries are pipelined on
+    one UDP socket, and truncated answers are retried over TCP.
+    """
+    MAX_IN_FLIGHT = 256
+    # seconds to cache nameservers of a zone, or the failure to find them
+    CACHE_TTL = 86400
+    NEGATIVE_CACHE_TTL = 300
+
+    def __init__(self, nameservers=None, timeout=2.0, retries=2, port=53):
+        """
+        :param nameservers: list of authoritative nameserver hosts used for all
+                            zones, they are discovered per zone if not given
+        :param timeout:     seconds to wait for answers of one attempt
+        :param retries:     extra attempts on other nameservers
+        :param port:        nameserver port
+        """
+        self.nameservers = nameservers
+        self.timeout = timeout
+        self.retries = retries
+        self.port = port
+        self.lock = threading.Lock()
+        # zone -> tuple of (nameserver addresses, recursion, expire time)
+        self.zone_nameservers = {}
+
+    def get_addresses(self, hosts):
+        """
+        Resolve nameserver hosts to addresses
+
+        :param hosts: list of hostnames or IP addresses
+        :return: tuple of IP addresses
+        """
+        addresses = []
+        for host in hosts:
+            try:
+                for info in socket.getaddrinfo(host, self.port, 0, socket.SOCK_DGRAM):
+                    if info[4][0] not in addresses:
+                        addresses.append(info[4][0])
+            except socket.error:
+                continue
+        return tuple(addresses)
+
+    def get_nameservers(self, zone):
+        """
+        Get authoritative nameserver addresses of zone, the NS records are
+        asked from system resolver and cached
+
+        :param zone: domain name
+        :return: tuple of (addresses, whether they are recursive resolvers)
+        """
+        return self.get_zones_nameservers([zone])[zone]
+
+    def get_zones_nameservers(self, zones):
+        """
+        Get authoritative nameserver addresses of many zones, NS records of
+        the zones not cached yet are asked in one pipelined batch
+
+        :param zones: list of domain names
+        :return: dict of zone -> tuple of (addresses, whether they are recursive resolvers)
+        """
+        now = time.time()
+        nameservers = {}
+        missing = []
+        with self.lock:
+            for zone in set(zones):
+                # configured nameservers are cached for all zones as None
+                cached = self.zone_nameservers.get(None if self.nameservers else zone)
+                if cached and cached[2] > now:
+                    nameservers[zone] = cached[0], cached[1]
+                else:
+                    missing.append(zone)
+        if not missing:
+            return nameservers
+
+        # cache key -> tuple of (addresses, recursion)
+        found = {}
+        if self.nameservers:
+            found[None] = self.get_addresses(self.nameservers), False
+        else:
+            system_nameservers = tuple(get_system_nameservers())
+            results = self.query_many(system_nameservers, [(zone, 'NS') for zone in missing],
+                                      recursion=True, all_answers=True)
+            # zones hosted by the same provider share nameserver hosts
+            host_addresses = {}
+            for zone in missing:
+                ns_hosts, _ = results[(zone, 'NS')]
+                hosts = tuple(sorted(ns_hosts or []))
+                if hosts not in host_addresses:
+                    host_addresses[hosts] = self.get_addresses(hosts)
+                if host_addresses[hosts]:
+                    found[zone] = host_addresses[hosts], False
+                else:
+                    # fall back to the recursive resolvers for a while
+                    found[zone] = system_nameservers, True
+
+        with self.lock:
+            for key, (addresses, recursion) in found.items():
+                ttl = self.NEGATIVE_CACHE_TTL if recursion or not addresses else self.CACHE_TTL
+                self.zone_nameservers[key] = (addresses, recursion, now + ttl)
+
+        for zone in missing:
+            nameservers[zone] = found[None if self.nameservers else zone]
+        return nameservers
+
+    def resolve(self, hostname, qtype='A', zone=None):
+        """
+        Resolve one name
+
+        :param hostname: name to query
+        :param qtype:    'A' or 'AAAA'
+        :param zone:     zone the name belongs to, default is hostname itself
+        :return: IP address
+        :raise DNSError: if it can't be resolved
+        """
+        ip_addr, error = self.resolve_many([(hostname, qtype, zone)])[(hostname, qtype)]
+        if error:
+            raise DNSError(error)
+        return ip_addr
+
+    def resolve_many(self, queries):
+        """
+        Resolve many names, nameservers of all zones are looked up in one batch
+        and queries against the same nameservers are sent at once
+
+        :param queries: list of (hostname, qtype, zone)
+        :return: dict of (hostname, qtype) -> (IP address or None, error or None)
+        """
+        zones_nameservers = self.get_zones_nameservers([zone or hostname
+                                                        for hostname, _, zone in queries])
+        groups = {}
+        for hostname, qtype, zone in queries:
+            nameservers = zones_nameservers[zone or hostname]
+            groups.setdefault(nameservers, []).append((hostname, qtype))
+
+        results = {}
+        for (addresses, recursion), questions in groups.items():
+            results.update(self.query_many(addresses, questions, recursion=recursion))
+        return results
+
+    def query_many(self, addresses, questions, recursion=False, all_answers=False):
+        """
+        Pipeline queries to nameservers over UDP, unanswered ones and the ones
+        a nameserver failed or refused to answer are retried on next
+        nameserver, truncated ones are retried over TCP. Every nameserver is
+        tried at least once
+
+        :param addresses:   tuple of nameserver addresses
+        :param questions:   list of (hostname, qtype)
+        :param recursion:   ask for recursion or not
+        :param all_answers: return list of all answers instead of the first one
+        :return: dict of (hostname, qtype) -> (answer or None, error or None)
+        """
+        results = {}
+        # question -> error of the latest nameserver which failed it
+        failures = {}
+        pending = list(set(questions))
+        if not addresses:
+            return dict((q, (None, "no nameserver")) for q in pending)
+
+        for attempt in range(max(self.retries + 1, len(addresses))):
+            if not pending:
+                break
+            address = addresses[attempt % len(addresses)]
+            answered = {}
+            # limit queries in flight so the socket buffer won't overflow
+            for i in range(0, len(pending), self.MAX_IN_FLIGHT):
+                answered.update(self.query_udp(address, pending[i:i + self.MAX_IN_FLIGHT],
+                                               recursion, all_answers))
+            for question, result in answered.items():
+                if result is None:
+                    result = self.query_tcp(address, question, recursion, all_answers)
+                if result[1] in NAMESERVER_ERRORS:
+                    failures[question] = result
+                    continue
+                results[question] = result
+            pending = [q for q in pending if q not in results]
+
+        for question in pending:
+            results[question] = failures.get(question, (None, "timed out"))
+        return results
+
+    def query_udp(self, address, questions, recursion, all_answers):
+        """
+        Send all questions on one UDP socket and collect answers until timeout
+
+        :return: dict of question -> result, result is None if truncated
+        """
+        family = socket.AF_INET6 if ":" in address else socket.AF_INET
+        try:
+            sock = socket.socket(family, socket.SOCK_DGRAM)
+        except socket.error:
+            return {}
+        try:
+            qids = random.sample(range(1, 0x10000), len(questions))
+            pending = dict(zip(qids, questions))
+            # refused or unreachable nameserver leaves all questions unanswered,
+            # so that they are asked to the next one
+            try:
+                sock.setblocking(False)
+                sock.connect((address, self.port))
+                for qid, (hostname, qtype) in pending.items():
+                    sock.send(build_query(qid, hostname, qtype, recursion))
+            except socket.error:
+                return {}
+
+            answered = {}
+            deadline = time.time() + self.timeout
+            while pending:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                readable, _, _ = select.select([sock], [], [], remaining)
+                if not readable:
+                    break
+                try:
+                    data = sock.recv(65535)
+                    response = parse_response(data)
+                except (socket.error, DNSError, struct.error):
+                    continue
+
+                question = pending.get(response['id'])
+                if question is None or \
+                   response['question'] != (question[0].rstrip(".").lower(), QTYPES[question[1]]):
+                    continue
+
+                del pending[response['id']]
+                if response['truncated']:
+                    answered[question] = None
+                else:
+                    answered[question] = self.get_result(response, question[1], all_answers)
+            return answered
+        finally:
+            sock.close()
+
+    def query_tcp(self, address, question, recursion, all_answers):
+        """
+        Query one question over TCP
+
+        :return: tuple of (answer or None, error or None)
+        """
+        hostname, qtype = question
+        qid = random.randint(1, 0xffff)
+        packet = build_query(qid, hostname, qtype, recursion)
+        family = socket.AF_INET6 if ":" in address else socket.AF_INET
+        sock = None
+        try:
+            sock = socket.socket(family, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            sock.connect((address, self.port))
+            sock.sendall(struct.pack("!H", len(packet)) + packet)
+            length = struct.unpack("!H", self.recv_exactly(sock, 2))[0]
+            response = parse_response(self.recv_exactly(sock, length))
+        except (socket.error, DNSError, struct.error) as ex:
+            return None, "TCP query failed: {0}".format(ex)
+        finally:
+            if sock is not None:
+                sock.close()
+
+        if response['id'] != qid:
+            return None, "mismatched TCP response"
+        return self.get_result(response, qtype, all_answers)
+
+    @staticmethod
+    def recv_exactly(sock, size):
+        """
+        Receive exactly size bytes from stream socket
+        """
+        data = b""
+        while len(data) < size:
+            chunk = sock.recv(size - len(data))
+            if not chunk:
+                raise DNSError("Connection closed")
+            data += chunk
+        return data
+
+    @staticmethod
+    def get_result(response, qtype, all_answers):
+        """
+        Turn parsed response into (answer or None, error or None)
+        """
+        if not all_answers:
+            return get_answer(response, qtype)
+
+        if response['rcode']:
+            return None, RCODES.get(response['rcode'], "rcode {0}".format(response['rcode']))
+        return [rdata for _, rtype, rdata in response['answers'] if rtype == QTYPES[qtype]], None
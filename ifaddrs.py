@@ -0,0 +1,338 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+ Copyright (C) 2010-2013, Ryan Fan
+
+ This program is free software; you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation; either version 2 of the License, or
+ (at your option) any later version.
+
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU Library General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with this program; if not, write to the Free Software
+ Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+"""
+import binascii
+import socket
+import threading
+
+IF_INET6_PATH = "/proc/net/if_inet6"
+
+# address scopes, values of /proc/net/if_inet6 (linux/ipv6.h IPV6_ADDR_*)
+SCOPE_GLOBAL = "global"
+SCOPE_SITE = "site"
+SCOPE_LINK = "link"
+SCOPE_HOST = "host"
+PROC_SCOPES = {0x00: SCOPE_GLOBAL, 0x40: SCOPE_SITE, 0x20: SCOPE_LINK, 0x10: SCOPE_HOST}
+
+# address flags, the low byte of ifa_flags in linux/if_addr.h
+IFA_F_TEMPORARY = 0x01
+IFA_F_DADFAILED = 0x08
+IFA_F_DEPRECATED = 0x20
+IFA_F_TENTATIVE = 0x40
+IFA_F_PERMANENT = 0x80
+
+# values of address_scope and address_prefer options
+VALID_SCOPES = (SCOPE_GLOBAL, SCOPE_SITE, SCOPE_LINK, SCOPE_HOST, "any")
+PREFER_STABLE = "stable"
+PREFER_EUI64 = "eui64"
+PREFER_TEMPORARY = "temporary"
+VALID_PREFERENCES = (PREFER_STABLE, PREFER_EUI64, PREFER_TEMPORARY, "none")
+
+
+def parse_address(addr):
+    """
+    Parse IPv4 or IPv6 address text
+
+    :return: tuple of (address family, int)
+    :raise ValueError: if it is not an IP address
+    """
+    family = socket.AF_INET6 if ":" in addr else socket.AF_INET
+    try:
+        packed = socket.inet_pton(family, addr)
+    except (socket.error, ValueError):
+        raise ValueError("invalid address {0}".format(addr))
+    return family, int(binascii.hexlify(packed), 16)
+
+
+class InterfaceAddress(object):# pylint: disable=too-few-public-methods
+    """
+    One address of a local interface
+    """
+    __slots__ = ('addr', 'family', 'value', 'prefixlen', 'scope', 'flags')
+
+    def __init__(self, addr, prefixlen=None, scope=SCOPE_GLOBAL, flags=0):
+        self.addr = addr
+        self.family, self.value = parse_address(addr)
+        self.prefixlen = prefixlen
+        self.scope = scope
+        self.flags = flags
+
+    @property
+    def temporary(self):
+        """
+        RFC 4941 privacy address, it is replaced every few hours
+        """
+        return bool(self.flags & IFA_F_TEMPORARY)
+
+    @property
+    def permanent(self):
+        """
+        Configured statically rather than by SLAAC or DHCPv6
+        """
+        return bool(self.flags & IFA_F_PERMANENT)
+
+    @property
+    def deprecated(self):
+        """
+        Preferred lifetime expired, or DAD not done or failed
+        """
+        return bool(self.flags & (IFA_F_DEPRECATED | IFA_F_TENTATIVE | IFA_F_DADFAILED))
+
+    @property
+    def eui64(self):
+        """
+        Interface identifier derived from MAC address, which has ff:fe in the middle
+        """
+        return self.family == socket.AF_INET6 and (self.value >> 24) & 0xffff == 0xfffe
+
+
+def get_address_scope(family, value):
+    """
+    Guess scope from address when the system doesn't tell it
+
+    :param family: address family
+    :param value: address as int
+    :return: scope
+    """
+    if family == socket.AF_INET:
+        if value >> 24 == 127:
+            return SCOPE_HOST
+        if value >> 16 == 0xa9fe:
+            return SCOPE_LINK
+        return SCOPE_GLOBAL
+
+    if value == 1:
+        return SCOPE_HOST
+    if value >> 118 == 0x3fa:
+        return SCOPE_LINK
+    if value >> 118 == 0x3fb:
+        return SCOPE_SITE
+    return SCOPE_GLOBAL
+
+
+def read_inet6_addresses(path=IF_INET6_PATH):
+    """
+    Read IPv6 addresses of all interfaces with scope and flags, lines are like
+    "20010db800000000021122fffe334455 02 40 00 80 eth0"
+
+    :return: dict of ifname -> list of InterfaceAddress, or None if it is unavailable
+    """
+    try:
+        with open(path) as inet6_file:
+            lines = inet6_file.readlines()
+    except (IOError, OSError):
+        return None
+
+    addresses = {}
+    for line in lines:
+        fields = line.split()
+        if len(fields) != 6 or len(fields[0]) != 32:
+            continue
+        addr = socket.inet_ntop(socket.AF_INET6, binascii.unhexlify(fields[0]))
+        scope = PROC_SCOPES.get(int(fields[3], 16) & 0xf0, SCOPE_GLOBAL)
+        addresses.setdefault(fields[5], []).append(
+            InterfaceAddress(addr, int(fields[2], 16), scope, int(fields[4], 16)))
+    return addresses
+
+
+def read_netifaces_addresses(ifname, family):
+    """
+    Read addresses of an interface through netifaces, scope is guessed and
+    no flags are known
+
+    :return: list of InterfaceAddress, or None if there is no such interface
+    """
+    import netifaces as ni
+    try:
+        infos = ni.ifaddresses(ifname)
+    except ValueError:
+        return None
+
+    addresses = []
+    for info in infos.get(ni.AF_INET6 if family == socket.AF_INET6 else ni.AF_INET, []):
+        # link-local addresses come as "fe80::1%eth0"
+        addr = info.get('addr', '').split('%')[0]
+        try:
+            address = InterfaceAddress(addr)
+        except ValueError:
+            continue
+        address.scope = get_address_scope(address.family, address.value)
+        addresses.append(address)
+    return addresses
+
+
+class AddressPolicy(object):# pylint: disable=too-few-public-methods
+    """
+    Rules picking one address out of all addresses of an interface, policies
+    are shared by LocalDomainRecords with the same options
+    """
+    __slots__ = ('scope', 'prefer', 'allow_deprecated', 'prefix', 'network', 'mask', 'family')
+    _policies = {}
+    _lock = threading.Lock()
+
+    def __init__(self, scope=SCOPE_GLOBAL, prefer=PREFER_STABLE, allow_deprecated=False,
+                 prefix=None):
+        if scope not in VALID_SCOPES:
+            raise ValueError("invalid address_scope {0}".format(scope))
+        if prefer not in VALID_PREFERENCES:
+            raise ValueError("invalid address_prefer {0}".format(prefer))
+
+        self.scope = scope
+        self.prefer = prefer
+        self.allow_deprecated = allow_deprecated
+        self.prefix = prefix
+        self.network = self.mask = self.family = None
+        if prefix:
+            addr, _, prefixlen = prefix.partition("/")
+            try:
+                self.family, self.network = parse_address(addr)
+                bits = 128 if self.family == socket.AF_INET6 else 32
+                prefixlen = int(prefixlen) if prefixlen else bits
+                if not 0 <= prefixlen <= bits:
+                    raise ValueError
+            except ValueError:
+                raise ValueError("invalid address_prefix {0}".format(prefix))
+            self.mask = ((1 << prefixlen) - 1) << (bits - prefixlen)
+            self.network &= self.mask
+
+    @classmethod
+    def get(cls, scope=SCOPE_GLOBAL, prefer=PREFER_STABLE, allow_deprecated=False, prefix=None):
+        """
+        Get the shared policy of the given options
+
+        :raise ValueError: if any option is invalid
+        """
+        key = (scope, prefer, allow_deprecated, prefix)
+        with cls._lock:
+            policy = cls._policies.get(key)
+            if policy is None:
+                policy = cls._policies[key] = cls(scope, prefer, allow_deprecated, prefix)
+            return policy
+
+    def matches(self, address):
+        """
+        Whether address can be picked at all
+        """
+        if self.scope != "any" and address.scope != self.scope:
+            return False
+        if address.deprecated and not self.allow_deprecated:
+            return False
+        if self.network is not None:
+            return address.family == self.family and \
+                address.value & self.mask == self.network
+        return True
+
+    def rank(self, address):
+        """
+        Sort key of a matching address, the lowest wins. Ties are broken by
+        the address itself so that the pick doesn't follow kernel order,
+        unless nothing is preferred
+        """
+        if self.prefer == PREFER_STABLE:
+            preference = (address.temporary, not (address.permanent or address.eui64))
+        elif self.prefer == PREFER_EUI64:
+            preference = (not address.eui64, address.temporary)
+        elif self.prefer == PREFER_TEMPORARY:
+            preference = (not address.temporary,)
+        else:
+            return (address.deprecated,)
+        return preference + (address.deprecated, address.value)
+
+    def select(self, addresses):
+        """
+        Pick one address
+
+        :param addresses: list of InterfaceAddress
+        :return: address text or None if none matches
+        """
+        candidates = [address for address in addresses if self.matches(address)]
+        if not candidates:
+            return None
+        return min(candidates, key=self.rank).addr
+
+
+DEFAULT_POLICY = AddressPolicy.get()
+# the first address in kernel order, as IPv4 interface addresses always were
+ANY_POLICY = AddressPolicy.get(scope="any", prefer="none", allow_deprecated=True)
+
+
+class InterfaceAddressSnapshot(object):
+    """
+    Addresses of local interfaces enumerated at most once until cleared, so
+    that all LocalDomainRecords sharing an interface in a sync cycle are
+    computed from the same enumeration
+    """
+    def __init__(self, inet6_path=IF_INET6_PATH):
+        self.inet6_path = inet6_path
+        self.lock = threading.Lock()
+        # (ifname, family) -> list of InterfaceAddress or None
+        self.addresses = {}
+        # whether /proc/net/if_inet6 was read into addresses
+        self.inet6_read = False
+
+    def clear(self):
+        """
+        Forget enumerated addresses, done at the start of every sync cycle
+        """
+        with self.lock:
+            self.addresses = {}
+            self.inet6_read = False
+
+    def get_addresses(self, ifname, family):
+        """
+        Get addresses of an interface
+
+        :param ifname: interface name
+        :param family: socket.AF_INET or socket.AF_INET6
+        :return: list of InterfaceAddress, or None if there is no such interface
+        """
+        key = (ifname, family)
+        with self.lock:
+            if key in self.addresses:
+                return self.addresses[key]
+
+            # one read of /proc/net/if_inet6 has IPv6 addresses of all interfaces
+            if family == socket.AF_INET6 and not self.inet6_read:
+                all_addresses = read_inet6_addresses(self.inet6_path)
+                if all_addresses is not None:
+                    self.inet6_read = True
+                    for name, addresses in all_addresses.items():
+                        self.addresses[(name, family)] = addresses
+                    return self.addresses.setdefault(key, None)
+
+            if family == socket.AF_INET6 and self.inet6_read:
+                return self.addresses.setdefault(key, None)
+
+            self.addresses[key] = read_netifaces_addresses(ifname, family)
+            return self.addresses[key]
+
+    def get_address(self, ifname, family, policy=DEFAULT_POLICY):
+        """
+        Get the address an interface has by policy
+
+        :param ifname: interface name
+        :param family: socket.AF_INET or socket.AF_INET6
+        :param policy: AddressPolicy
+        :return: address text or None
+        :raise LookupError: if there is no such interface
+        """
+        addresses = self.get_addresses(ifname, family)
+        if addresses is None:
+            raise LookupError("Can't find the interface {0}".format(ifname))
+        return policy.select(addresses)
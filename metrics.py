@@ -0,0 +1,286 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+ Copyright (C) 2010-2013, Ryan Fan
+
+ This program is free software; you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation; either version 2 of the License, or
+ (at your option) any later version.
+
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU Library General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with this program; if not, write to the Free Software
+ Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+"""
+import os
+import threading
+import time
+
+# os.rename is atomic on POSIX but can't overwrite on Windows
+replace_file = getattr(os, "replace", os.rename)
+
+
+def format_value(value):
+    """
+    Format sample value
+    """
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def format_bound(bound):
+    """
+    Format histogram bucket bound as canonical float
+    """
+    if bound == float("inf"):
+        return "+Inf"
+    return repr(float(bound))
+
+
+def format_labels(labelnames, labelvalues, extra=None):
+    """
+    Format label set like {action="UpdateDomainRecord",code="200"}
+    """
+    pairs = list(zip(labelnames, labelvalues))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join('{0}="{1}"'.format(
+        name, str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"'))
+                          for name, value in pairs) + "}"
+
+
+class Metric(object):
+    """
+    Base class of metric families, samples are kept per label values
+    """
+    TYPE = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        # tuple of label values -> sample state
+        self.samples = {}
+
+    def get_labelvalues(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def render(self, openmetrics):
+        """
+        Render metric family in text format
+
+        :param openmetrics: OpenMetrics if True, or Prometheus text format
+        :return: list of lines
+        """
+        family = self.name
+        if not openmetrics and self.TYPE == "counter":
+            family += "_total"
+        lines = ["# HELP {0} {1}".format(family, self.documentation),
+                 "# TYPE {0} {1}".format(family, self.TYPE)]
+        with self.lock:
+            samples = sorted(self.samples.items())
+            for labelvalues, state in samples:
+                lines.extend(self.render_samples(labelvalues, state))
+        return lines
+
+    def render_samples(self, labelvalues, state):
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    """
+    Monotonic counter, exposed with "_total" suffix
+    """
+    TYPE = "counter"
+
+    def inc(self, amount=1, **labels):
+        labelvalues = self.get_labelvalues(labels)
+        with self.lock:
+            self.samples[labelvalues] = self.samples.get(labelvalues, 0) + amount
+
+    def render_samples(self, labelvalues, state):
+        return ["{0}_total{1} {2}".format(self.name, format_labels(self.labelnames, labelvalues),
+                                          format_value(state))]
+
+
+class Gauge(Metric):
+    """
+    Value which can go up and down
+    """
+    TYPE = "gauge"
+
+    def set(self, value, **labels):
+        labelvalues = self.get_labelvalues(labels)
+        with self.lock:
+            self.samples[labelvalues] = value
+
+    def render_samples(self, labelvalues, state):
+        return ["{0}{1} {2}".format(self.name, format_labels(self.labelnames, labelvalues),
+                                    format_value(state))]
+
+
+class Histogram(Metric):
+    """
+    Histogram with cumulative buckets
+    """
+    TYPE = "histogram"
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, value, **labels):
+        labelvalues = self.get_labelvalues(labels)
+        with self.lock:
+            state = self.samples.get(labelvalues)
+            if state is None:
+                # [count per bucket..., sum]
+                state = self.samples[labelvalues] = [0] * len(self.buckets) + [0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[i] += 1
+                    break
+            state[-1] += value
+
+    def time(self, **labels):
+        """
+        Context manager observing elapsed seconds
+        """
+        return Timer(self, labels)
+
+    def render_samples(self, labelvalues, state):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, state):
+            cumulative += count
+            lines.append("{0}_bucket{1} {2}".format(
+                self.name, format_labels(self.labelnames, labelvalues, ("le", format_bound(bound))),
+                cumulative))
+        labels = format_labels(self.labelnames, labelvalues)
+        lines.append("{0}_count{1} {2}".format(self.name, labels, cumulative))
+        lines.append("{0}_sum{1} {2}".format(self.name, labels, format_value(state[-1])))
+        return lines
+
+
+class Timer(object):
+    """
+    Observe seconds spent in a with block into a Histogram
+    """
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+        self.start_time = None
+
+    def __enter__(self):
+        self.start_time = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.time() - self.start_time, **self.labels)
+
+
+class MetricsRegistry(object):
+    """
+    Collection of metrics rendered together
+    """
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self.register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=Histogram.DEFAULT_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self, openmetrics=True):
+        """
+        Render all metrics
+
+        :param openmetrics: OpenMetrics if True, or Prometheus text format
+                            understood by node_exporter textfile collector
+        :return: text
+        """
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render(openmetrics))
+        if openmetrics:
+            lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+    def write_textfile(self, path):
+        """
+        Write metrics for node_exporter textfile collector atomically
+        """
+        import tempfile
+        text = self.render(openmetrics=False)
+        try:
+            fd, tmp_path = tempfile.mkstemp(prefix=".ddns-metrics-",
+                                            dir=os.path.dirname(os.path.abspath(path)))
+            with os.fdopen(fd, "w") as tmp_file:
+                tmp_file.write(text)
+            # textfile collector needs it readable by node_exporter user
+            os.chmod(tmp_path, 0o644)
+            replace_file(tmp_path, path)
+        except (IOError, OSError) as ex:
+            # utils imports this module
+            from utils import DDNSUtils
+            DDNSUtils.err("Failed writing metrics file {0}: {1}".format(path, ex))
+
+
+REGISTRY = MetricsRegistry()
+
+API_REQUESTS = REGISTRY.counter(
+    "ddns_api_requests", "Aliyun API requests by action and http status code",
+    ("action", "code"))
+API_REQUEST_DURATION = REGISTRY.histogram(
+    "ddns_api_request_duration_seconds", "Aliyun API request latency by action",
+    ("action",))
+API_RETRIES = REGISTRY.counter(
+    "ddns_api_retries", "Aliyun API requests retried on connection or gateway errors",
+    ("action",))
+UPDATE_THROTTLED = REGISTRY.counter(
+    "ddns_update_throttled", "UpdateDomainRecord calls rejected by flow control")
+DNS_LOOKUPS = REGISTRY.counter(
+    "ddns_dns_lookups", "DomainRecord DNS lookups by result", ("result",))
+DNS_LOOKUP_DURATION = REGISTRY.histogram(
+    "ddns_dns_lookup_duration_seconds", "Seconds spent in one single or batched DNS lookup",
+    ("mode",))
+PUBLIC_IP_DISCOVERIES = REGISTRY.counter(
+    "ddns_public_ip_discoveries", "Public IP discoveries by result", ("result",))
+PUBLIC_IP_DISCOVERY_DURATION = REGISTRY.histogram(
+    "ddns_public_ip_discovery_duration_seconds", "Seconds spent discovering public IP")
+PUBLIC_IP_PROVIDER_REQUESTS = REGISTRY.counter(
+    "ddns_public_ip_provider_requests", "Public IP provider queries by provider and result",
+    ("provider", "result"))
+LOG_MESSAGES_DROPPED = REGISTRY.counter(
+    "ddns_log_messages_dropped", "Log messages dropped because output is blocked")
+RECORDS = REGISTRY.counter(
+    "ddns_records", "Reconciled DomainRecords by status", ("status",))
+RECORD_RECONCILE_DURATION = REGISTRY.histogram(
+    "ddns_record_reconcile_duration_seconds",
+    "Seconds spent resolving, fetching and comparing one DomainRecord")
+SYNC_DURATION = REGISTRY.gauge(
+    "ddns_sync_duration_seconds", "Seconds spent in the last sync cycle")
+LAST_SYNC_TIME = REGISTRY.gauge(
+    "ddns_last_sync_timestamp_seconds", "Time the last sync cycle finished")
+LAST_SUCCESS_TIME = REGISTRY.gauge(
+    "ddns_last_success_timestamp_seconds", "Time the last sync cycle without failures finished")
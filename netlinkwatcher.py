@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+ Copyright (C) 2010-2013, Ryan Fan
+
+ This program is free software; you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation; either version 2 of the License, or
+ (at your option) any later version.
+
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU Library General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with this program; if not, write to the Free Software
+ Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+"""
+import errno
+import socket
+import struct
+import threading
+import time
+
+from utils import DDNSUtils
+
+# from linux/netlink.h and linux/rtnetlink.h
+NETLINK_ROUTE = 0
+RTMGRP_IPV4_IFADDR = 0x10
+RTMGRP_IPV6_IFADDR = 0x100
+RTM_NEWADDR = 20
+RTM_DELADDR = 21
+NLMSG_DONE = 3
+
+# struct nlmsghdr: length, type, flags, seq, pid
+NLMSG_HEADER = struct.Struct("=LHHLL")
+# struct ifaddrmsg: family, prefixlen, flags, scope, index
+IFADDR_MESSAGE = struct.Struct("=BBBBL")
+
+# the socket itself is gone, reading it again can't succeed
+FATAL_ERRNOS = frozenset((errno.EBADF, errno.ENOTSOCK, errno.EINVAL, errno.EFAULT))
+# seconds to wait before reading again after a transient error
+ERROR_BACKOFF = 1.0
+
+
+class NetlinkSource(object):
+    """
+    rtnetlink socket subscribed to IPv4/IPv6 address notifications
+    """
+    def __init__(self):
+        self.sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE) # pylint: disable=no-member
+        self.sock.bind((0, RTMGRP_IPV4_IFADDR | RTMGRP_IPV6_IFADDR))
+
+    def recv(self):
+        """
+        Block until next batch of netlink messages arrives
+
+        :return: bytes
+        """
+        return self.sock.recv(65536)
+
+    def close(self):
+        """
+        Close netlink socket
+        """
+        self.sock.close()
+
+
+def parse_address_messages(data):
+    """
+    Parse RTM_NEWADDR/RTM_DELADDR messages in netlink data
+
+    :param data: bytes received from netlink socket
+    :return: list of (message type, address family, interface index)
+    """
+    events = []
+    offset = 0
+    while offset + NLMSG_HEADER.size <= len(data):
+        msg_len, msg_type, _, _, _ = NLMSG_HEADER.unpack_from(data, offset)
+        if msg_len < NLMSG_HEADER.size or msg_type == NLMSG_DONE:
+            break
+
+        if msg_type in (RTM_NEWADDR, RTM_DELADDR) and \
+           msg_len >= NLMSG_HEADER.size + IFADDR_MESSAGE.size:
+            family, _, _, _, index = IFADDR_MESSAGE.unpack_from(data, offset + NLMSG_HEADER.size)
+            events.append((msg_type, family, index))
+
+        # messages are aligned to 4 bytes
+        offset += (msg_len + 3) & ~3
+
+    return events
+
+
+def get_interface_name(index):
+    """
+    Get interface name by index, the index is returned as name if the
+    interface doesn't exist any more
+
+    :param index: interface index
+    :return: interface name
+    """
+    try:
+        return socket.if_indextoname(index)
+    except (OSError, AttributeError):
+        return str(index)
+
+
+class NetlinkAddressWatcher(object):
+    """
+    Watch interface address changes, callback is called with the set of
+    changed interface names once no more changes arrive in debounce seconds,
+    or with None if notifications were lost and any interface may have changed
+    """
+    def __init__(self, callback, debounce=2.0, source=None):
+        """
+        :param callback: function accepting a set of interface names or None
+        :param debounce: seconds to wait for a flapping link to settle
+        :param source:   object with recv() and close(), default is NetlinkSource
+        """
+        self.callback = callback
+        self.debounce = debounce
+        self.source = source
+        self.condition = threading.Condition()
+        self.pending_ifnames = set()
+        self.full_sync = False
+        self.last_event_time = 0
+        self.running = False
+        self.threads = []
+
+    def start(self):
+        """
+        Start reader and debouncer threads
+        """
+        if self.source is None:
+            self.source = NetlinkSource()
+
+        self.running = True
+        for target in (self.read_loop, self.debounce_loop):
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        """
+        Stop watching
+        """
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        self.source.close()
+
+    def read_loop(self):
+        """
+        Read netlink messages and queue changed interfaces
+        """
+        while self.running:
+            try:
+                data = self.source.recv()
+            except (OSError, socket.error) as ex:
+                if not self.running:
+                    break
+                if ex.errno == errno.ENOBUFS:
+                    # the kernel dropped notifications we were too slow to read
+                    DDNSUtils.info("Netlink notifications were lost, syncing all interfaces")
+                    self.queue_changes(None)
+                    continue
+                if ex.errno in FATAL_ERRNOS:
+                    DDNSUtils.err("Stopped watching address changes, " \
+                                  "failed reading netlink socket: {0}".format(ex))
+                    break
+                DDNSUtils.err("Failed reading netlink socket: {0}".format(ex))
+                time.sleep(ERROR_BACKOFF)
+                continue
+
+            if not data:
+                break
+
+            ifnames = set(get_interface_name(index)
+                          for _, _, index in parse_address_messages(data))
+            if ifnames:
+                self.queue_changes(ifnames)
+
+    def queue_changes(self, ifnames):
+        """
+        Queue changed interfaces for the debouncer
+
+        :param ifnames: set of interface names, None to sync all interfaces
+        """
+        with self.condition:
+            if ifnames is None:
+                self.full_sync = True
+            else:
+                self.pending_ifnames.update(ifnames)
+            self.last_event_time = time.time()
+            self.condition.notify_all()
+
+    def debounce_loop(self):
+        """
+        Call callback when queued changes settle down
+        """
+        while True:
+            with self.condition:
+                while self.running and not (self.pending_ifnames or self.full_sync):
+                    self.condition.wait()
+
+                # keep waiting while new changes keep coming
+                while self.running:
+                    remaining = self.last_event_time + self.debounce - time.time()
+                    if remaining <= 0:
+                        break
+                    self.condition.wait(remaining)
+
+                if not self.running:
+                    return
+
+                ifnames = None if self.full_sync else self.pending_ifnames
+                self.pending_ifnames = set()
+                self.full_sync = False
+
+            try:
+                self.callback(ifnames)
+            except Exception as ex: # pylint: disable=broad-except
+                DDNSUtils.err("Failed handling address changes of {0}: {1}"
+                              .format(", ".join(sorted(ifnames or ["all interfaces"])), ex))
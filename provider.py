@@ -0,0 +1,346 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+ Copyright (C) 2010-2013, Ryan Fan
+
+ This program is free software; you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation; either version 2 of the License, or
+ (at your option) any later version.
+
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU Library General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with this program; if not, write to the Free Software
+ Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+"""
+import itertools
+import json
+import os
+import threading
+
+from utils import DDNSUtils
+from config import is_aliyun_provider
+from record import RemoteDomainRecord
+
+# os.rename is atomic on POSIX but can't overwrite on Windows
+replace_file = getattr(os, "replace", os.rename)
+
+
+class DNSProvider(object):
+    """
+    Backend holding remote DomainRecords, DDNSDomainRecordManager and the
+    reconcilers only talk to DNS servers through this interface
+    """
+    # whether update_records() applies a whole batch at once, so that the
+    # update scheduler needn't pace and retry updates one by one
+    BATCH_UPDATES = False
+    # whether the records are served by public DNS servers, so that resolving
+    # a record tells its current value without asking the backend
+    SERVED_BY_DNS = False
+
+    def iter_zone_records(self, domainname):
+        """
+        Stream all DomainRecords of a zone
+
+        :param domainname: domain name
+        :return: generator of RemoteDomainRecord
+        """
+        raise NotImplementedError
+
+    def get_record(self, record_id):
+        """
+        Get one DomainRecord by its id
+
+        :param record_id: RecordId
+        :return: RemoteDomainRecord or None if there is no such record
+        """
+        raise NotImplementedError
+
+    def search_records(self, domainname, rr, record_type):
+        """
+        Find DomainRecords with the given name and type
+
+        :return: list of RemoteDomainRecord, or None if the zone can't be listed
+        """
+        return [remote_record for remote_record in self.iter_zone_records(domainname)
+                if remote_record.rr == rr and remote_record.type == record_type]
+
+    def update_record(self, remote_record, value, record_type, ttl=None, line=None,
+                      priority=None):
+        """
+        Point a DomainRecord to value, TTL, line and priority are sent as given
+
+        :param remote_record: RemoteDomainRecord
+        :return: True or False
+        :raise ThrottlingError: if the backend asks to slow down
+        """
+        raise NotImplementedError
+
+    def update_records(self, updates):
+        """
+        Run several updates, one by one unless the backend can batch them
+
+        :param updates: list of (RemoteDomainRecord, value, record type, dict of
+                        ttl, line and priority)
+        :return: dict of RecordId -> True or False
+        """
+        return dict((remote_record.recordid,
+                     self.update_record(remote_record, value, record_type, **settings))
+                    for remote_record, value, record_type, settings in updates)
+
+    def close(self):
+        """
+        Release connections or files held by the provider
+        """
+
+
+class AliyunProvider(DNSProvider):
+    """
+    Aliyun DNS through YunResolver, or any resolver with the same methods
+    """
+    SERVED_BY_DNS = True
+
+    def __init__(self, resolver):
+        self.resolver = resolver
+
+    @staticmethod
+    def to_remote_record(domain_record_info):
+        """
+        Create RemoteDomainRecord from Aliyun API record info
+
+        :param domain_record_info: dict of record info
+        :return: RemoteDomainRecord
+        """
+        get = domain_record_info.get
+        return RemoteDomainRecord(get('DomainName'), get('RecordId'), get('RR'), get('Type'),
+                                  get('Value'), ttl=get('TTL'), priority=get('Priority'),
+                                  line=get('Line'), status=get('Status'),
+                                  locked=get('Locked', False))
+
+    def iter_zone_records(self, domainname):
+        for rec in self.resolver.iter_domain_records(domainname):
+            yield self.to_remote_record(rec)
+
+    def get_record(self, record_id):
+        domain_record_info = self.resolver.describe_domain_record_info(record_id)
+        if not domain_record_info:
+            return None
+        return self.to_remote_record(domain_record_info)
+
+    def search_records(self, domainname, rr, record_type):
+        # Aliyun use fuzzy matching pattern for RR and type keyword
+        fuzzy_matched_list = self.resolver.describe_domain_records(domainname,
+                                                                   rr_keyword=rr,
+                                                                   type_keyword=record_type)
+        if not fuzzy_matched_list:
+            return None
+
+        return [remote_record for remote_record in map(self.to_remote_record, fuzzy_matched_list)
+                if remote_record.key == (domainname, rr, record_type)]
+
+    def update_record(self, remote_record, value, record_type, ttl=None, line=None,
+                      priority=None):
+        return self.resolver.update_domain_record(remote_record.recordid,
+                                                  rr=remote_record.rr,
+                                                  record_value=value,
+                                                  record_type=record_type,
+                                                  ttl=ttl, line=line, priority=priority)
+
+    def close(self):
+        self.resolver.close()
+
+
+class MemoryProvider(DNSProvider):
+    """
+    DomainRecords kept in memory, for offline runs and tests
+    """
+    BATCH_UPDATES = True
+    FIELDS = ('domain', 'record_id', 'rr', 'type', 'value', 'ttl', 'line', 'priority')
+
+    def __init__(self, records=None):
+        """
+        :param records: list of dict with keys in FIELDS, record_id is given if missing
+        """
+        self.lock = threading.Lock()
+        # RecordId -> RemoteDomainRecord
+        self.records = {}
+        # domainname -> list of RecordId in insertion order
+        self.zones = {}
+        self.record_ids = itertools.count(1)
+        for rec in records or []:
+            self.add_record(rec)
+
+    def add_record(self, rec):
+        """
+        Add a DomainRecord
+
+        :param rec: dict with keys in FIELDS
+        :return: RemoteDomainRecord
+        """
+        with self.lock:
+            record_id = str(rec.get('record_id') or "")
+            while not record_id or record_id in self.records:
+                record_id = str(next(self.record_ids))
+            remote_record = RemoteDomainRecord(rec['domain'], record_id, rec['rr'],
+                                               rec.get('type') or "A", rec.get('value'),
+                                               ttl=rec.get('ttl'), line=rec.get('line'),
+                                               priority=rec.get('priority'))
+            self.records[record_id] = remote_record
+            self.zones.setdefault(remote_record.domainname, []).append(record_id)
+            return remote_record
+
+    def get_records(self):
+        """
+        Dump all DomainRecords
+
+        :return: list of dict with keys in FIELDS
+        """
+        with self.lock:
+            return [dict(zip(self.FIELDS, (rec.domainname, rec.recordid, rec.rr, rec.type,
+                                           rec.value, rec.ttl, rec.line, rec.priority)))
+                    for rec in self.records.values()]
+
+    def iter_zone_records(self, domainname):
+        with self.lock:
+            remote_records = [self.records[record_id]
+                              for record_id in self.zones.get(domainname, [])]
+        # hand out copies so that updates never change records callers hold
+        for remote_record in remote_records:
+            yield self.copy_record(remote_record)
+
+    def get_record(self, record_id):
+        with self.lock:
+            remote_record = self.records.get(record_id)
+        return self.copy_record(remote_record) if remote_record else None
+
+    @staticmethod
+    def copy_record(remote_record):
+        return RemoteDomainRecord(remote_record.domainname, remote_record.recordid,
+                                  remote_record.rr, remote_record.type, remote_record.value,
+                                  ttl=remote_record.ttl, priority=remote_record.priority,
+                                  line=remote_record.line)
+
+    def apply_update(self, remote_record, value, record_type, ttl=None, line=None,
+                     priority=None):
+        """
+        Update a record in memory, lock must be held
+
+        :return: True or False if the record doesn't exist any more
+        """
+        current = self.records.get(remote_record.recordid)
+        if current is None:
+            return False
+
+        current.type = record_type
+        current.value = value
+        if ttl is not None:
+            current.ttl = ttl
+        if line is not None:
+            current.line = line
+        if priority is not None:
+            current.priority = priority
+        current.key = (current.domainname, current.rr, current.type)
+        return True
+
+    def update_record(self, remote_record, value, record_type, ttl=None, line=None,
+                      priority=None):
+        return self.update_records([(remote_record, value, record_type,
+                                     dict(ttl=ttl, line=line, priority=priority))]
+                                  )[remote_record.recordid]
+
+    def update_records(self, updates):
+        with self.lock:
+            return dict((remote_record.recordid,
+                         self.apply_update(remote_record, value, record_type, **settings))
+                        for remote_record, value, record_type, settings in updates)
+
+
+class FileProvider(MemoryProvider):
+    """
+    DomainRecords kept in a JSON file, which is read once and written back
+    atomically after every batch of updates
+    """
+    def __init__(self, path):
+        """
+        :param path: JSON file holding a list of records, see MemoryProvider
+        :raise ValueError: if the file doesn't exist or can't be read
+        """
+        self.path = path
+        # serializes updating and writing back, so a failed write can be undone
+        self.save_lock = threading.Lock()
+        if not os.path.isfile(path):
+            raise ValueError("Failed reading DomainRecords from {0}: no such file".format(path))
+        try:
+            with open(path) as records_file:
+                records = json.load(records_file)
+        except (IOError, OSError, ValueError) as ex:
+            raise ValueError("Failed reading DomainRecords from {0}: {1}".format(path, ex))
+        if not isinstance(records, list):
+            raise ValueError("Failed reading DomainRecords from {0}: " \
+                             "a list of records is expected".format(path))
+        try:
+            super(FileProvider, self).__init__(records)
+        except (KeyError, TypeError, AttributeError) as ex:
+            raise ValueError("Invalid DomainRecord in {0}: {1!r}".format(path, ex))
+
+    def save(self):
+        """
+        Write all DomainRecords to file atomically
+        """
+        tmp_path = "{0}.{1}.tmp".format(self.path, os.getpid())
+        try:
+            with open(tmp_path, "w") as records_file:
+                json.dump(self.get_records(), records_file, indent=2, sort_keys=True)
+            replace_file(tmp_path, self.path)
+        except (IOError, OSError):
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def update_records(self, updates):
+        """
+        Update records in memory and write them back, records are restored
+        in memory if the file can't be written so both stay the same
+        """
+        with self.save_lock:
+            with self.lock:
+                snapshot = dict((remote_record.recordid,
+                                 self.copy_record(self.records[remote_record.recordid]))
+                                for remote_record, _, _, _ in updates
+                                if remote_record.recordid in self.records)
+            results = super(FileProvider, self).update_records(updates)
+            if any(results.values()):
+                try:
+                    self.save()
+                except (IOError, OSError) as ex:
+                    with self.lock:
+                        self.records.update(snapshot)
+                    DDNSUtils.err("Failed writing DomainRecords to {0}: {1}".format(self.path, ex))
+                    return dict((record_id, False) for record_id in results)
+            return results
+
+
+def create_dns_provider(spec, resolver_factory):
+    """
+    Create provider from spec string: "aliyun", "memory" or "file:///path/to/records.json"
+
+    :param spec: provider spec
+    :param resolver_factory: function returning the resolver of an Aliyun provider
+    :return: DNSProvider
+    :raise ValueError: if the spec is unknown or the file can't be read
+    """
+    if is_aliyun_provider(spec):
+        return AliyunProvider(resolver_factory())
+
+    spec = spec.strip()
+    if spec == "memory":
+        return MemoryProvider()
+
+    if spec.startswith("file://"):
+        return FileProvider(spec[len("file://"):])
+
+    raise ValueError("Unknown DNS provider: {0}".format(spec))
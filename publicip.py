@@ -0,0 +1,335 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+ Copyright (C) 2010-2013, Ryan Fan
+
+ This program is free software; you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation; either version 2 of the License, or
+ (at your option) any later version.
+
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU Library General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with this program; if not, write to the Free Software
+ Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+"""
+import os
+import socket
+import struct
+import sys
+import threading
+import time
+if sys.version_info < (3,):
+    import Queue as queue
+else:
+    import queue
+
+from utils import DDNSUtils
+from ifaddrs import InterfaceAddressSnapshot, ANY_POLICY
+from metrics import PUBLIC_IP_DISCOVERIES, PUBLIC_IP_DISCOVERY_DURATION, \
+    PUBLIC_IP_PROVIDER_REQUESTS
+
+DEFAULT_PROVIDERS = [
+    "http://members.3322.org/dyndns/getip",
+    "https://api.ipify.org",
+    "https://ipv4.icanhazip.com",
+]
+
+STUN_MAGIC_COOKIE = 0x2112A442
+STUN_BINDING_REQUEST = 0x0001
+STUN_BINDING_RESPONSE = 0x0101
+STUN_MAPPED_ADDRESS = 0x0001
+STUN_XOR_MAPPED_ADDRESS = 0x0020
+
+
+def is_ipv4_address(value):
+    """
+    Check whether value is an IPv4 address in dotted notation
+    """
+    try:
+        return socket.inet_ntoa(socket.inet_aton(value)) == value
+    except (socket.error, TypeError, ValueError):
+        return False
+
+
+class PublicIPProvider(object):
+    """
+    Base class of public IP sources
+    """
+    def __init__(self, name):
+        self.name = name
+
+    def get_ip(self, timeout):
+        """
+        Get public IP
+
+        :param timeout: seconds
+        :return: IP address
+        :raise Exception: if it failed
+        """
+        raise NotImplementedError
+
+
+class HTTPProvider(PublicIPProvider):
+    """
+    HTTP echo service responding public IP in plain text, queried by urllib
+    so that a run finding nothing to change doesn't import requests
+    """
+    def __init__(self, url):
+        super(HTTPProvider, self).__init__(url)
+        self.url = url
+
+    def get_ip(self, timeout):
+        if sys.version_info < (3,):
+            from urllib2 import urlopen
+        else:
+            from urllib.request import urlopen
+
+        # non-2xx status is raised as HTTPError
+        response = urlopen(self.url, timeout=timeout)
+        try:
+            return response.read().decode('utf-8').strip()
+        finally:
+            response.close()
+
+
+class STUNProvider(PublicIPProvider):
+    """
+    STUN server, public IP is read from the mapped address of a binding request
+    """
+    def __init__(self, host, port=3478):
+        super(STUNProvider, self).__init__("stun://{0}:{1}".format(host, port))
+        self.host = host
+        self.port = port
+
+    def get_ip(self, timeout):
+        transaction_id = os.urandom(12)
+        request = struct.pack("!HHI", STUN_BINDING_REQUEST, 0, STUN_MAGIC_COOKIE) + transaction_id
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            sock.settimeout(timeout)
+            sock.sendto(request, (self.host, self.port))
+            data = sock.recv(2048)
+        finally:
+            sock.close()
+
+        msg_type, msg_len, cookie = struct.unpack_from("!HHI", data, 0)
+        if msg_type != STUN_BINDING_RESPONSE or cookie != STUN_MAGIC_COOKIE or \
+           data[8:20] != transaction_id:
+            raise ValueError("unexpected STUN response")
+
+        offset = 20
+        while offset + 4 <= min(len(data), 20 + msg_len):
+            attr_type, attr_len = struct.unpack_from("!HH", data, offset)
+            value = data[offset + 4:offset + 4 + attr_len]
+            # family 0x01 is IPv4
+            if attr_type in (STUN_XOR_MAPPED_ADDRESS, STUN_MAPPED_ADDRESS) and \
+               attr_len >= 8 and struct.unpack_from("!B", value, 1)[0] == 0x01:
+                address = struct.unpack_from("!I", value, 4)[0]
+                if attr_type == STUN_XOR_MAPPED_ADDRESS:
+                    address ^= STUN_MAGIC_COOKIE
+                return socket.inet_ntoa(struct.pack("!I", address))
+            # attributes are padded to 4 bytes
+            offset += 4 + ((attr_len + 3) & ~3)
+
+        raise ValueError("no mapped address in STUN response")
+
+
+class InterfaceProvider(PublicIPProvider):
+    """
+    IPv4 address of a local interface
+    """
+    def __init__(self, ifname, interface_addresses=None):
+        """
+        :param ifname: interface name
+        :param interface_addresses: InterfaceAddressSnapshot shared with the
+                                    reconciler, default is a new one per query
+        """
+        super(InterfaceProvider, self).__init__("nic://{0}".format(ifname))
+        self.ifname = ifname
+        self.interface_addresses = interface_addresses
+
+    def get_ip(self, timeout):
+        interface_addresses = self.interface_addresses or InterfaceAddressSnapshot()
+        ip_addr = interface_addresses.get_address(self.ifname, socket.AF_INET, ANY_POLICY)
+        if ip_addr is None:
+            raise LookupError("No IPv4 address on the interface {0}".format(self.ifname))
+        return ip_addr
+
+
+def create_provider(spec, interface_addresses=None):
+    """
+    Create provider from spec string:
+    http(s)://... for echo service, stun://host[:port] and nic://ifname
+
+    :param spec: provider spec
+    :param interface_addresses: InterfaceAddressSnapshot nic:// providers read
+    :return: PublicIPProvider
+    :raise ValueError: if the spec is unknown or invalid
+    """
+    spec = spec.strip()
+    if spec.startswith("http://") or spec.startswith("https://"):
+        return HTTPProvider(spec)
+
+    if spec.startswith("stun://"):
+        host, _, port = spec[len("stun://"):].partition(":")
+        try:
+            port = int(port) if port else 3478
+        except ValueError:
+            port = None
+        if not host or port is None or not 0 < port < 65536:
+            raise ValueError("Invalid STUN server: {0}".format(spec))
+        return STUNProvider(host, port)
+
+    if spec.startswith("nic://"):
+        if not spec[len("nic://"):]:
+            raise ValueError("Missing interface name: {0}".format(spec))
+        return InterfaceProvider(spec[len("nic://"):], interface_addresses)
+
+    raise ValueError("Unknown public IP provider: {0}".format(spec))
+
+
+class PublicIPDiscovery(object):
+    """
+    Query several public IP providers concurrently, the first answer, or the
+    first one confirmed by quorum providers, wins. Providers are tried in
+    order of their past latency and reliability, and the result is cached.
+    """
+    # weight of the latest sample in latency moving average
+    LATENCY_WEIGHT = 0.3
+
+    def __init__(self, providers, quorum=1, parallel=2, timeout=5, cache_ttl=60):
+        """
+        :param providers: list of PublicIPProvider
+        :param quorum:    number of providers which must agree
+        :param parallel:  number of providers queried at the same time
+        :param timeout:   seconds to wait in total
+        :param cache_ttl: seconds to reuse discovered IP
+        """
+        self.providers = providers
+        self.quorum = max(1, quorum)
+        self.parallel = max(self.quorum, parallel)
+        self.timeout = timeout
+        self.cache_ttl = cache_ttl
+
+        self.lock = threading.Lock()
+        # provider name -> [average latency, failures in a row]
+        self.stats = dict((p.name, [0.0, 0]) for p in providers)
+        self.cached_ip = None
+        self.cached_time = 0
+
+    def get_ordered_providers(self):
+        """
+        Get providers ordered by failures first, then average latency
+
+        :return: list of PublicIPProvider
+        """
+        with self.lock:
+            return sorted(self.providers,
+                          key=lambda p: (self.stats[p.name][1], self.stats[p.name][0]))
+
+    def record_result(self, provider, latency, succeeded):
+        """
+        Update provider's latency and failure stats
+        """
+        PUBLIC_IP_PROVIDER_REQUESTS.inc(provider=provider.name,
+                                        result="ok" if succeeded else "error")
+        with self.lock:
+            stats = self.stats[provider.name]
+            if succeeded:
+                if stats[0]:
+                    stats[0] += self.LATENCY_WEIGHT * (latency - stats[0])
+                else:
+                    stats[0] = latency
+                stats[1] = 0
+            else:
+                stats[1] += 1
+
+    def query(self, provider, results):
+        """
+        Query one provider and put (provider, IP or None, error) into results
+        """
+        start_time = time.time()
+        try:
+            ip_addr = provider.get_ip(self.timeout)
+            if not is_ipv4_address(ip_addr):
+                raise ValueError("invalid IP address: {0!r}".format(ip_addr[:64]))
+        except Exception as ex: # pylint: disable=broad-except
+            self.record_result(provider, time.time() - start_time, False)
+            results.put((provider, None, ex))
+            return
+
+        self.record_result(provider, time.time() - start_time, True)
+        results.put((provider, ip_addr, None))
+
+    def get_ip(self, use_cache=True):
+        """
+        Get current public IP
+
+        :param use_cache: return cached IP if it's not expired
+        :return: IP address or None
+        """
+        if use_cache and self.cached_ip and time.time() - self.cached_time < self.cache_ttl:
+            return self.cached_ip
+
+        with PUBLIC_IP_DISCOVERY_DURATION.time():
+            ip_addr = self.discover()
+        PUBLIC_IP_DISCOVERIES.inc(result="ok" if ip_addr else "error")
+        if ip_addr:
+            self.cached_ip = ip_addr
+            self.cached_time = time.time()
+        return ip_addr
+
+    def discover(self):
+        """
+        Race providers, one more provider is started whenever one finishes
+        without reaching quorum
+
+        :return: IP address or None
+        """
+        providers = self.get_ordered_providers()
+        results = queue.Queue()
+        votes = {}
+        launched = finished = 0
+
+        def launch():
+            thread = threading.Thread(target=self.query, args=(providers[launched], results))
+            # stragglers must not keep the process alive
+            thread.daemon = True
+            thread.start()
+
+        while launched < min(self.parallel, len(providers)):
+            launch()
+            launched += 1
+
+        deadline = time.time() + self.timeout
+        while finished < launched:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                provider, ip_addr, error = results.get(timeout=remaining)
+            except queue.Empty:
+                break
+            finished += 1
+
+            if ip_addr:
+                votes[ip_addr] = votes.get(ip_addr, 0) + 1
+                if votes[ip_addr] >= self.quorum:
+                    return ip_addr
+            else:
+                DDNSUtils.err("Failed to get current public IP from {0}: {1}"
+                              .format(provider.name, error))
+
+            if launched < len(providers):
+                launch()
+                launched += 1
+
+        if votes:
+            DDNSUtils.err("Public IP providers don't agree: {0}".format(votes))
+        return None
@@ -0,0 +1,751 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+ Copyright (C) 2010-2013, Ryan Fan
+
+ This program is free software; you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation; either version 2 of the License, or
+ (at your option) any later version.
+
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU Library General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with this program; if not, write to the Free Software
+ Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+"""
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from utils import DDNSUtils
+from config import DEFAULT_ACCOUNT
+from record import RemoteDomainRecord
+from ifaddrs import InterfaceAddressSnapshot, ANY_POLICY
+from state import DDNSStateCache
+from dnsclient import DNSClient
+from scheduler import TokenBucket, UpdateScheduler
+from publicip import PublicIPDiscovery, DEFAULT_PROVIDERS, create_provider
+from metrics import REGISTRY, RECORDS, RECORD_RECONCILE_DURATION, SYNC_DURATION, LAST_SYNC_TIME, \
+    LAST_SUCCESS_TIME
+
+PLAN_VERSION = 1
+# actions of records in a plan
+PLAN_SKIP = "skip"
+PLAN_UPDATE = "update"
+PLAN_ERROR = "error"
+
+
+class DDNSReconciler(object):
+    """
+    Reconcile LocalDomainRecords with remote DomainRecords on DNS providers,
+    records are processed by a bounded worker pool
+    """
+    SKIPPED = "skipped"
+    UPDATED = "updated"
+    FAILED = "failed"
+    PENDING = "pending"
+
+    # why a record is skipped, updated or failed, given in message fields and plans
+    REASON_STATE_FRESH = "state_fresh"
+    REASON_DNS_MATCH = "dns_match"
+    REASON_REMOTE_MATCH = "remote_match"
+    REASON_CHANGED = "changed"
+    REASON_NOT_FOUND = "not_found"
+    REASON_NO_ADDRESS = "no_address"
+    REASON_ERROR = "error"
+
+    # a zone with more records than this to look up in a cycle is listed
+    # once, instead of one DescribeDomainRecordInfo call per known RecordId
+    ZONE_FETCH_THRESHOLD = 3
+
+    def __init__(self, config, record_manager):
+        self.config = config
+        self.record_manager = record_manager
+        self.max_workers = max(1, config.max_workers)
+        self.max_workers_per_zone = max(1, config.max_workers_per_zone)
+
+        self.lock = threading.Lock()
+        # domainname -> semaphore limiting concurrent API calls on the zone
+        self.zone_semaphores = {}
+        # domainname -> lock making sure a zone is fetched only once per cycle
+        self.zone_locks = {}
+        self.fetched_zones = set()
+        # zones listed on first lookup in current cycle, see get_bulk_zones()
+        self.bulk_zones = set()
+
+        self.dns_client = DNSClient(nameservers=config.nameservers, timeout=config.dns_timeout,
+                                    port=config.dns_port)
+
+        # addresses of local interfaces, enumerated once per cycle
+        self.interface_addresses = InterfaceAddressSnapshot()
+
+        try:
+            providers = [create_provider(spec, self.interface_addresses)
+                         for spec in config.public_ip_providers or DEFAULT_PROVIDERS]
+        except ValueError as ex:
+            DDNSUtils.err_and_exit("Invalid config: {0}".format(ex))
+        self.public_ip_discovery = PublicIPDiscovery(providers,
+                                                     quorum=config.public_ip_quorum,
+                                                     parallel=config.public_ip_parallel,
+                                                     timeout=config.public_ip_timeout,
+                                                     cache_ttl=config.public_ip_cache_ttl)
+
+        # the buckets live as long as the reconciler to pace updates across
+        # cycles, every account is limited on its own by Aliyun
+        self.update_bucket = TokenBucket(config.api_qps, config.api_burst)
+        self.update_buckets = dict((name, TokenBucket(account.api_qps, account.api_burst))
+                                   for name, account in config.accounts.items()
+                                   if name != DEFAULT_ACCOUNT)
+        self.scheduler = UpdateScheduler(record_manager, self.update_bucket,
+                                         max_workers=self.max_workers,
+                                         max_retries=config.update_max_retries,
+                                         retry_backoff=config.update_retry_backoff,
+                                         get_zone_semaphore=self.get_zone_semaphore,
+                                         get_bucket=self.get_update_bucket)
+
+        self.state = None
+        if config.state_file:
+            self.state = DDNSStateCache(config.state_file, config.state_refresh_interval)
+            self.state.load()
+
+    def get_current_public_ip(self):
+        """
+        Get current public ip for this server
+
+        :return: IP address or None
+        """
+        # nic:// public IP providers read the snapshot as well
+        self.interface_addresses.clear()
+        if self.config.pifn_enable:
+            try:
+                return self.interface_addresses.get_address(self.config.pifn_interface,
+                                                            socket.AF_INET, ANY_POLICY)
+            except LookupError as ex:
+                DDNSUtils.err(str(ex))
+                return None
+
+        return self.public_ip_discovery.get_ip()
+
+    def write_metrics(self):
+        """
+        Write metrics to textfile collector file if it is configured
+        """
+        if self.config.metrics_textfile:
+            REGISTRY.write_textfile(self.config.metrics_textfile)
+
+    def get_update_bucket(self, account):
+        """
+        Get the TokenBucket pacing updates of an account
+
+        :param account: account name
+        :return: TokenBucket
+        """
+        return self.update_buckets.get(account, self.update_bucket)
+
+    def get_zone_semaphore(self, domainname):
+        """
+        Get the semaphore limiting concurrent API calls against a zone
+
+        :param domainname: domain name
+        :return: threading.BoundedSemaphore
+        """
+        with self.lock:
+            if domainname not in self.zone_semaphores:
+                self.zone_semaphores[domainname] = \
+                    threading.BoundedSemaphore(self.max_workers_per_zone)
+            return self.zone_semaphores[domainname]
+
+    def fetch_zone(self, local_record):
+        """
+        Fetch all remote records of the LocalDomainRecord's zone, only the
+        first caller in a cycle does the fetching, others wait for it
+
+        :param local_record: LocalDomainRecord
+        """
+        domainname = local_record.domainname
+        with self.lock:
+            zone_lock = self.zone_locks.setdefault(domainname, threading.Lock())
+
+        with zone_lock:
+            if domainname in self.fetched_zones:
+                return
+
+            with self.get_zone_semaphore(domainname):
+                self.record_manager.fetch_remote_records([local_record])
+            self.fetched_zones.add(domainname)
+
+    def remember(self, local_record, value, recordid=None):
+        """
+        Save record's value, which is just pushed or verified, to state cache
+
+        :param local_record: LocalDomainRecord
+        :param value:        record value
+        :param recordid:     RecordId
+        """
+        if recordid:
+            self.record_manager.remember_record_id(local_record, recordid)
+        if self.state is not None and value:
+            self.state.update(local_record, value, recordid)
+
+    def get_record_id(self, local_record):
+        """
+        Get RecordId of LocalDomainRecord known by record manager or state cache
+
+        :param local_record: LocalDomainRecord
+        :return: RecordId or None
+        """
+        recordid = self.record_manager.get_record_id(local_record)
+        if not recordid and self.state is not None:
+            recordid = self.state.get_recordid(local_record)
+        return recordid
+
+    def forget_record_id(self, local_record):
+        """
+        Forget stale RecordId of LocalDomainRecord
+
+        :param local_record: LocalDomainRecord
+        """
+        self.record_manager.forget_record_id(local_record)
+        if self.state is not None:
+            self.state.invalidate_recordid(local_record)
+
+    def find_remote_record(self, local_record):
+        """
+        Find RemoteDomainRecord of LocalDomainRecord, the known RecordId is
+        tried first and the whole zone is fetched only if it is missing or
+        stale, or if many records of the zone are looked up in this cycle
+
+        :param local_record: LocalDomainRecord
+        :return: RemoteDomainRecord or None
+        """
+        # zone listed in this cycle already, no need to ask again
+        if local_record.domainname in self.fetched_zones:
+            return self.record_manager.find_remote_record(local_record)
+
+        recordid = None
+        if local_record.domainname not in self.bulk_zones:
+            recordid = self.get_record_id(local_record)
+        if recordid:
+            with self.get_zone_semaphore(local_record.domainname):
+                remote_record = self.record_manager.fetch_remote_record_by_id(recordid,
+                                                                              local_record)
+            if remote_record:
+                return remote_record
+            self.forget_record_id(local_record)
+
+        # Remote records are fetched zone by zone rather than one query per record
+        self.fetch_zone(local_record)
+        return self.record_manager.find_remote_record(local_record)
+
+    def get_current_ip(self, local_record, current_public_ip):
+        """
+        Get the IP LocalDomainRecord should point to, "AAAA" records take the
+        address their policy picks from the interface snapshot of this cycle
+
+        :param local_record: LocalDomainRecord
+        :param current_public_ip: current public IP
+        :return: IP address or None
+        """
+        if local_record.type == "AAAA":
+            try:
+                return self.interface_addresses.get_address(local_record.interface,
+                                                            socket.AF_INET6,
+                                                            local_record.address_policy)
+            except LookupError:
+                return None
+
+        return current_public_ip
+
+    def can_resolve(self, local_record):
+        """
+        Whether a DNS answer can tell that LocalDomainRecord needs no update:
+        records with TTL, line or priority given are left out as DNS answers
+        can't tell them, and so are records of DNS providers no public DNS
+        server knows about, like memory and file
+
+        :param local_record: LocalDomainRecord
+        :return: True or False
+        """
+        return not local_record.has_settings() and \
+            self.record_manager.get_provider(local_record.domainname).SERVED_BY_DNS
+
+    def get_bulk_zones(self, local_record_list, current_public_ip, dns_resolved_ips):
+        """
+        Find zones where more than ZONE_FETCH_THRESHOLD records will need
+        their remote record in this cycle, those that are neither fresh in
+        state cache nor matched by DNS answers
+
+        :param local_record_list: list of LocalDomainRecord
+        :param current_public_ip: current public IP
+        :param dns_resolved_ips: IP addresses resolved by resolve_records()
+        :return: set of domain names
+        """
+        # domainname -> number of records to look up
+        lookups = {}
+        for local_record in local_record_list:
+            current_ip = self.get_current_ip(local_record, current_public_ip)
+            if not current_ip:
+                continue
+            if self.state is not None and self.state.is_fresh(local_record, current_ip):
+                continue
+            if self.can_resolve(local_record) and \
+               dns_resolved_ips.get(local_record.key) == current_ip:
+                continue
+            lookups[local_record.domainname] = lookups.get(local_record.domainname, 0) + 1
+
+        return set(domainname for domainname, count in lookups.items()
+                   if count > self.ZONE_FETCH_THRESHOLD)
+
+    def resolve_records(self, local_record_list, current_public_ip):
+        """
+        Resolve LocalDomainRecords which are not fresh in state cache and can
+        be resolved at all, see can_resolve(). All queries are pipelined in
+        one batch
+
+        :param local_record_list: list of LocalDomainRecord
+        :param current_public_ip: current public IP
+        :return: dict of (domainname, rr, type) -> IP address or None
+        """
+        local_record_list = [rec for rec in local_record_list if self.can_resolve(rec)]
+        if self.state is not None:
+            local_record_list = [
+                rec for rec in local_record_list
+                if not self.state.is_fresh(rec, self.get_current_ip(rec, current_public_ip))]
+
+        if not local_record_list:
+            return {}
+
+        # records left unresolved are compared against the API instead
+        try:
+            return DDNSUtils.get_dns_resolved_ips(local_record_list, dns_client=self.dns_client)
+        except Exception as ex: # pylint: disable=broad-except
+            DDNSUtils.err("Failed resolving DomainRecords in batch: {0}".format(ex))
+            return {}
+
+    def check_current_ip(self, local_record, current_ip):
+        """
+        Decide what needs no lookup at all: there is no address to point the
+        record to, or the same IP was pushed or verified lately
+
+        :param local_record: LocalDomainRecord
+        :param current_ip: IP the record should point to, None if unknown
+        :return: result like reconcile_record(), or None if lookups are needed
+        """
+        name = "[{rec.subdomain}.{rec.domainname}]".format(rec=local_record)
+        if not current_ip:
+            return self.FAILED, [(True, "Failed getting address of interface {0} for " \
+                                  "DomainRecord{1}".format(local_record.interface, name),
+                                  {"reason": self.REASON_NO_ADDRESS})], None
+
+        # we pushed or verified the same IP lately, no need to look up anything
+        if self.state is not None and self.state.is_fresh(local_record, current_ip):
+            return self.SKIPPED, [(False, "Skipped as no changes since last sync for " \
+                                   "DomainRecord" + name,
+                                   {"reason": self.REASON_STATE_FRESH})], None
+        return None
+
+    def check_dns_answer(self, local_record, current_ip, dns_resolved_ip):
+        """
+        Decide from the DNS answer of a record which can_resolve()
+
+        :param local_record: LocalDomainRecord
+        :param current_ip: IP the record should point to
+        :param dns_resolved_ip: IP address resolved or None
+        :return: result like reconcile_record(), or None if the remote record
+                 is needed
+        """
+        if current_ip != dns_resolved_ip:
+            return None
+
+        self.remember(local_record, current_ip)
+        return self.SKIPPED, [(False, "Skipped as no changes for DomainRecord" \
+                               "[{rec.subdomain}.{rec.domainname}]".format(rec=local_record),
+                               {"reason": self.REASON_DNS_MATCH})], None
+
+    def check_remote_record(self, local_record, current_ip, remote_record):
+        """
+        Decide from the remote record, any field differing from what we expect
+        makes a pending update for the update scheduler
+
+        :param local_record: LocalDomainRecord
+        :param current_ip: IP the record should point to
+        :param remote_record: RemoteDomainRecord or None if it is not found
+        :return: result like reconcile_record()
+        """
+        name = "[{rec.subdomain}.{rec.domainname}]".format(rec=local_record)
+        if not remote_record:
+            return self.FAILED, [(True, "Failed finding remote DomainRecord" + name,
+                                  {"reason": self.REASON_NOT_FOUND})], None
+
+        changes = local_record.diff(remote_record, current_ip)
+        if not changes:
+            self.remember(local_record, current_ip, remote_record.recordid)
+            return self.SKIPPED, [(False, "Skipped as we already updated DomainRecord" + name,
+                                   {"reason": self.REASON_REMOTE_MATCH})], None
+
+        return self.PENDING, [(False, "DomainRecord{0} changes: {1}".format(
+            name, self.format_changes(changes)),
+                               {"old_value": remote_record.value, "new_value": current_ip,
+                                "changes": sorted(changes), "reason": self.REASON_CHANGED})], \
+            (remote_record, current_ip)
+
+    def reconcile_record(self, local_record, current_public_ip, dns_resolved_ips=None):
+        """
+        Run resolve/fetch/update pipeline for one LocalDomainRecord, decisions
+        are made by the check_*() helpers shared with the asyncio reconciler
+
+        :param local_record: LocalDomainRecord
+        :param current_public_ip: current public IP
+        :param dns_resolved_ips: IP addresses resolved in batch by resolve_records()
+        :return: tuple of (status, list of (is_error, message[, fields]), pending
+                 update of (RemoteDomainRecord, value) or None)
+        """
+        current_ip = self.get_current_ip(local_record, current_public_ip)
+        result = self.check_current_ip(local_record, current_ip)
+        if result is not None:
+            return result
+
+        # DNS answers only tell the value, TTL, line and priority need the API
+        if self.can_resolve(local_record):
+            key = local_record.key
+            if dns_resolved_ips is not None and key in dns_resolved_ips:
+                dns_resolved_ip = dns_resolved_ips[key]
+            else:
+                dns_resolved_ip = DDNSUtils.get_dns_resolved_ip(local_record.subdomain,
+                                                                local_record.domainname,
+                                                                local_record.type,
+                                                                dns_client=self.dns_client)
+            result = self.check_dns_answer(local_record, current_ip, dns_resolved_ip)
+            if result is not None:
+                return result
+
+        # If current public IP doesn't equal to current DNS resolved ip, only in three cases:
+        # 1. The new synced IP for remote record in Aliyun doesn't take effect yet
+        # 2. remote record's IP in Aliyun server has changed
+        # 3. current public IP is changed
+        remote_record = self.find_remote_record(local_record)
+        return self.check_remote_record(local_record, current_ip, remote_record)
+
+    @staticmethod
+    def format_changes(changes):
+        """
+        Format changes returned by LocalDomainRecord.diff()
+
+        :param changes: dict of field -> (old, new)
+        :return: string like "value 1.1.1.1 -> 2.2.2.2, ttl 600 -> 60"
+        """
+        return ", ".join("{0} {1} -> {2}".format(field, old, new)
+                         for field, (old, new) in sorted(changes.items()))
+
+    def finish_update(self, local_record, remote_record, value, sync_result):
+        """
+        Get result of a scheduled update
+
+        :return: tuple of (status, list of (is_error, message))
+        """
+        name = "[{rec.subdomain}.{rec.domainname}]".format(rec=local_record)
+        if not sync_result:
+            return self.FAILED, [(True, "Failed updating DomainRecord" + name)]
+
+        self.remember(local_record, value, remote_record.recordid)
+        return self.UPDATED, [(False, "Successfully updated DomainRecord" + name,
+                               {"old_value": remote_record.value, "new_value": value})]
+
+    def safe_reconcile_record(self, local_record, current_public_ip, dns_resolved_ips=None):
+        """
+        Reconcile one LocalDomainRecord, turning unexpected errors into a failed
+        result so that one bad record won't abort the others
+        """
+        try:
+            with RECORD_RECONCILE_DURATION.time():
+                return self.reconcile_record(local_record, current_public_ip, dns_resolved_ips)
+        except Exception as ex: # pylint: disable=broad-except
+            return self.FAILED, [(True, "Failed reconciling DomainRecord" \
+                                  "[{rec.subdomain}.{rec.domainname}]: {ex}"
+                                  .format(rec=local_record, ex=ex),
+                                  {"reason": self.REASON_ERROR})], None
+
+    def record_metrics(self, statuses, start_time):
+        """
+        Count reconciled records and time the cycle
+
+        :param statuses: list of record status
+        :param start_time: time the cycle started
+        """
+        for status in statuses:
+            RECORDS.inc(status=status)
+
+        now = time.time()
+        SYNC_DURATION.set(now - start_time)
+        LAST_SYNC_TIME.set(now)
+        if self.FAILED not in statuses:
+            LAST_SUCCESS_TIME.set(now)
+
+    @staticmethod
+    def log_messages(local_record, status, messages, duration=None):
+        """
+        Output messages of one LocalDomainRecord with the record's fields
+
+        :param local_record: LocalDomainRecord
+        :param status:       record status
+        :param messages:     list of (is_error, message[, fields])
+        :param duration:     seconds spent on the record
+        """
+        fields = {"alias": local_record.alias, "domain": local_record.domainname,
+                  "rr": local_record.rr, "type": local_record.type, "status": status}
+        if duration is not None:
+            fields["duration"] = round(duration, 6)
+
+        for message in messages:
+            message_fields = dict(fields, **message[2]) if len(message) > 2 else fields
+            if message[0]:
+                DDNSUtils.err(message[1], **message_fields)
+            else:
+                DDNSUtils.info(message[1], **message_fields)
+
+    def detect(self, current_public_ip, local_record_list):
+        """
+        Resolve, fetch and compare LocalDomainRecords without updating any of
+        them, DNS lookups are done in one batch and zones are fetched once
+
+        :param current_public_ip: current public IP
+        :param local_record_list: list of LocalDomainRecord
+        :return: tuple of (list of reconcile_record() results, list of seconds
+                 spent on each record)
+        """
+        self.fetched_zones = set()
+        self.interface_addresses.clear()
+        dns_resolved_ips = self.resolve_records(local_record_list, current_public_ip)
+        self.bulk_zones = self.get_bulk_zones(local_record_list, current_public_ip,
+                                              dns_resolved_ips)
+        durations = [None] * len(local_record_list)
+
+        def run(i):
+            record_start_time = time.time()
+            result = self.safe_reconcile_record(local_record_list[i], current_public_ip,
+                                                dns_resolved_ips)
+            durations[i] = time.time() - record_start_time
+            return result
+
+        if self.max_workers == 1 or len(local_record_list) <= 1:
+            results = [run(i) for i in range(len(local_record_list))]
+        else:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                results = list(executor.map(run, range(len(local_record_list))))
+
+        return results, durations
+
+    def run_updates(self, updates, results):
+        """
+        Run queued updates in one batch at the pace Aliyun allows
+
+        :param updates: list of (index in results, LocalDomainRecord, RemoteDomainRecord, value)
+        :param results: list of (status, messages, update), results of updates
+                        are merged into it
+        """
+        for _, local_record, remote_record, value in updates:
+            self.scheduler.submit(local_record, remote_record, value)
+        update_results = self.scheduler.run()
+
+        for i, local_record, remote_record, value in updates:
+            sync_result = update_results.get(remote_record.recordid, False)
+            status, update_messages = self.finish_update(local_record, remote_record, value,
+                                                         sync_result)
+            results[i] = (status, results[i][1] + update_messages, None)
+
+    def reconcile(self, current_public_ip, local_record_list=None):
+        """
+        Reconcile LocalDomainRecords, messages are output in the order of
+        local records no matter in which order they are processed
+
+        :param current_public_ip: current public IP
+        :param local_record_list: list of LocalDomainRecord, default is all
+        :return: list of (LocalDomainRecord, status)
+        """
+        if local_record_list is None:
+            local_record_list = self.record_manager.local_record_list
+
+        start_time = time.time()
+        results, durations = self.detect(current_public_ip, local_record_list)
+        self.run_updates([(i, local_record, update[0], update[1])
+                          for i, (local_record, (_, _, update)) in
+                          enumerate(zip(local_record_list, results)) if update is not None],
+                         results)
+
+        if self.state is not None:
+            self.state.save()
+        self.record_metrics([status for status, _, _ in results], start_time)
+
+        for local_record, (status, messages, _), duration in \
+                zip(local_record_list, results, durations):
+            self.log_messages(local_record, status, messages, duration)
+
+        return [(rec, status) for rec, (status, _, _) in zip(local_record_list, results)]
+
+    @staticmethod
+    def get_plan_entry(local_record, status, messages, update):
+        """
+        Describe what reconcile() would do with one LocalDomainRecord
+
+        :param local_record: LocalDomainRecord
+        :param status:       record status returned by reconcile_record()
+        :param messages:     list of (is_error, message[, fields])
+        :param update:       pending update of (RemoteDomainRecord, value) or None
+        :return: dict which can be dumped as JSON
+        """
+        entry = {"alias": local_record.alias, "domain": local_record.domainname,
+                 "rr": local_record.rr, "type": local_record.type,
+                 "account": local_record.account, "reason": None, "message": None}
+        if messages:
+            entry["message"] = messages[-1][1]
+            if len(messages[-1]) > 2:
+                entry["reason"] = messages[-1][2].get("reason")
+
+        if update is None:
+            entry["action"] = PLAN_ERROR if status == DDNSReconciler.FAILED else PLAN_SKIP
+            return entry
+
+        remote_record, value = update
+        entry["action"] = PLAN_UPDATE
+        entry["new_value"] = value
+        entry["changes"] = dict((field, [old, new]) for field, (old, new) in
+                                local_record.diff(remote_record, value).items())
+        entry["remote"] = {"record_id": remote_record.recordid, "value": remote_record.value,
+                           "ttl": remote_record.ttl, "line": remote_record.line,
+                           "priority": remote_record.priority}
+        return entry
+
+    def plan(self, current_public_ip, local_record_list=None):
+        """
+        Work out what reconcile() would change without changing anything, no
+        update is sent and the state cache file is left untouched
+
+        :param current_public_ip: current public IP
+        :param local_record_list: list of LocalDomainRecord, default is all
+        :return: plan dict which can be dumped as JSON and given to apply()
+        """
+        if local_record_list is None:
+            local_record_list = self.record_manager.local_record_list
+
+        start_time = time.time()
+        results, _ = self.detect(current_public_ip, local_record_list)
+        records = [self.get_plan_entry(local_record, status, messages, update)
+                   for local_record, (status, messages, update) in
+                   zip(local_record_list, results)]
+
+        summary = dict((action, 0) for action in (PLAN_SKIP, PLAN_UPDATE, PLAN_ERROR))
+        for entry in records:
+            summary[entry["action"]] += 1
+
+        return {"version": PLAN_VERSION, "created": int(start_time),
+                "duration": round(time.time() - start_time, 6),
+                "public_ip": current_public_ip, "summary": summary, "records": records}
+
+    def check_plan(self, plan, current_public_ip=None):
+        """
+        Check that a plan is still current enough to be applied
+
+        :param plan: plan dict
+        :param current_public_ip: current public IP, not checked if None
+        :raise ValueError: if the plan is too old or the public IP has changed
+        """
+        created = plan.get("created")
+        if not isinstance(created, (int, float)):
+            raise ValueError("no creation time in plan")
+
+        age = time.time() - created
+        if self.config.plan_max_age and age > self.config.plan_max_age:
+            raise ValueError("plan is {0:.0f} seconds old, plan_max_age is {1}".format(
+                age, self.config.plan_max_age))
+
+        if current_public_ip is not None and plan.get("public_ip") != current_public_ip:
+            raise ValueError("public IP changed from {0} to {1} since the plan was made".format(
+                plan.get("public_ip"), current_public_ip))
+
+    def get_planned_update(self, entry):
+        """
+        Rebuild the update of a plan entry against the current config
+
+        :param entry: plan entry made by get_plan_entry()
+        :return: tuple of (LocalDomainRecord, RemoteDomainRecord, value)
+        :raise ValueError: if the entry is malformed or doesn't match config
+        """
+        try:
+            key = (entry["domain"], entry["rr"], entry["type"])
+            remote = entry["remote"]
+            remote_record = RemoteDomainRecord(key[0], remote["record_id"], key[1], key[2],
+                                               remote["value"], ttl=remote["ttl"],
+                                               priority=remote["priority"], line=remote["line"])
+            value = entry["new_value"]
+            changes = entry["changes"]
+        except (KeyError, TypeError) as ex:
+            raise ValueError("malformed plan entry: {0!r}".format(ex))
+
+        local_record = self.record_manager.local_record_index.get(key)
+        if local_record is None:
+            raise ValueError("not found in config")
+        if not remote_record.recordid:
+            raise ValueError("no RecordId in plan")
+
+        # settings sent along with the update come from config, refuse if
+        # config has changed since the plan was made
+        expected = dict((field, list(change)) for field, change in
+                        local_record.diff(remote_record, value).items())
+        if expected != changes:
+            raise ValueError("config changed since the plan was made")
+
+        return local_record, remote_record, value
+
+    def apply(self, plan, current_public_ip=None):
+        """
+        Run updates of a plan made by plan(), all of them are batched in the
+        update scheduler, entries which are not updates are ignored. Nothing
+        is updated if the plan is stale, see check_plan()
+
+        :param plan: plan dict
+        :param current_public_ip: current public IP the plan must be made for
+        :return: list of (LocalDomainRecord, status)
+        """
+        if not isinstance(plan, dict) or plan.get("version") != PLAN_VERSION:
+            DDNSUtils.err_and_exit("Unsupported plan, version {0} expected".format(PLAN_VERSION))
+
+        start_time = time.time()
+        local_record_list = []
+        results = []
+        updates = []
+        statuses = []
+        for entry in plan.get("records", []):
+            if not isinstance(entry, dict) or entry.get("action") != PLAN_UPDATE:
+                continue
+
+            try:
+                self.check_plan(plan, current_public_ip)
+                local_record, remote_record, value = self.get_planned_update(entry)
+            except ValueError as ex:
+                DDNSUtils.err("Skipped DomainRecord[{0}.{1}] in plan: {2}".format(
+                    entry.get("rr"), entry.get("domain"), ex),
+                              alias=entry.get("alias"), domain=entry.get("domain"),
+                              rr=entry.get("rr"), type=entry.get("type"), status=self.FAILED)
+                statuses.append(self.FAILED)
+                continue
+
+            updates.append((len(results), local_record, remote_record, value))
+            local_record_list.append(local_record)
+            results.append((self.PENDING, [], None))
+
+        self.run_updates(updates, results)
+
+        if self.state is not None:
+            self.state.save()
+        statuses.extend(status for status, _, _ in results)
+        self.record_metrics(statuses, start_time)
+
+        for local_record, (status, messages, _) in zip(local_record_list, results):
+            self.log_messages(local_record, status, messages)
+
+        return [(rec, status) for rec, (status, _, _) in zip(local_record_list, results)]
@@ -17,95 +17,381 @@
  along with this program; if not, write to the Free Software
  Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
 """
-import sys
-if sys.version_info < (3,):
-    import string
-    def lower_func(s):
-        return string.lower(s)
-else:
-    def lower_func(s):
-        return str.lower(s)
+import threading
 
 from utils import DDNSUtils
-from yunresolver import YunResolver
+from config import DEFAULT_ACCOUNT
+from yunresolver import YunResolver, VALID_TTLS, VALID_PRIORITIES, VALID_LINES
+from ifaddrs import AddressPolicy, SCOPE_GLOBAL, PREFER_STABLE
+
+# same as ConfigParser.getboolean()
+BOOLEAN_STATES = {'1': True, 'yes': True, 'true': True, 'on': True,
+                  '0': False, 'no': False, 'false': False, 'off': False}
 
 class LocalDomainRecord(object):# pylint: disable=too-few-public-methods
     """
     Local domain record created from config file
     """
     VALID_TYPES = ('A', 'AAAA')
+    # fixed fields keep 10k+ records compact
+    __slots__ = ('alias', 'domainname', 'rr', 'type', 'interface', 'recordid',
+                 'update_priority', 'ttl', 'line', 'priority', 'account', 'address_policy',
+                 'key')
+
+    def __init__(self, config, section, options=None):
+        """
+        :param config:  DDNSConfig
+        :param section: section name, or alias of a record in record set
+        :param options: options of the record, read from section if not given
+        """
+        if options is None:
+            options = config.get_section_options(section)
 
-    def __init__(self, config, section):
         # set the local record alias to be section
         self.alias = section
-        self.domainname = config.get_option_value(section, "domain")
-        self.rr = self.subdomain = config.get_option_value(section, "sub_domain")
-        self.type = config.get_option_value(section, "type", default="A")
-        self.interface = config.get_option_value(section, "interface", default="eno1")
+        self.domainname = options.get("domain") or None
+        self.rr = options.get("sub_domain") or None
+        self.type = options.get("type") or "A"
+        self.interface = options.get("interface") or "eno1"
+        # optional RecordId in Aliyun, it is learned at runtime if not given
+        self.recordid = options.get("record_id") or None
+        # optional TTL, line and priority, remote ones are kept if not given
+        self.line = options.get("line") or None
+        # Aliyun account owning the domain
+        self.account = options.get("account") or DEFAULT_ACCOUNT
+
+        # all problems of the record are reported at once
+        errors = []
+        # records with higher update_priority are updated first
+        self.update_priority = self.get_int_option(options, "update_priority", errors) or 0
+        self.ttl = self.get_int_option(options, "ttl", errors)
+        self.priority = self.get_int_option(options, "priority", errors)
 
         if not self.domainname:
-            raise ValueError("Failed initializing LocalDomainRecord: " \
-                             "Invalid domain in config file.")
+            errors.append("invalid domain")
 
         if not self.rr:
-            raise ValueError("Failed initializing LocalDomainRecord: " \
-                             "Invalid sub_domain in config file.")
+            errors.append("invalid sub_domain")
 
         if self.type.upper() not in self.VALID_TYPES:
-            raise ValueError("Failed initializing LocalDomainRecord: " \
-                            "Invalid type in config file.")
+            errors.append("invalid type {0}".format(self.type))
+
+        if self.ttl is not None and self.ttl not in VALID_TTLS:
+            errors.append("invalid ttl {0}".format(self.ttl))
+
+        if self.line is not None and self.line not in VALID_LINES:
+            errors.append("invalid line {0}".format(self.line))
+
+        if self.priority is not None and self.priority not in VALID_PRIORITIES:
+            errors.append("invalid priority {0}".format(self.priority))
+
+        if self.account not in config.accounts:
+            errors.append("unknown account {0}".format(self.account))
+
+        # how the address of an "AAAA" record is picked out of the interface's
+        self.address_policy = self.get_address_policy(options, errors)
+
+        if errors:
+            raise ValueError("Failed initializing LocalDomainRecord {0}: {1}".format(
+                section, ", ".join(errors)))
+
+        # index key shared with RemoteDomainRecord
+        self.key = (self.domainname, self.rr, self.type)
+
+    @property
+    def subdomain(self):
+        """
+        Alias of rr
+        """
+        return self.rr
+
+    @staticmethod
+    def get_int_option(options, option, errors):
+        """
+        Get optional integer option value
+
+        :param errors: list collecting the error if it is not an integer
+        :return: int or None
+        """
+        value = options.get(option)
+        if not value:
+            return None
+
+        try:
+            return int(value)
+        except ValueError:
+            errors.append("invalid {0} {1}".format(option, value))
+            return None
+
+    @staticmethod
+    def get_address_policy(options, errors):
+        """
+        Get the shared AddressPolicy of address_scope, address_prefer,
+        address_allow_deprecated and address_prefix options
+
+        :param errors: list collecting errors of invalid options
+        :return: AddressPolicy or None if it is invalid
+        """
+        allow_deprecated = options.get("address_allow_deprecated") or "false"
+        if allow_deprecated.lower() not in BOOLEAN_STATES:
+            errors.append("invalid address_allow_deprecated {0}".format(allow_deprecated))
+            allow_deprecated = "false"
+
+        try:
+            return AddressPolicy.get(scope=options.get("address_scope") or SCOPE_GLOBAL,
+                                     prefer=options.get("address_prefer") or PREFER_STABLE,
+                                     allow_deprecated=BOOLEAN_STATES[allow_deprecated.lower()],
+                                     prefix=options.get("address_prefix") or None)
+        except ValueError as ex:
+            errors.append(str(ex))
+            return None
+
+    def has_settings(self):
+        """
+        Whether TTL, line or priority is given, which DNS answers can't tell
+
+        :return: True or False
+        """
+        return any(setting is not None for setting in (self.ttl, self.line, self.priority))
+
+    def get_settings(self):
+        """
+        Get TTL, line and priority given in config
+
+        :return: list of [ttl, line, priority]
+        """
+        return [self.ttl, self.line, self.priority]
+
+    def diff(self, remote_record, value):
+        """
+        Compare all fields we manage against RemoteDomainRecord in one pass,
+        fields not given in config are not compared
+
+        :param remote_record: RemoteDomainRecord
+        :param value:         expected record value
+        :return: dict of field -> (remote value, expected value), empty if no changes
+        """
+        changes = {}
+        for field, expected in (('value', value), ('ttl', self.ttl),
+                                ('line', self.line), ('priority', self.priority)):
+            if expected is None:
+                continue
+
+            current = getattr(remote_record, field)
+            if field in ('ttl', 'priority') and current is not None:
+                current = int(current)
+            if current != expected:
+                changes[field] = (current, expected)
+
+        return changes
 
 class RemoteDomainRecord(object):# pylint: disable=too-many-instance-attributes, too-few-public-methods
     """
-    Remote domain record created from Aliyun server
+    Remote domain record created by a DNSProvider
     """
-    def __init__(self, domain_record_info):
-        self.domainname = None
-        self.recordid = None
-        self.rr = None
-        self.type = None
-        self.value = None
-        self.ttl = None
-        self.priority = None
-        self.line = None
-        self.status = None
-        self.locked = False
-
-        # convert json record key name to lowercased one
-        converted_domain_record_info = dict(zip(map(lower_func, domain_record_info.keys()),
-                                                domain_record_info.values()))
-
-        for k in converted_domain_record_info.keys():
-            self.__dict__[k] = converted_domain_record_info[k]
+    __slots__ = ('domainname', 'recordid', 'rr', 'type', 'value', 'ttl', 'priority',
+                 'line', 'status', 'locked', 'key')
+
+    def __init__(self, domainname, recordid, rr, record_type, value, ttl=None, priority=None,
+                 line=None, status=None, locked=False):# pylint: disable=too-many-arguments
+        self.domainname = domainname
+        self.recordid = recordid
+        self.rr = rr
+        self.type = record_type
+        self.value = value
+        self.ttl = ttl
+        self.priority = priority
+        self.line = line
+        self.status = status
+        self.locked = locked
+        self.key = (self.domainname, self.rr, self.type)
 
 
 class DDNSDomainRecordManager(object):
     """
     Manager class used to manage local domain record and remote domain records
     """
-    def __init__(self, config):
+    def __init__(self, config, resolver=None, providers=None, resolver_class=YunResolver):
+        """
+        :param config:         DDNSConfig
+        :param resolver:       resolver of the default account
+        :param providers:      dict of account name -> DNSProvider to reuse
+        :param resolver_class: class of resolvers created for Aliyun accounts
+        """
         self.config = config
-        self.resolver = YunResolver(self.config.access_id, self.config.access_key, self.config.debug)
+        self.resolver_class = resolver_class
+        # account name -> DNSProvider, Aliyun ones with their own connection pool
+        self.providers = dict(providers or {})
+        if resolver is not None:
+            self.providers[DEFAULT_ACCOUNT] = self.create_provider(
+                config.accounts.get(DEFAULT_ACCOUNT), resolver)
+        for name, account in self.config.accounts.items():
+            if name not in self.providers:
+                try:
+                    self.providers[name] = self.create_provider(account)
+                except ValueError as ex:
+                    DDNSUtils.err_and_exit("Invalid provider of account {0}: {1}".format(name, ex))
+        # domainname -> account name
+        self.zone_accounts = {}
         self.local_record_list = self.get_local_record_list()
+        # (domainname, rr, type) -> LocalDomainRecord
+        self.local_record_index = dict((local_record.key, local_record)
+                                       for local_record in self.local_record_list)
+        # (domainname, rr, type) -> list of RemoteDomainRecord
+        self.remote_record_index = {}
+        # domainname -> keys of the zone in remote_record_index
+        self.zone_keys = {}
+        # (domainname, rr, type) -> RecordId, given in config or learned from DNS provider
+        self.record_ids = {}
+        self.lock = threading.Lock()
+        for local_record in self.local_record_list:
+            if local_record.recordid:
+                self.remember_record_id(local_record, local_record.recordid)
+
+    @property
+    def resolvers(self):
+        """
+        Resolvers of accounts on Aliyun, by account name
+        """
+        return dict((name, provider.resolver) for name, provider in self.providers.items()
+                    if hasattr(provider, "resolver"))
+
+    @property
+    def resolver(self):
+        """
+        Resolver of the default account, or the only one if there is no default
+        """
+        resolvers = self.resolvers
+        if DEFAULT_ACCOUNT in resolvers:
+            return resolvers[DEFAULT_ACCOUNT]
+        return next(iter(resolvers.values()), None)
+
+    def create_resolver(self, account):
+        """
+        Create resolver of an account
+
+        :param account: DDNSAccount
+        :return: resolver_class instance
+        """
+        return self.resolver_class(account.access_id, account.access_key, self.config.debug,
+                                   pool_size=self.config.pool_size,
+                                   connect_timeout=self.config.connect_timeout,
+                                   read_timeout=self.config.read_timeout,
+                                   max_retries=self.config.max_retries,
+                                   retry_backoff=self.config.retry_backoff,
+                                   url=account.api_url)
+
+    def create_provider(self, account, resolver=None):
+        """
+        Create DNSProvider of an account
+
+        :param account: DDNSAccount
+        :param resolver: resolver to use if the account is on Aliyun
+        :return: DNSProvider
+        :raise ValueError: if the provider can't be created
+        """
+        # provider module builds RemoteDomainRecords of this module
+        from provider import create_dns_provider
+        spec = account.provider if account is not None else None
+        return create_dns_provider(spec, lambda: resolver or self.create_resolver(account))
+
+    def get_provider(self, domainname):
+        """
+        Get DNSProvider of the account owning a zone
+
+        :param domainname: domain name
+        :return: DNSProvider
+        """
+        return self.providers[self.zone_accounts.get(domainname, DEFAULT_ACCOUNT)]
+
+    def get_resolver(self, domainname):
+        """
+        Get resolver of the account owning a zone on Aliyun
+
+        :param domainname: domain name
+        :return: resolver
+        """
+        return self.get_provider(domainname).resolver
+
+    def close(self):
+        """
+        Close pooled connections and files of all accounts
+        """
+        for provider in self.providers.values():
+            provider.close()
 
     def get_local_record_list(self):
         """
-        Create local domain record objectes based on local config info
+        Create local domain record objectes based on local config info,
+        all invalid or duplicated definitions are reported in one pass
 
         :return: list of LocalDomainRecord objects
         """
         local_record_list = []
+        errors = []
+        seen_keys = set()
 
-        for section in self.config.get_domain_record_sections():
+        for alias, options in self.config.iter_domain_records(errors):
             try:
-                local_record = LocalDomainRecord(self.config, section)
-            except ValueError:
+                local_record = LocalDomainRecord(self.config, alias, options)
+            except ValueError as ex:
+                errors.append(str(ex))
+                continue
+
+            if local_record.key in seen_keys:
+                errors.append("Duplicated DomainRecord {0}: {1}.{2} {3} is already " \
+                              "defined".format(alias, local_record.rr, local_record.domainname,
+                                               local_record.type))
+                continue
+
+            # a zone belongs to exactly one account
+            account = self.zone_accounts.setdefault(local_record.domainname,
+                                                    local_record.account)
+            if account != local_record.account:
+                errors.append("Invalid DomainRecord {0}: domain {1} belongs to account " \
+                              "{2} already".format(alias, local_record.domainname, account))
                 continue
 
+            seen_keys.add(local_record.key)
             local_record_list.append(local_record)
 
+        for error in errors:
+            DDNSUtils.err(error)
+
         return local_record_list
 
+    def get_record_id(self, local_record):
+        """
+        Get known RecordId of LocalDomainRecord
+
+        :param   LocalDomainRecord
+        :return: RecordId or None
+        """
+        key = local_record.key
+        with self.lock:
+            return self.record_ids.get(key)
+
+    def remember_record_id(self, local_record, record_id):
+        """
+        Remember RecordId of LocalDomainRecord for later single-record lookups
+
+        :param   LocalDomainRecord
+        :param   RecordId
+        """
+        key = local_record.key
+        with self.lock:
+            self.record_ids[key] = record_id
+
+    def forget_record_id(self, local_record):
+        """
+        Forget stale RecordId of LocalDomainRecord
+
+        :param   LocalDomainRecord
+        """
+        key = local_record.key
+        with self.lock:
+            self.record_ids.pop(key, None)
+
     def find_local_record(self, remote_record):
         """
         Find LocalDomainRecord based on RemoteDomainRecord
@@ -113,60 +399,195 @@ class DDNSDomainRecordManager(object):
         :param   RemoteDomainRecord
         :return: LocalDomainRecord or None
         """
-        for local_record in self.local_record_list:
-            if all(getattr(local_record, attr) == getattr(remote_record, attr)
-                   for attr in ('domainname', 'rr', 'type')):
-                return local_record
+        return self.local_record_index.get(remote_record.key)
+
+    def iter_remote_records(self, domainname):
+        """
+        Stream all RemoteDomainRecords of a zone page by page
+
+        :param   domain name
+        :return: generator of RemoteDomainRecord
+        """
+        return self.get_provider(domainname).iter_zone_records(domainname)
+
+    def fetch_remote_records(self, local_record_list=None):
+        """
+        Fetch RemoteDomainRecords in bulk, one paged DescribeDomainRecords
+        listing per zone instead of one fuzzy query per LocalDomainRecord,
+        and index those matching LocalDomainRecords by (domainname, rr, type)
+
+        :param   list of LocalDomainRecord, default is all local records
+        :return: dict of (domainname, rr, type) -> list of RemoteDomainRecord
+        """
+        if local_record_list is None:
+            local_record_list = self.local_record_list
+
+        domainnames = []
+        for local_record in local_record_list:
+            if local_record.domainname not in domainnames:
+                domainnames.append(local_record.domainname)
+
+        for domainname in domainnames:
+            self.set_zone_records(domainname, self.iter_remote_records(domainname))
+
+        return self.remote_record_index
+
+    def set_zone_records(self, domainname, remote_records):
+        """
+        Replace indexed RemoteDomainRecords of a zone, only records matching
+        a LocalDomainRecord are kept so large zones don't stay in memory
+
+        :param domainname:      domain name
+        :param remote_records:  iterable of RemoteDomainRecord
+        """
+        zone_index = {}
+        for remote_record in remote_records:
+            key = remote_record.key
+            if key in self.local_record_index:
+                zone_index.setdefault(key, []).append(remote_record)
+
+        # zones may be fetched concurrently, swap the zone's entries at once
+        with self.lock:
+            for key in self.zone_keys.get(domainname, ()):
+                del self.remote_record_index[key]
+            self.remote_record_index.update(zone_index)
+            self.zone_keys[domainname] = list(zone_index)
+
+            # learn RecordIds of unambiguous records
+            for key, matched_list in zone_index.items():
+                if len(matched_list) == 1:
+                    self.record_ids[key] = matched_list[0].recordid
+
+    def find_remote_record(self, local_record):
+        """
+        Find RemoteDomainRecord for LocalDomainRecord in the index built by
+        fetch_remote_records()
+
+        :param    LocalDomainRecord
+        :return:  RemoteDomainRecord or None
+        """
+        key = local_record.key
+        matched_list = self.remote_record_index.get(key, [])
+        if not matched_list:
+            return None
+
+        if len(matched_list) > 1:
+            DDNSUtils.err("Duplicate DomainRecord in DNS provider: " \
+                          "{rec.subdomain}.{rec.domainname}".format(rec=local_record))
+            return None
+
+        return matched_list[0]
+
+    @staticmethod
+    def match_remote_record(remote_record, local_record):
+        """
+        Check RemoteDomainRecord still belongs to LocalDomainRecord
+
+        :param   RemoteDomainRecord or None
+        :param   LocalDomainRecord
+        :return: RemoteDomainRecord or None
+        """
+        if remote_record is not None and remote_record.key == local_record.key:
+            return remote_record
 
         return None
 
+    def fetch_remote_record_by_id(self, record_id, local_record):
+        """
+        Fetch RemoteDomainRecord by RecordId, which is much cheaper than
+        searching the zone
+
+        :param   RecordId
+        :param   LocalDomainRecord the RecordId is expected to belong to
+        :return: RemoteDomainRecord or None if the RecordId is stale
+        """
+        provider = self.get_provider(local_record.domainname)
+        remote_record = self.match_remote_record(provider.get_record(record_id), local_record)
+        if remote_record:
+            self.remember_record_id(local_record, record_id)
+        return remote_record
 
     def fetch_remote_record(self, local_record):
         """
-        Fetch RemoteDomainReord from Aliyun server by using LocalDomainRecord info
+        Fetch RemoteDomainReord from DNS provider by using LocalDomainRecord info,
+        known RecordId is looked up first, searching is used only if the
+        RecordId is missing or stale
 
         :param    LocalDomainRecord
         :return:  RemoteDomainRecord or None
         """
-        # Aliyun use fuzzy matching pattern for RR and type keyword
-        fuzzy_matched_list = self.resolver.describe_domain_records(local_record.domainname,
-                                                                   rr_keyword=local_record.rr,
-                                                                   type_keyword=local_record.type)
-        if not fuzzy_matched_list:
+        record_id = self.get_record_id(local_record)
+        if record_id:
+            remote_record = self.fetch_remote_record_by_id(record_id, local_record)
+            if remote_record:
+                return remote_record
+            self.forget_record_id(local_record)
+
+        provider = self.get_provider(local_record.domainname)
+        exact_matched_list = provider.search_records(local_record.domainname, local_record.rr,
+                                                     local_record.type)
+        if exact_matched_list is None:
             DDNSUtils.err("Failed to fetch remote DomainRecords.")
             return None
 
-        exact_matched_list = []
-        check_keys = ('DomainName', 'RR', 'Type')
-        for rec in fuzzy_matched_list:
-            if all(rec.get(key, None) == getattr(local_record, key.lower()) for key in check_keys):
-                exact_matched_list.append(rec)
-
         if not exact_matched_list:
             return None
 
         if len(exact_matched_list) > 1:
-            DDNSUtils.err("Duplicate DomainRecord in Aliyun: {rec.subdomain}.{rec.domainname}"
-                          .format(rec=local_record))
+            DDNSUtils.err("Duplicate DomainRecord in DNS provider: " \
+                          "{rec.subdomain}.{rec.domainname}".format(rec=local_record))
             return None
 
-        try:
-            remote_record = RemoteDomainRecord(exact_matched_list[0])
-        except Exception as ex:
-            raise ex
-
+        remote_record = exact_matched_list[0]
+        self.remember_record_id(local_record, remote_record.recordid)
         return remote_record
 
-    def update(self, remote_record, current_public_ip,record_type='A'):
+    @staticmethod
+    def get_update_settings(remote_record, ttl=None, line=None, priority=None):
+        """
+        Get TTL, line and priority to send along with an update, the ones not
+        given are taken from RemoteDomainRecord as they are, so that they
+        won't be reset
+
+        :param remote_record: RemoteDomainRecord
+        :return: dict of ttl, line and priority
+        """
+        if ttl is None and remote_record.ttl:
+            ttl = int(remote_record.ttl)
+        if line is None and remote_record.line:
+            line = remote_record.line
+        if priority is None and remote_record.priority:
+            priority = int(remote_record.priority)
+
+        return dict(ttl=ttl, line=line, priority=priority)
+
+    def update(self, remote_record, current_public_ip, record_type='A',
+               ttl=None, line=None, priority=None):
         """
-        Update RemoteDomainRecord 's value to current public IP on Aliyun server
+        Update RemoteDomainRecord 's value to current public IP on DNS provider,
+        TTL, line and priority not given are kept as they are on DNS provider
 
         :param  RemoteDomainRecord:
         :param  current public IP
         :return: True or False
         """
-        return self.resolver.update_domain_record(remote_record.recordid,
-                                                  rr=remote_record.rr,
-                                                  record_value=current_public_ip,
-                                                  record_type=record_type
-                                                  )
+        provider = self.get_provider(remote_record.domainname)
+        return provider.update_record(remote_record, current_public_ip, record_type,
+                                      **self.get_update_settings(remote_record,
+                                                                 ttl, line, priority))
+
+    def update_many(self, updates):
+        """
+        Update RemoteDomainRecords of one account in one batch
+
+        :param updates: list of (RemoteDomainRecord, value, record type, ttl, line, priority)
+        :return: dict of RecordId -> True or False
+        """
+        if not updates:
+            return {}
+
+        provider = self.get_provider(updates[0][0].domainname)
+        return provider.update_records([
+            (remote_record, value, record_type,
+             self.get_update_settings(remote_record, ttl, line, priority))
+            for remote_record, value, record_type, ttl, line, priority in updates])
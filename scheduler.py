@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+ Copyright (C) 2010-2013, Ryan Fan
+
+ This program is free software; you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation; either version 2 of the License, or
+ (at your option) any later version.
+
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU Library General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with this program; if not, write to the Free Software
+ Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+"""
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from utils import DDNSUtils
+from yunresolver import ThrottlingError
+from metrics import UPDATE_THROTTLED
+
+
+class TokenBucket(object):
+    """
+    Thread-safe token bucket rate limiter
+    """
+    def __init__(self, rate, burst=None):
+        """
+        :param rate:  tokens added per second
+        :param burst: bucket capacity, default is rate
+        """
+        self.rate = float(rate)
+        self.capacity = float(burst or max(1, rate))
+        self.tokens = self.capacity
+        self.last_time = time.time()
+        self.lock = threading.Lock()
+
+    def try_acquire(self):
+        """
+        Take one token if it is available, never blocks
+
+        :return: 0 if taken, or seconds until the next token is available
+        """
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.capacity, self.tokens + (now - self.last_time) * self.rate)
+            self.last_time = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    def acquire(self):
+        """
+        Take one token, block until it is available
+        """
+        while True:
+            wait = self.try_acquire()
+            if not wait:
+                return
+            time.sleep(wait)
+
+
+class UpdateJob(object):# pylint: disable=too-few-public-methods
+    """
+    Pending update of one RemoteDomainRecord
+    """
+    def __init__(self, local_record, remote_record, value, order):
+        self.local_record = local_record
+        self.remote_record = remote_record
+        self.value = value
+        self.order = order
+
+
+class UpdateScheduler(object):
+    """
+    Schedule UpdateDomainRecord calls: duplicate updates of the same record
+    are coalesced, critical records go first, calls are paced by a token
+    bucket of the record's account and retried with exponential backoff when
+    Aliyun throttles us. Accounts are updated concurrently so that a throttled
+    account won't hold back the others, accounts on DNS providers taking
+    batches get all their updates in one call
+    """
+    def __init__(self, record_manager, bucket, max_workers=1,
+                 max_retries=5, retry_backoff=1.0, get_zone_semaphore=None, get_bucket=None):
+        """
+        :param record_manager:     DDNSDomainRecordManager doing the updates
+        :param bucket:             TokenBucket, shared across runs
+        :param max_workers:        number of concurrent updates of an account
+        :param max_retries:        retries of a throttled update
+        :param retry_backoff:      seconds to wait before first retry
+        :param get_zone_semaphore: function returning semaphore of a zone
+        :param get_bucket:         function returning TokenBucket of an account,
+                                   bucket is used for all accounts if not given
+        """
+        self.record_manager = record_manager
+        self.bucket = bucket
+        self.get_bucket = get_bucket
+        self.max_workers = max(1, max_workers)
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.get_zone_semaphore = get_zone_semaphore
+        self.lock = threading.Lock()
+        # RecordId -> UpdateJob
+        self.jobs = {}
+
+    def submit(self, local_record, remote_record, value):
+        """
+        Queue an update, a later update of the same record replaces the earlier one
+
+        :param local_record:  LocalDomainRecord
+        :param remote_record: RemoteDomainRecord
+        :param value:         new value
+        """
+        with self.lock:
+            order = len(self.jobs)
+            if remote_record.recordid in self.jobs:
+                order = self.jobs[remote_record.recordid].order
+            self.jobs[remote_record.recordid] = UpdateJob(local_record, remote_record, value, order)
+
+    def execute(self, job):
+        """
+        Run one update, retrying when throttled
+
+        :param job: UpdateJob
+        :return: True or False
+        """
+        bucket = self.bucket
+        if self.get_bucket is not None:
+            bucket = self.get_bucket(job.local_record.account)
+
+        for attempt in range(self.max_retries + 1):
+            bucket.acquire()
+            try:
+                if self.get_zone_semaphore is None:
+                    return self.record_manager.update(job.remote_record, job.value,
+                                                      job.local_record.type,
+                                                      ttl=job.local_record.ttl,
+                                                      line=job.local_record.line,
+                                                      priority=job.local_record.priority)
+                with self.get_zone_semaphore(job.local_record.domainname):
+                    return self.record_manager.update(job.remote_record, job.value,
+                                                      job.local_record.type,
+                                                      ttl=job.local_record.ttl,
+                                                      line=job.local_record.line,
+                                                      priority=job.local_record.priority)
+            except ThrottlingError as ex:
+                UPDATE_THROTTLED.inc()
+                if attempt == self.max_retries:
+                    DDNSUtils.err("Gave up updating DomainRecord" \
+                                  "[{rec.subdomain}.{rec.domainname}] after {0} retries: {1}"
+                                  .format(attempt, ex, rec=job.local_record))
+                    return False
+
+                # exponential backoff with jitter so retries don't come in waves
+                time.sleep(self.retry_backoff * (2 ** attempt) * random.uniform(0.5, 1.5))
+            except Exception as ex: # pylint: disable=broad-except
+                # one broken update must not take down the others of the run
+                DDNSUtils.err("Failed updating DomainRecord[{rec.subdomain}.{rec.domainname}]: "
+                              "{0!r}".format(ex, rec=job.local_record))
+                return False
+
+        return False
+
+    def run_jobs(self, jobs):
+        """
+        Run jobs of one account in order with at most max_workers at a time
+
+        :param jobs: list of UpdateJob
+        :return: list of True or False
+        """
+        if jobs and self.record_manager.get_provider(
+                jobs[0].local_record.domainname).BATCH_UPDATES:
+            return self.run_batch(jobs)
+
+        if self.max_workers == 1 or len(jobs) <= 1:
+            return [self.execute(job) for job in jobs]
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            return list(executor.map(self.execute, jobs))
+
+    def run_batch(self, jobs):
+        """
+        Run jobs of one account at once, for DNS providers applying a batch of
+        updates together there is nothing to pace or retry
+
+        :param jobs: list of UpdateJob
+        :return: list of True or False
+        """
+        try:
+            results = self.record_manager.update_many([
+                (job.remote_record, job.value, job.local_record.type, job.local_record.ttl,
+                 job.local_record.line, job.local_record.priority) for job in jobs])
+        except Exception as ex: # pylint: disable=broad-except
+            DDNSUtils.err("Failed updating {0} DomainRecords of account {1}: {2!r}".format(
+                len(jobs), jobs[0].local_record.account, ex))
+            return [False] * len(jobs)
+        return [results.get(job.remote_record.recordid, False) for job in jobs]
+
+    def take_jobs(self):
+        """
+        Take queued jobs in priority order and clear the queue, for callers
+        running the updates themselves
+
+        :return: list of UpdateJob
+        """
+        with self.lock:
+            jobs = sorted(self.jobs.values(),
+                          key=lambda job: (-job.local_record.update_priority, job.order))
+            self.jobs = {}
+        return jobs
+
+    def run(self):
+        """
+        Run queued updates in priority order, then clear the queue
+
+        :return: dict of RecordId -> True or False
+        """
+        jobs = self.take_jobs()
+
+        # account name -> jobs in priority order
+        account_jobs = {}
+        for job in jobs:
+            account_jobs.setdefault(job.local_record.account, []).append(job)
+
+        if len(account_jobs) <= 1:
+            account_results = [self.run_jobs(jobs)]
+            account_jobs = [jobs]
+        else:
+            account_jobs = list(account_jobs.values())
+            with ThreadPoolExecutor(max_workers=len(account_jobs)) as executor:
+                account_results = list(executor.map(self.run_jobs, account_jobs))
+
+        return dict((job.remote_record.recordid, result)
+                    for jobs, results in zip(account_jobs, account_results)
+                    for job, result in zip(jobs, results))
@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+ Copyright (C) 2010-2013, Ryan Fan
+
+ This program is free software; you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation; either version 2 of the License, or
+ (at your option) any later version.
+
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU Library General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with this program; if not, write to the Free Software
+ Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+"""
+import sys
+if sys.version_info < (3,):
+    from urllib import quote_plus
+else:
+    from urllib.parse import quote_plus
+
+import hmac
+import re
+import hashlib
+import time
+import uuid
+from base64 import b64encode
+
+# "=" and "&" of the query string, quoted once more in the string to sign
+EQUALS = quote_plus("=")
+AMPERSAND = quote_plus("&")
+
+# chars never escaped by quote_plus, values made of them need no encoding
+is_safe_param = re.compile(r'[A-Za-z0-9_.\-]*\Z').match
+
+
+def quote_twice(value):
+    """
+    Encode one param key or value as it appears in the string to sign: it is
+    quoted by urlencode() first, then quoted again with the whole query string
+
+    :param value: param key or value
+    :return: encoded string
+    """
+    if not isinstance(value, str):
+        value = str(value)
+    if is_safe_param(value):
+        return value
+    return quote_plus(quote_plus(value))
+
+
+class AliyunSigner(object):
+    """
+    Sign Aliyun API requests with HMAC-SHA1. The HMAC key state and the
+    encoded static common params are built once and reused by all requests
+    """
+    API_VERSION = '2015-01-09'
+
+    def __init__(self, access_id, access_key):
+        self.access_id = access_id
+        # keyed HMAC state, copied for every request instead of rehashing the key
+        self.hmac = hmac.new((access_key + '&').encode('utf-8'), digestmod=hashlib.sha1)
+        self.static_params = {
+            'Format': 'json',
+            'Version': self.API_VERSION,
+            'AccessKeyId': access_id,
+            'SignatureMethod': 'HMAC-SHA1',
+            'SignatureVersion': "1.0",
+        }
+        # key -> encoded "key=value" of static common params
+        self.encoded_static_params = dict(
+            (key, quote_twice(key) + EQUALS + quote_twice(value))
+            for key, value in self.static_params.items())
+        # request param keys are few, their encoding is cached
+        self.encoded_keys = {}
+        self.sign_prefix = {}
+        # (second, formatted timestamp) of the latest request
+        self.timestamp_cache = (None, None)
+
+    def get_timestamp(self):
+        """
+        Get ISO8601 timestamp: YYYY-MM-DDThh:mm:ssZ in UTC, it is formatted
+        once per second
+
+        :return: timestamp string
+        """
+        now = int(time.time())
+        second, timestamp = self.timestamp_cache
+        if second != now:
+            timestamp = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(now))
+            self.timestamp_cache = (now, timestamp)
+        return timestamp
+
+    @staticmethod
+    def get_nonce():
+        """
+        Get one-time SignatureNonce
+
+        :return: nonce string
+        """
+        return uuid.uuid4().hex
+
+    def get_common_params(self):
+        """
+        Build common params need by Aliyun API
+
+        :return: dict of all nessary params
+        """
+        common_params = dict(self.static_params)
+        common_params['Timestamp'] = self.get_timestamp()
+        common_params['SignatureNonce'] = self.get_nonce()
+        return common_params
+
+    def get_sign_prefix(self, http_method):
+        """
+        Get encoded "HTTPMethod&%2F&" prefix of string to sign
+        """
+        prefix = self.sign_prefix.get(http_method)
+        if prefix is None:
+            prefix = self.sign_prefix[http_method] = http_method + "&" + quote_plus("/") + "&"
+        return prefix
+
+    def get_signature(self, http_method, params):
+        """
+        Add common params to params and sign them, see YunResolver.get_signature()
+        for the steps. The query string is built already quoted twice, static
+        common params are encoded in advance, so only request specific values
+        are encoded here
+
+        :param http_method: 'GET' or 'POST'
+        :param params: dict of request params, common params are added to it
+        :return: signature string
+        """
+        params['Timestamp'] = self.get_timestamp()
+        params['SignatureNonce'] = self.get_nonce()
+
+        # common params override the request ones like YunResolver always did
+        encoded_static_params = self.encoded_static_params
+        encoded_keys = self.encoded_keys
+        pairs = list(encoded_static_params.items())
+        for key, value in params.items():
+            if key in encoded_static_params:
+                continue
+            encoded_key = encoded_keys.get(key)
+            if encoded_key is None:
+                encoded_key = encoded_keys[key] = quote_twice(key) + EQUALS
+            pairs.append((key, encoded_key + quote_twice(value)))
+        params.update(self.static_params)
+
+        pairs.sort()
+        sign_str = self.get_sign_prefix(http_method) + AMPERSAND.join(pair for _, pair in pairs)
+
+        mac = self.hmac.copy()
+        mac.update(sign_str.encode('utf-8'))
+        signature = b64encode(mac.digest())
+        if not isinstance(signature, str):
+            signature = signature.decode('ascii')
+        return signature
+
+    def sign(self, http_method, params):
+        """
+        Sign params in place
+
+        :param http_method: 'GET' or 'POST'
+        :param params: dict of request params
+        :return: params with common params and Signature
+        """
+        params['Signature'] = self.get_signature(http_method, params)
+        return params
+
+    def sign_many(self, http_method, params_list):
+        """
+        Sign a batch of requests
+
+        :param http_method: 'GET' or 'POST'
+        :param params_list: list of dict of request params
+        :return: list of params with common params and Signature
+        """
+        return [self.sign(http_method, params) for params in params_list]
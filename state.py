@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+ Copyright (C) 2010-2013, Ryan Fan
+
+ This program is free software; you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation; either version 2 of the License, or
+ (at your option) any later version.
+
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU Library General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with this program; if not, write to the Free Software
+ Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+"""
+import json
+import os
+import tempfile
+import threading
+import time
+
+from utils import DDNSUtils
+
+# os.rename is atomic on POSIX but can't overwrite on Windows
+replace_file = getattr(os, "replace", os.rename)
+
+
+class DDNSStateCache(object):
+    """
+    On-disk cache of what we know about each DomainRecord: its RecordId,
+    the value we last pushed or verified, and when
+    """
+    VERSION = 1
+
+    def __init__(self, path, refresh_interval=3600):
+        """
+        :param path:             state file path
+        :param refresh_interval: seconds after which a cached value must be
+                                 verified against DNS and Aliyun again
+        """
+        self.path = path
+        self.refresh_interval = refresh_interval
+        self.lock = threading.Lock()
+        self.dirty = False
+        # record key -> {"recordid": ..., "value": ..., "settings": ..., "timestamp": ...}
+        self.records = {}
+
+    @staticmethod
+    def get_key(local_record):
+        """
+        Get state key of LocalDomainRecord
+
+        :param local_record: LocalDomainRecord
+        :return: key string
+        """
+        return "{rec.rr}.{rec.domainname}/{rec.type}".format(rec=local_record)
+
+    def load(self):
+        """
+        Load state file, a missing, corrupted or incompatible file is ignored
+        """
+        try:
+            with open(self.path) as state_file:
+                state = json.load(state_file)
+        except (IOError, OSError):
+            return
+        except ValueError as ex:
+            DDNSUtils.err("Ignored corrupted state file {0}: {1}".format(self.path, ex))
+            return
+
+        if not isinstance(state, dict) or state.get("version") != self.VERSION:
+            DDNSUtils.err("Ignored state file {0} of unsupported version".format(self.path))
+            return
+
+        with self.lock:
+            self.records = state.get("records", {})
+            self.dirty = False
+
+    def save(self):
+        """
+        Write state file atomically if anything changed
+        """
+        with self.lock:
+            if not self.dirty:
+                return
+            state = {"version": self.VERSION, "records": dict(self.records)}
+            self.dirty = False
+
+        state_dir = os.path.dirname(os.path.abspath(self.path))
+        try:
+            fd, tmp_path = tempfile.mkstemp(prefix=".ddns-state-", dir=state_dir)
+            with os.fdopen(fd, "w") as tmp_file:
+                json.dump(state, tmp_file, indent=1, sort_keys=True)
+                tmp_file.flush()
+                os.fsync(tmp_file.fileno())
+            replace_file(tmp_path, self.path)
+        except (IOError, OSError) as ex:
+            DDNSUtils.err("Failed saving state file {0}: {1}".format(self.path, ex))
+
+    def get(self, local_record):
+        """
+        Get cached state of LocalDomainRecord
+
+        :param local_record: LocalDomainRecord
+        :return: dict or None
+        """
+        with self.lock:
+            return self.records.get(self.get_key(local_record))
+
+    def is_fresh(self, local_record, current_ip):
+        """
+        Check whether we pushed or verified current IP, with the same TTL,
+        line and priority, for the record lately, so both DNS and API
+        lookups can be skipped
+
+        :param local_record: LocalDomainRecord
+        :param current_ip:   current IP
+        :return: True or False
+        """
+        state = self.get(local_record)
+        if not state or state.get("value") != current_ip:
+            return False
+
+        if state.get("settings", [None, None, None]) != local_record.get_settings():
+            return False
+
+        return time.time() - state.get("timestamp", 0) < self.refresh_interval
+
+    def get_recordid(self, local_record):
+        """
+        Get cached RecordId of LocalDomainRecord
+
+        :param local_record: LocalDomainRecord
+        :return: RecordId or None
+        """
+        state = self.get(local_record)
+        if not state:
+            return None
+
+        return state.get("recordid")
+
+    def update(self, local_record, value, recordid=None):
+        """
+        Remember the record's value and settings were pushed or verified just now
+
+        :param local_record: LocalDomainRecord
+        :param value:        record value
+        :param recordid:     RecordId, kept unchanged if None
+        """
+        key = self.get_key(local_record)
+        with self.lock:
+            state = self.records.setdefault(key, {})
+            if recordid is not None:
+                state["recordid"] = recordid
+            state["value"] = value
+            state["settings"] = local_record.get_settings()
+            state["timestamp"] = time.time()
+            self.dirty = True
+
+    def invalidate_recordid(self, local_record):
+        """
+        Forget stale RecordId of LocalDomainRecord
+
+        :param local_record: LocalDomainRecord
+        """
+        key = self.get_key(local_record)
+        with self.lock:
+            if key in self.records and self.records[key].pop("recordid", None) is not None:
+                self.dirty = True
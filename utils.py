@@ -17,120 +17,330 @@
  along with this program; if not, write to the Free Software
  Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
 """
-import socket
-from socket import error as socket_error
+import atexit
+import json
+import logging
 import sys
-from datetime import datetime
-import uuid
+import threading
+import time
+if sys.version_info < (3,):
+    import Queue as queue
+else:
+    import queue
 
-import requests
+from dnsclient import DNSClient, DNSError
+from metrics import DNS_LOOKUPS, DNS_LOOKUP_DURATION, LOG_MESSAGES_DROPPED
+
+LOG_FORMATS = ('text', 'json')
+# log lines a DomainRecord may take in one cycle, sizing the log queue
+LOG_LINES_PER_RECORD = 4
+
+
+class TextFormatter(logging.Formatter):
+    """
+    Format log records as "timestamp\t[LEVEL]\tmessage"
+    """
+    def format(self, record):
+        return "{0}\t[{1}]\t{2}".format(self.formatTime(record, "%Y-%m-%d %H:%M:%S"),
+                                       record.levelname, record.getMessage())
+
+
+class JSONFormatter(logging.Formatter):
+    """
+    Format log records as JSON lines, fields given to DDNSUtils.info() and
+    friends are added as keys
+    """
+    def format(self, record):
+        entry = {
+            "time": "{0}.{1:03d}Z".format(time.strftime("%Y-%m-%dT%H:%M:%S",
+                                                       time.gmtime(record.created)),
+                                          int(record.msecs)),
+            "level": record.levelname.lower(),
+            "msg": record.getMessage(),
+        }
+        entry.update(getattr(record, "fields", None) or {})
+        return json.dumps(entry, sort_keys=True, default=str)
+
+
+class MaxLevelFilter(logging.Filter):
+    """
+    Pass log records below a level
+    """
+    def __init__(self, level):
+        logging.Filter.__init__(self)
+        self.level = level
+
+    def filter(self, record):
+        return record.levelno < self.level
+
+
+class QueueLogHandler(logging.Handler):
+    """
+    Hand log records over to a LogWriter thread. When the queue stays full
+    for put_timeout seconds, because stdout is blocked, info and debug
+    records are dropped rather than blocking the caller. Warnings and
+    errors are never dropped
+    """
+    def __init__(self, log_queue, put_timeout=1.0):
+        logging.Handler.__init__(self)
+        self.queue = log_queue
+        self.put_timeout = put_timeout
+        self.dropped = 0
+
+    def emit(self, record):
+        # message is formatted by the writer thread, args must not change meanwhile
+        record.msg = record.getMessage()
+        record.args = None
+        record.exc_info = None
+        if record.levelno >= logging.WARNING:
+            self.queue.put(record)
+            return
+        try:
+            self.queue.put(record, timeout=self.put_timeout)
+        except queue.Full:
+            self.dropped += 1
+            LOG_MESSAGES_DROPPED.inc()
+
+
+class LogWriter(threading.Thread):
+    """
+    Background thread writing queued log records to output handlers
+    """
+    def __init__(self, log_queue, queue_handler, handlers):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.queue = log_queue
+        self.queue_handler = queue_handler
+        self.handlers = handlers
+
+    def run(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+            if not isinstance(record, logging.LogRecord):
+                # flush marker
+                record.set()
+                continue
+            self.handle(record)
+
+            dropped, self.queue_handler.dropped = self.queue_handler.dropped, 0
+            if dropped:
+                self.handle(logging.makeLogRecord({
+                    "name": record.name, "levelno": logging.WARNING, "levelname": "WARNING",
+                    "msg": "{0} log messages dropped as output is blocked".format(dropped),
+                    "fields": {"dropped": dropped}}))
+
+    def handle(self, record):
+        for handler in self.handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+    def flush(self, timeout=5):
+        """
+        Wait until records queued so far are written
+        """
+        written = threading.Event()
+        self.queue.put(written)
+        written.wait(timeout)
+
+    def stop(self, timeout=5):
+        """
+        Write out queued records and stop
+        """
+        self.queue.put(None)
+        self.join(timeout)
 
 
 class DDNSUtils(object):
-    # To support "*" subdomain definition,
-    # We need generate a non-exist subdomain name
-    # Here we generate a random UUID for that
-    #fake_subdomain = ''.join([random.choice(string.lowercase) for i in xrange(12)])
-    RANDOM_UUID = uuid.uuid4().hex 
+    # DNSClient shared by all DNS queries
+    _dns_client = None
+    # logger writing through a background LogWriter
+    _logger = None
+    _log_writer = None
 
     """
     Utils class wrapper
     """
-    @staticmethod
-    def err(msg):
+    @classmethod
+    def setup_logging(cls, log_format="text", debug=False, records=0, queue_size=None):
+        """
+        Set up logging, messages are written by a background thread: info
+        and debug to stdout, errors to stderr
+
+        :param log_format: 'text' or 'json' lines
+        :param debug:      log debug messages
+        :param records:    number of DomainRecords, a cycle logs a few lines each
+        :param queue_size: max messages waiting to be written, default is
+                           sized from records
+        """
+        if queue_size is None:
+            queue_size = max(10000, records * LOG_LINES_PER_RECORD)
+        formatter = JSONFormatter() if log_format == "json" else TextFormatter()
+        stdout_handler = logging.StreamHandler(sys.stdout)
+        stdout_handler.addFilter(MaxLevelFilter(logging.WARNING))
+        stderr_handler = logging.StreamHandler(sys.stderr)
+        stderr_handler.setLevel(logging.WARNING)
+        for handler in (stdout_handler, stderr_handler):
+            handler.setFormatter(formatter)
+
+        log_queue = queue.Queue(queue_size)
+        queue_handler = QueueLogHandler(log_queue)
+        log_writer = LogWriter(log_queue, queue_handler, [stdout_handler, stderr_handler])
+        log_writer.start()
+
+        logger = logging.getLogger("ddns")
+        logger.propagate = False
+        logger.setLevel(logging.DEBUG if debug else logging.INFO)
+        for handler in list(logger.handlers):
+            logger.removeHandler(handler)
+        logger.addHandler(queue_handler)
+
+        if cls._log_writer is not None:
+            cls._log_writer.stop()
+        else:
+            atexit.register(cls.flush_logging)
+        cls._logger = logger
+        cls._log_writer = log_writer
+
+    @classmethod
+    def flush_logging(cls):
+        """
+        Write out queued log messages, called at exit
+        """
+        if cls._log_writer is not None:
+            cls._log_writer.stop()
+            cls._log_writer = None
+            cls._logger = None
+
+    @classmethod
+    def get_logger(cls):
+        """
+        Get the logger, set up with defaults if setup_logging() isn't called yet
+        """
+        if cls._logger is None:
+            cls.setup_logging()
+        return cls._logger
+
+    @classmethod
+    def err(cls, msg, **fields):
         """
         Output error message
         :param msg: Message to be displayed
+        :param fields: structured fields of JSON log lines
         """
-        sys.stderr.write("{0}\t[ERROR]\t{1}\n".format(DDNSUtils.get_current_time(), msg))
+        cls.get_logger().error(msg, extra={"fields": fields})
 
-    @staticmethod
-    def info(msg):
+    @classmethod
+    def info(cls, msg, **fields):
         """
         Output informative message
         :param msg: Message to be displayed
+        :param fields: structured fields of JSON log lines
         """
-        sys.stdout.write("{0}\t[INFO]\t{1}\n".format(DDNSUtils.get_current_time(), msg))
+        cls.get_logger().info(msg, extra={"fields": fields})
 
-    @staticmethod
-    def err_and_exit(msg):
+    @classmethod
+    def debug(cls, msg, **fields):
+        """
+        Output debug message, only if debug is enabled
+        :param msg: Message to be displayed
+        :param fields: structured fields of JSON log lines
+        """
+        logger = cls.get_logger()
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(msg, extra={"fields": fields})
+
+    @classmethod
+    def err_and_exit(cls, msg):
         """
         Output error message and exit
         :param msg: Message to be displayed
         """
-        sys.stderr.write("{0}\t[ERROR]\t{1}\n".format(DDNSUtils.get_current_time(), msg))
+        cls.err(msg)
+        if cls._log_writer is not None:
+            cls._log_writer.flush()
         sys.exit(1)
 
     @classmethod
-    def get_current_public_ip(cls):
+    def get_dns_client(cls):
         """
-        Get current public IP
+        Get the shared DNSClient
 
-        @return  IP address or None
+        :return: DNSClient
         """
-        try:
-            ret = requests.get("http://members.3322.org/dyndns/getip")
-        except requests.RequestException as ex:
-            cls.err("network problem:{0}".format(ex))
-            return None
-
-        if ret.status_code != requests.codes.ok:
-            cls.err("Failed to get current public IP: {0}\n{1}" \
-                    .format(ret.status_code, ret.content))
-            return None
+        if cls._dns_client is None:
+            cls._dns_client = DNSClient()
+        return cls._dns_client
 
-        return ret.content.decode('utf-8').rstrip("\n")
+    @staticmethod
+    def get_query_hostname(subdomain, domainname):
+        """
+        Get hostname to query for DomainRecord. Wildcard records like "*" or
+        "*.dev" are queried by their literal owner name, which authoritative
+        servers answer with the wildcard RRset itself (RFC 4592), so the same
+        cacheable name is asked every time instead of a made up one
 
-    @classmethod
-    def get_interface_address(cls, ifname):
-        import netifaces as ni
-        try:
-            ip = ni.ifaddresses(ifname)[ni.AF_INET][0]['addr']
-            return ip
-        except KeyError:
-            cls.err("Can't find the interface {}".format(ifname))
-            return None
+        :param subdomain:  sub domain
+        :param domainname:     domain name
+        :return:  hostname
+        """
+        if subdomain == "@":
+            return domainname
 
-    @classmethod
-    def get_interface_ipv6_address(cls, ifname):
-        import netifaces as ni
-        try:
-            ip = ni.ifaddresses(ifname)[ni.AF_INET6][0]['addr']
-            return ip
-        except KeyError:
-            cls.err("Can't find the interface {}".format(ifname))
-            return None
+        return "{0}.{1}".format(subdomain, domainname)
 
     @classmethod
-    def get_dns_resolved_ip(cls, subdomain, domainname):
+    def get_dns_resolved_ip(cls, subdomain, domainname, record_type="A", dns_client=None):
         """
-        Get current IP address resolved by DNS server
+        Get current IP address resolved by authoritative DNS server
 
         :param subdomain:  sub domain
         :param domainname:     domain name
+        :param record_type:  'A' or 'AAAA'
+        :param dns_client:  DNSClient, default is the shared one
         :return:  IP address or None
         """
+        dns_client = dns_client or cls.get_dns_client()
+        hostname = cls.get_query_hostname(subdomain, domainname)
         ip_addr = None
         try:
-            if subdomain == "@":
-                hostname = domainname 
-            elif subdomain == "*":
-                hostname = "{0}.{1}".format(cls.RANDOM_UUID, domainname)
-            else:
-                hostname = "{0}.{1}".format(subdomain, domainname)
-
-            ip_addr = socket.gethostbyname(hostname)
-        except socket_error as ex:
+            with DNS_LOOKUP_DURATION.time(mode="single"):
+                ip_addr = dns_client.resolve(hostname, record_type, zone=domainname)
+            DNS_LOOKUPS.inc(result="ok")
+        except DNSError as ex:
+            DNS_LOOKUPS.inc(result="error")
             cls.err("DomainRecord[{0}] cannot be resolved because of:{1}" \
                      .format(hostname, ex))
 
         return ip_addr
 
-    @staticmethod
-    def get_current_time():
+    @classmethod
+    def get_dns_resolved_ips(cls, local_record_list, dns_client=None):
         """
-        Get human readable standard timestamp
+        Get current IP addresses of many DomainRecords, all queries are
+        pipelined to authoritative DNS servers
 
-        :return: timestamp string
+        :param local_record_list:  list of LocalDomainRecord
+        :param dns_client:  DNSClient, default is the shared one
+        :return:  dict of (domainname, rr, type) -> IP address or None
         """
-        return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        dns_client = dns_client or cls.get_dns_client()
+        queries = []
+        for rec in local_record_list:
+            queries.append((cls.get_query_hostname(rec.subdomain, rec.domainname),
+                            rec.type, rec.domainname))
+
+        with DNS_LOOKUP_DURATION.time(mode="batch"):
+            results = dns_client.resolve_many(queries)
+
+        resolved_ips = {}
+        for rec, (hostname, qtype, _) in zip(local_record_list, queries):
+            ip_addr, error = results[(hostname, qtype)]
+            DNS_LOOKUPS.inc(result="error" if error else "ok")
+            if error:
+                cls.err("DomainRecord[{0}] cannot be resolved because of:{1}" \
+                         .format(hostname, error))
+            resolved_ips[rec.key] = ip_addr
+
+        return resolved_ips
@@ -17,52 +17,214 @@
  along with this program; if not, write to the Free Software
  Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
 """
-from __future__ import print_function
-import sys
-if sys.version_info < (3,):
-    from urllib import urlencode, quote_plus 
-else:
-    from urllib.parse import urlencode, quote_plus
+import threading
+import time
 
-import hmac
-import hashlib
-import uuid
-from datetime import datetime
+from signer import AliyunSigner
+from utils import DDNSUtils
+from metrics import API_REQUESTS, API_REQUEST_DURATION, API_RETRIES
 
-import requests
+DEFAULT_API_URL = "https://dns.aliyuncs.com/"
+
+# Aliyun allows at most 500 records per DescribeDomainRecords page
+MAX_PAGE_SIZE = 500
+
+# TTL range allowed by Aliyun, the minimum TTL depends on the DNS plan
+VALID_TTLS = range(1, 86401)
+VALID_PRIORITIES = range(1, 11)
+VALID_LINES = ('default', 'telecom', 'unicom', 'mobile', 'oversea', 'edu',
+               'drpeng', 'btvn', 'search', 'google', 'baidu', 'biying')
+
+HTTP_OK = 200
+
+# error codes returned by Aliyun when API calls exceed the quota
+THROTTLING_CODES = ('Throttling', 'Throttling.User', 'Throttling.Api', 'ServiceUnavailable')
+
+
+class ThrottlingError(Exception):
+    """
+    Raised when Aliyun rejects a request because of flow control
+    """
+    pass
+
+
+def prefetch(func, *args, **kwargs):
+    """
+    Run func in a background thread
+
+    :return: callable which waits for and returns the result of func
+    """
+    result = {}
+
+    def run():
+        try:
+            result['value'] = func(*args, **kwargs)
+        except Exception as ex: # pylint: disable=broad-except
+            result['error'] = ex
+
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+
+    def wait():
+        thread.join()
+        if 'error' in result:
+            raise result['error']
+        return result.get('value')
+
+    return wait
 
 class YunResolver(object):
     """
     Implementation of Aliyun Resolver API
     """
-    def __init__(self, access_id, access_key, debug):
-        self.url = "https://dns.aliyuncs.com/"
+    def __init__(self, access_id, access_key, debug, pool_size=10,
+                 connect_timeout=5, read_timeout=10, max_retries=3, retry_backoff=0.5,
+                 url=DEFAULT_API_URL):
+        self.url = url
         self.access_id = access_id
-        self.hash_key = access_key + '&'
+        self.signer = AliyunSigner(access_id, access_key)
         self.debug = debug
+        self.pool_size = pool_size
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self._session = None
+
+    @property
+    def session(self):
+        """
+        Keep-alive http session, created on first use
+        """
+        if self._session is None:
+            self._session = self.create_session(self.pool_size, self.max_retries,
+                                                self.retry_backoff)
+        return self._session
 
-    def get_common_params(self):
+    @staticmethod
+    def create_session(pool_size, max_retries, retry_backoff):
         """
-        Build common params need by Aliyun API
+        Create keep-alive http session with connection pool and retry policy,
+        which is reused by all API calls of this resolver
 
-        :return: dict of all nessary params
+        :return: requests.Session
+        """
+        # requests is only imported once an API call is really made, most
+        # runs find nothing to change and never need it
+        import requests
+        from requests.adapters import HTTPAdapter
+        try:
+            from urllib3.util.retry import Retry
+        except ImportError:
+            from requests.packages.urllib3.util.retry import Retry # pylint: disable=import-error
+
+        # Signed requests carry an one-time SignatureNonce, so urllib3 only
+        # retries when the request surely didn't reach Aliyun: connection
+        # failures. Error responses are retried by request() with a new nonce
+        retry = Retry(total=max_retries, connect=max_retries, read=0, status=0,
+                      backoff_factor=retry_backoff, raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size,
+                              max_retries=retry)
+
+        session = requests.Session()
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    def close(self):
         """
+        Close pooled connections
+        """
+        if self._session is not None:
+            self._session.close()
+            self._session = None
 
-      # ISO8601 standard: YYYY-MM-DDThh:mm:ssZ, e,g:2015-0109T12:00:00Z (UTC Timezone)
-        current_timestamp = datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
-        signature_nonce = uuid.uuid4()
+    @staticmethod
+    def is_retryable(status, error_code):
+        """
+        Whether a failed request is worth sending again: server errors and
+        flow control, but not errors of the request itself
 
-        common_params = {
-            'Format': 'json',
-            'Version': '2015-01-09',
-            'AccessKeyId': self.access_id,
-            'Timestamp': current_timestamp,
-            'SignatureMethod': 'HMAC-SHA1',
-            'SignatureNonce': signature_nonce,
-            'SignatureVersion': "1.0",
-        }
+        :param status: http status
+        :param error_code: Aliyun error code or None
+        :return: True or False
+        """
+        return status >= 500 or error_code in THROTTLING_CODES
+
+    def resign(self, params):
+        """
+        Sign params again with a new Timestamp and SignatureNonce, Aliyun
+        rejects a request replaying a used nonce
+
+        :param params: signed request params
+        :return: params
+        """
+        params.pop('Signature', None)
+        return self.signer.sign("GET", params)
 
-        return common_params
+    def request(self, params, raise_throttling=False):
+        """
+        Send signed request to Aliyun through the pooled session, server
+        errors and flow control are retried with backoff, signed again for
+        every attempt
+
+        :param params: signed request params
+        :param raise_throttling: raise ThrottlingError at once if Aliyun asks
+                                 to slow down, so that the caller backs off
+        :return: requests.Response
+        :raise ThrottlingError: if raise_throttling is set and Aliyun asks to slow down
+        """
+        action = params.get('Action', '')
+        attempt = 0
+        while True:
+            start_time = time.time()
+            try:
+                ret = self.session.get(self.url, params=params, timeout=self.timeout)
+            except Exception:
+                API_REQUESTS.inc(action=action, code="error")
+                raise
+            finally:
+                API_REQUEST_DURATION.observe(time.time() - start_time, action=action)
+
+            API_REQUESTS.inc(action=action, code=ret.status_code)
+            # urllib3 keeps the retries made for this response
+            retries = getattr(getattr(ret.raw, 'retries', None), 'history', None)
+            if retries:
+                API_RETRIES.inc(len(retries), action=action)
+            if ret.status_code == HTTP_OK:
+                return ret
+
+            error_code = self.get_error_code(ret)
+            if raise_throttling and error_code in THROTTLING_CODES:
+                raise ThrottlingError(error_code)
+            if attempt >= self.max_retries or not self.is_retryable(ret.status_code, error_code):
+                return ret
+
+            API_RETRIES.inc(action=action)
+            time.sleep(self.retry_backoff * (2 ** attempt))
+            attempt += 1
+            self.resign(params)
+
+    @staticmethod
+    def get_error_code(ret):
+        """
+        Get Aliyun error code from failed response
+
+        :param ret: requests.Response
+        :return: error code or None
+        """
+        try:
+            return ret.json().get('Code')
+        except (ValueError, AttributeError):
+            return None
+
+    def get_common_params(self):
+        """
+        Build common params need by Aliyun API
+
+        :return: dict of all nessary params
+        """
+        return self.signer.get_common_params()
 
     def get_signature(self, http_method, params):
         """
@@ -76,32 +238,14 @@ class YunResolver(object):
 
         @return string
         """
-        def sha1_hmac(key, str_to_sign):
-            if sys.version_info < (3,):
-                hash_value = hmac.new(self.hash_key, sign_str, hashlib.sha1).digest()
-                return hash_value.encode('base64').strip('\n')
-            else:
-                from base64 import b64encode
-                key = bytes(key, 'utf-8') 
-                str_to_sign = bytes(str_to_sign, 'utf-8')
-                byte_hash_value = hmac.new(key, str_to_sign, hashlib.sha1).digest()
-                return str(b64encode(byte_hash_value), 'utf8').strip('\n')
-
-        params.update(self.get_common_params())
-        sorted_params = sorted(params.items())
-        canon_str = urlencode(sorted_params)
-        sign_str = http_method + "&" + quote_plus("/") + "&" + quote_plus(canon_str)
-
-        # hmac sha1 algrithm
-        signature = sha1_hmac(self.hash_key, sign_str) 
-
-        return signature
+        return self.signer.get_signature(http_method, params)
 
-    def describe_domain_records(self, domain_name, page_number=None, page_size=None,
-                                rr_keyword="", type_keyword="", value_keyword=""):
+    def get_describe_domain_records_params(self, domain_name, page_number=None, page_size=None,
+                                           rr_keyword="", type_keyword="", value_keyword=""):
         """
-        query:  DomainName(*), PageNumber, PageSize, RRKeyWord, TypeKeyWord, ValueKeyWord
-        return: TotalCount, PageNumber, PageSize, DomainRecords
+        Build signed params of DescribeDomainRecords
+
+        :return: dict of params
         """
         http_method = "GET"
         params = {
@@ -123,51 +267,122 @@ class YunResolver(object):
 
         params.update(optional_params)
         # add signature
-        params.update({"Signature": self.get_signature(http_method, params)})
+        self.signer.sign(http_method, params)
+
+        return params
+
+    def describe_domain_records_page(self, domain_name, page_number=None, page_size=None,
+                                     rr_keyword="", type_keyword="", value_keyword=""):
+        """
+        query:  DomainName(*), PageNumber, PageSize, RRKeyWord, TypeKeyWord, ValueKeyWord
+        return: TotalCount, PageNumber, PageSize, DomainRecords
+        """
+        params = self.get_describe_domain_records_params(domain_name,
+                                                         page_number=page_number,
+                                                         page_size=page_size,
+                                                         rr_keyword=rr_keyword,
+                                                         type_keyword=type_keyword,
+                                                         value_keyword=value_keyword)
 
         # do real http action
-        try:
-            ret = requests.get(self.url, params=params)
-        except requests.RequestException as ex:
-            raise ex
+        ret = self.request(params)
 
-        if ret.status_code != requests.codes.ok:
-            print("Server side problem: {0}".format(ret.status_code))
+        if ret.status_code != HTTP_OK:
+            DDNSUtils.err("Server side problem: {0}".format(ret.status_code),
+                          action="DescribeDomainRecords", status=ret.status_code)
             if self.debug:
-                print("Error in describeDomainRecords(), " \
-                       "params: {0},\nhttp response: {1}" \
-                       .format(params, ret.content))
+                DDNSUtils.err("Error in describeDomainRecords(), " \
+                              "params: {0},\nhttp response: {1}" \
+                              .format(params, ret.content),
+                              action="DescribeDomainRecords", params=params, response=ret.content)
             return None
 
-        domain_record_list = []
         try:
             json_result = ret.json()
-            total_records = json_result.get('TotalCount', 0)
-            if total_records == 0:
-                return None
+        except ValueError as ex:
+            raise ex
+
+        return json_result
+
+    def iter_domain_records(self, domain_name, page_size=MAX_PAGE_SIZE,
+                            rr_keyword="", type_keyword="", value_keyword=""):
+        """
+        Generator walking through all pages of DescribeDomainRecords, the next
+        page is prefetched in background while the current one is consumed, so
+        at most two pages are held in memory
+
+        :return: generator of domain record dict
+        """
+        def fetch(page_number):
+            return self.describe_domain_records_page(domain_name,
+                                                     page_number=page_number,
+                                                     page_size=page_size,
+                                                     rr_keyword=rr_keyword,
+                                                     type_keyword=type_keyword,
+                                                     value_keyword=value_keyword)
+
+        page_number = 1
+        fetched_count = 0
+        json_result = fetch(page_number)
+        while json_result:
+            total_count = json_result.get('TotalCount', 0)
+            records = json_result.get('DomainRecords', {}).get('Record', [])
+            fetched_count += len(records)
+
+            next_page = None
+            if records and fetched_count < total_count:
+                page_number += 1
+                next_page = prefetch(fetch, page_number)
 
-            records = json_result['DomainRecords']['Record']
             for rec in records:
-                domain_record_list.append(rec)
-        except requests.RequestException as ex:
-            raise ex
+                yield rec
 
-        return domain_record_list
+            if next_page is None:
+                break
 
-    def update_domain_record(self, record_id, rr="www", record_type="A", record_value="192.168.0.1",
-                             ttl=None, priority=None, line=None):
+            json_result = next_page()
+            if not json_result:
+                DDNSUtils.err("Failed fetching page {0} of DomainRecords for {1}, " \
+                              "got {2} of {3} records".format(page_number, domain_name,
+                                                               fetched_count, total_count),
+                              domain=domain_name, page=page_number, fetched=fetched_count,
+                              total=total_count)
+
+    def describe_domain_records(self, domain_name, page_number=None, page_size=None,
+                                rr_keyword="", type_keyword="", value_keyword=""):
         """
-        Update remote domain record on Aliyun server
+        Fetch domain records as list, all pages are fetched unless page_number is given
 
-        :param record_id:     record id
-        :param rr:            sub domain
-        :param record_type:   record type
-        :param record_value:  record value
-        :param ttl:           TTL
-        :param priority:      priority
-        :param line:          resolve line
+        :return: list of domain record dict or None
+        """
+        if page_number:
+            json_result = self.describe_domain_records_page(domain_name,
+                                                            page_number=page_number,
+                                                            page_size=page_size,
+                                                            rr_keyword=rr_keyword,
+                                                            type_keyword=type_keyword,
+                                                            value_keyword=value_keyword)
+            if not json_result or json_result.get('TotalCount', 0) == 0:
+                return None
+            return list(json_result['DomainRecords']['Record'])
+
+        domain_record_list = list(self.iter_domain_records(domain_name,
+                                                           page_size=page_size or MAX_PAGE_SIZE,
+                                                           rr_keyword=rr_keyword,
+                                                           type_keyword=type_keyword,
+                                                           value_keyword=value_keyword))
+        if not domain_record_list:
+            return None
 
-        :return: True if succeed, of False if failed
+        return domain_record_list
+
+    def get_update_domain_record_params(self, record_id, rr="www", record_type="A",
+                                        record_value="192.168.0.1",
+                                        ttl=None, priority=None, line=None):
+        """
+        Build signed params of UpdateDomainRecord
+
+        :return: dict of params, or None if any param is invalid
         """
         http_method = "GET"
         params = {
@@ -180,53 +395,71 @@ class YunResolver(object):
 
         optional_params = {}
         if ttl:
-            valid_ttl_list = [1, 5, 10, 60, 120, 600, 1800, 3600, 43200, 86400]
-            if ttl not in valid_ttl_list:
-                print("Invalid TTL, it need to be one of them: %s" % valid_ttl_list)
-                return False
+            if ttl not in VALID_TTLS:
+                DDNSUtils.err("Invalid TTL, it need to be in range: %s-%s" \
+                              % (VALID_TTLS[0], VALID_TTLS[-1]), record_id=record_id, ttl=ttl)
+                return None
             optional_params['TTL'] = ttl
 
         if priority:
-            valid_priorities = range(1, 11)
-            if priority not in valid_priorities:
-                print("Invalid priority, it need to be one of them: %s" % valid_priorities)
+            if priority not in VALID_PRIORITIES:
+                DDNSUtils.err("Invalid priority, it need to be one of them: %s" \
+                              % (VALID_PRIORITIES,), record_id=record_id, priority=priority)
             optional_params['Priority'] = priority
 
+        # configured lines are checked against VALID_LINES by LocalDomainRecord,
+        # a record's current line is sent back as is since Aliyun has many more
         if line:
-            valid_lines = ['default', 'telecom', 'unicom',
-                           'mobile', 'oversea', 'edu',
-                           'google', 'baidu', 'biying']
-            if line not in valid_lines:
-                print("Invalid line, it need to be one of them: %s" % valid_lines)
-                return False
             optional_params['Line'] = line
 
         params.update(optional_params)
         # add signature
-        params.update({"Signature": self.get_signature(http_method, params)})
+        self.signer.sign(http_method, params)
 
-        # do real http action
-        try:
-            ret = requests.get(self.url, params=params)
-        except requests.RequestException as ex:
-            raise ex
+        return params
 
-        if ret.status_code != requests.codes.ok:
-            print("Server side problem: {0}".format(ret.status_code))
+    def update_domain_record(self, record_id, rr="www", record_type="A", record_value="192.168.0.1",
+                             ttl=None, priority=None, line=None):
+        """
+        Update remote domain record on Aliyun server
+
+        :param record_id:     record id
+        :param rr:            sub domain
+        :param record_type:   record type
+        :param record_value:  record value
+        :param ttl:           TTL
+        :param priority:      priority
+        :param line:          resolve line
+
+        :return: True if succeed, of False if failed
+        """
+        params = self.get_update_domain_record_params(record_id, rr=rr,
+                                                      record_type=record_type,
+                                                      record_value=record_value,
+                                                      ttl=ttl, priority=priority, line=line)
+        if params is None:
+            return False
+
+        # do real http action, throttling is left to the update scheduler
+        ret = self.request(params, raise_throttling=True)
+
+        if ret.status_code != HTTP_OK:
+            DDNSUtils.err("Server side problem: {0}".format(ret.status_code),
+                          action="UpdateDomainRecord", status=ret.status_code)
             if self.debug:
-                print("Error in updateDomainRecord(), " \
-                       "params: {0},\nhttp response: {1}" \
-                       .format(params, ret.content))
+                DDNSUtils.err("Error in updateDomainRecord(), " \
+                              "params: {0},\nhttp response: {1}" \
+                              .format(params, ret.content),
+                              action="UpdateDomainRecord", params=params, response=ret.content)
             return False
 
         return True
 
-    def describe_domain_record_info(self, record_id):
+    def get_describe_domain_record_info_params(self, record_id):
         """
-        Fetch remote domain record info by record id
+        Build signed params of DescribeDomainRecordInfo
 
-        :param record_id:  domain record id
-        :return:  dict
+        :return: dict of params
         """
         http_method = "GET"
         params = {
@@ -234,20 +467,31 @@ class YunResolver(object):
             'RecordId': record_id,
         }
         # add signature
-        params.update({"Signature": self.get_signature(http_method, params)})
+        self.signer.sign(http_method, params)
+
+        return params
+
+    def describe_domain_record_info(self, record_id):
+        """
+        Fetch remote domain record info by record id
+
+        :param record_id:  domain record id
+        :return:  dict
+        """
+        params = self.get_describe_domain_record_info_params(record_id)
 
         # do real http action
-        try:
-            ret = requests.get(self.url, params=params)
-        except requests.RequestException as ex:
-            raise ex
+        ret = self.request(params)
 
-        if ret.status_code != requests.codes.ok:
-            print("Server side problem: {0}".format(ret.status_code))
+        if ret.status_code != HTTP_OK:
+            DDNSUtils.err("Server side problem: {0}".format(ret.status_code),
+                          action="DescribeDomainRecordInfo", status=ret.status_code)
             if self.debug:
-                print("Error in describeDomainRecordInfo(), " \
-                       "params: {0},\nhttp response: {1}" \
-                       .format(params, ret.content))
+                DDNSUtils.err("Error in describeDomainRecordInfo(), " \
+                              "params: {0},\nhttp response: {1}" \
+                              .format(params, ret.content),
+                              action="DescribeDomainRecordInfo", params=params,
+                              response=ret.content)
             return False
 
         return ret.json()